@@ -0,0 +1,296 @@
+import math
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from catalog import catalog
+from metrics import metrics
+from sqlite_handler import QueryBudget, budget_scope
+
+SEARCH_FRACTION = 0.1  # Share of a table an index search is assumed to visit when nothing better is known
+MIN_QUERY_COST = 1000  # Rows charged for any query, so floods of tiny queries are limited too
+MAX_BUCKETS = 4096
+_PLAN_STEP = re.compile(r'^(SCAN|SEARCH) (?:TABLE )?(\S+)')
+_FINAL_LIMIT = re.compile(r'\blimit\s+(\d+)(?:\s*(?:offset|,)\s*(\d+))?\s*;?\s*$', re.IGNORECASE)
+# A LIMIT only stops these queries after all rows were examined
+_NEEDS_ALL_ROWS = re.compile(r'\b(?:group\s+by|distinct|union|except|intersect|window|over)\b|'
+                             r'\b(?:count|sum|total|avg|min|max|group_concat)\s*\(', re.IGNORECASE)
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, tokens):
+        """Seconds until the bucket holds the tokens (a request larger than the bucket needs it full)."""
+        return max(0.0, min(tokens, self.capacity) - self.tokens) / self.rate
+
+    def take(self, tokens):
+        self.tokens -= min(tokens, self.capacity)
+
+
+class AdmissionController:
+    def __init__(self, user_rate=100000, user_burst=2000000, database_rate=1000000, database_burst=20000000,
+                 max_cost=20000000, max_concurrent=4, max_wait=10, max_rows=1000000, max_seconds=30):
+        """
+        Decides whether a query may run now, later or not at all.
+
+        The cost of a query is the number of rows it is expected to examine, estimated from its EXPLAIN
+        QUERY PLAN and the row counts of the catalog. Queries costing more than max_cost are rejected.
+        Otherwise the cost is taken from a token bucket of the user and one of the database, both refilled
+        with rows per second; a query waits up to max_wait seconds for its tokens and for one of the
+        max_concurrent slots, and is rejected if they do not become free in time. Admitted queries of users
+        run under a QueryBudget of max_rows fetched rows and max_seconds spent in SQLite. Admins skip the cost
+        check, the buckets and the budget, but not the concurrency limit. Callers give the slot back while they
+        send a result (see released).
+        Limits apply per process: the bot and Streamlit each enforce them for their own queries.
+
+        :param user_rate: Rows per second added to each user's bucket.
+        :param user_burst: Size of each user's bucket.
+        :param database_rate: Rows per second added to each database's bucket.
+        :param database_burst: Size of each database's bucket.
+        :param max_cost: Estimated rows above which a query is rejected.
+        :param max_concurrent: Queries running at the same time in this process.
+        :param max_wait: Seconds a query may wait for tokens or a slot before it is rejected.
+        :param max_rows: Rows a user's query may fetch.
+        :param max_seconds: Seconds a user's query may spend in SQLite.
+        """
+        self._lock = threading.Lock()
+        self._user_buckets = {}
+        self._database_buckets = {}
+        self.stats = {'admitted': 0, 'waited': 0, 'wait_time': 0.0, 'rejected_cost': 0, 'rejected_rate': 0,
+                      'rejected_busy': 0, 'budget_exceeded': 0}
+        self._running = 0
+        self._slots = threading.Condition(self._lock)
+        self._holder = threading.local()  # holds_slot: this thread is inside admit() with a slot
+        self.configure(user_rate, user_burst, database_rate, database_burst, max_cost, max_concurrent, max_wait,
+                       max_rows, max_seconds)
+
+    def configure(self, user_rate=100000, user_burst=2000000, database_rate=1000000, database_burst=20000000,
+                  max_cost=20000000, max_concurrent=4, max_wait=10, max_rows=1000000, max_seconds=30):
+        """
+        Change the limits. Streamlit calls this on every rerun, so the same values change nothing; new rates
+        apply to the existing buckets without refilling them, and waiting queries re-check the new limits.
+        """
+        limits = (user_rate, user_burst, database_rate, database_burst, max_cost, max_concurrent, max_wait,
+                  max_rows, max_seconds)
+        with self._slots:
+            if limits == getattr(self, '_limits', None):
+                return
+            self._limits = limits
+            self.user_rate = user_rate
+            self.user_burst = user_burst
+            self.database_rate = database_rate
+            self.database_burst = database_burst
+            self.max_cost = max_cost
+            self.max_concurrent = max_concurrent
+            self.max_wait = max_wait
+            self.max_rows = max_rows
+            self.max_seconds = max_seconds
+            now = time.monotonic()
+            for buckets, rate, capacity in ((self._user_buckets, user_rate, user_burst),
+                                            (self._database_buckets, database_rate, database_burst)):
+                for bucket in buckets.values():
+                    bucket.refill(now)
+                    bucket.rate = rate
+                    bucket.capacity = capacity
+                    bucket.tokens = min(bucket.tokens, capacity)
+            self._slots.notify_all()
+
+    @staticmethod
+    def estimate(viewer, query):
+        """
+        Rows the query is expected to examine.
+
+        Every SCAN of a table counts its rows and every SEARCH a SEARCH_FRACTION of them (one row for a rowid
+        lookup). Steps of the same (sub)query are nested loops, so each multiplies the rows of the steps
+        before it; a temporary b-tree for sorting or grouping counts the rows it receives once more.
+        Aliases and subqueries are charged like the largest table the statement reads. A final LIMIT caps
+        the cost of a single loop that is neither sorted nor aggregated.
+        """
+        database = catalog.database(os.path.basename(viewer.database_name))
+        tables = database.tables if database is not None else {}
+        rows_of = {name: table.row_estimate or 0 for name, table in tables.items()}
+        read = [rows_of.get(name, 0) for name in viewer.classify(query).tables]
+        largest = max(read, default=0)
+        with viewer.connection() as connection:
+            plan = connection.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+        loops = {}  # parent step -> rows produced by its nested loops so far
+        cost = 0
+        for _, parent, _, detail in plan:
+            match = _PLAN_STEP.match(detail)
+            if match:
+                kind, name = match.groups()
+                if name == 'CONSTANT':
+                    rows = 1
+                elif kind == 'SEARCH' and 'INTEGER PRIMARY KEY (rowid=?)' in detail:
+                    rows = 1
+                else:
+                    rows = rows_of.get(name, largest)
+                    if kind == 'SEARCH':
+                        rows = max(1, int(rows * SEARCH_FRACTION))
+                loops[parent] = loops.get(parent, 1) * rows
+                cost += loops[parent]
+            elif detail.startswith('USE TEMP B-TREE'):
+                cost += loops.get(parent, 1)
+        limit = _FINAL_LIMIT.search(query)
+        if limit and len(plan) == 1 and not _NEEDS_ALL_ROWS.search(query):
+            cost = min(cost, int(limit.group(1)) + int(limit.group(2) or 0))
+        return cost
+
+    def _bucket(self, buckets, key, rate, capacity):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= MAX_BUCKETS:
+                now = time.monotonic()
+                for stale in [key for key, bucket in buckets.items()
+                              if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.capacity]:
+                    del buckets[stale]  # Full buckets hold no state worth keeping
+            bucket = buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+    def _reserve(self, owner, database, cost, deadline):
+        """Take the cost from both buckets and a concurrency slot, waiting until the deadline (None: forever)."""
+        with self._slots:
+            buckets = []
+            if cost is not None:
+                buckets = [self._bucket(self._user_buckets, owner, self.user_rate, self.user_burst),
+                           self._bucket(self._database_buckets, database, self.database_rate, self.database_burst)]
+            while True:
+                now = time.monotonic()
+                for bucket in buckets:
+                    bucket.refill(now)
+                delay = max([bucket.delay(cost) for bucket in buckets], default=0.0)
+                if delay == 0 and self._running < self.max_concurrent:
+                    for bucket in buckets:
+                        bucket.take(cost)
+                    self._running += 1
+                    return
+                if deadline is not None and delay and now + delay > deadline:
+                    self.stats['rejected_rate'] += 1
+                    raise RuntimeError(f"Too many queries, try again in {delay:.0f}s.")
+                if deadline is not None and now >= deadline:
+                    self.stats['rejected_busy'] += 1
+                    raise RuntimeError("The server is busy, try again in a moment.")
+                # Woken early when a slot is released; tokens only come back with time
+                timeout = delay or None
+                if deadline is not None:
+                    timeout = min(timeout, deadline - now) if timeout else deadline - now
+                self._slots.wait(timeout)
+
+    def _release(self):
+        with self._slots:
+            self._running -= 1
+            self._slots.notify()
+
+    def check_cost(self, viewer, query, cost=None):
+        """
+        Estimate the cost of a query (unless given) and raise RuntimeError if it is above max_cost.
+
+        :return: The cost to charge, at least MIN_QUERY_COST.
+        """
+        if cost is None:
+            cost = self.estimate(viewer, query)
+        if cost > self.max_cost:
+            self.stats['rejected_cost'] += 1
+            raise RuntimeError(f"This query would examine about {cost:,} rows, more than the limit of "
+                               f"{self.max_cost:,}. Add a WHERE clause on an indexed column or a LIMIT.")
+        return max(cost, MIN_QUERY_COST)
+
+    def charge(self, owner, viewer, query):
+        """
+        Admit a query that runs later, e.g. a background job: check its cost and take it from the buckets of
+        the user and the database right away, or raise RuntimeError without waiting.
+        """
+        cost = self.check_cost(viewer, query)
+        with self._slots:
+            buckets = [self._bucket(self._user_buckets, owner, self.user_rate, self.user_burst),
+                       self._bucket(self._database_buckets, os.path.abspath(viewer.database_name),
+                                    self.database_rate, self.database_burst)]
+            now = time.monotonic()
+            for bucket in buckets:
+                bucket.refill(now)
+            delay = max(bucket.delay(cost) for bucket in buckets)
+            if delay:
+                self.stats['rejected_rate'] += 1
+                raise RuntimeError(f"Too many queries, try again in {math.ceil(delay)}s.")
+            for bucket in buckets:
+                bucket.take(cost)
+            self.stats['admitted'] += 1
+        return cost
+
+    @contextmanager
+    def admit(self, owner, viewer, query, cost=None, privileged=False):
+        """
+        Admit a read query for the duration of a with block, or raise RuntimeError saying why not.
+
+        Statements run by this thread inside the block are held to the user's QueryBudget (yielded, None for
+        privileged callers) and fail with a RuntimeError once it is exceeded.
+
+        :param owner: Who runs the query, e.g. "chat:<id>" for the bot.
+        :param cost: Rows the query examines when the caller knows better than the estimate (e.g. a page).
+        :param privileged: Admin queries only wait for a concurrency slot.
+        """
+        if not privileged:
+            cost = self.check_cost(viewer, query, cost)
+        started = time.monotonic()
+        self._reserve(owner, os.path.abspath(viewer.database_name), None if privileged else cost,
+                      started + self.max_wait)
+        waited = time.monotonic() - started
+        with self._lock:
+            self.stats['admitted'] += 1
+            if waited > 0.001:
+                self.stats['waited'] += 1
+                self.stats['wait_time'] += waited
+        budget = None if privileged else QueryBudget(self.max_rows, self.max_seconds)
+        self._holder.holds_slot = True
+        try:
+            with budget_scope(budget):
+                yield budget
+        except RuntimeError:
+            if budget is not None and budget.reason is not None:
+                self.stats['budget_exceeded'] += 1
+            raise
+        finally:
+            self._holder.holds_slot = False
+            self._release()
+
+    @contextmanager
+    def released(self):
+        """
+        Give the concurrency slot of this thread's admitted query to others for the duration of a with block,
+        e.g. while its result is uploaded, then wait for a slot again. Does nothing outside admit().
+        """
+        if not getattr(self._holder, 'holds_slot', False):
+            yield
+            return
+        self._holder.holds_slot = False
+        self._release()
+        try:
+            yield
+        finally:
+            # Already admitted and charged, so it waits as long as it takes instead of being rejected
+            self._reserve(None, None, None, None)
+            self._holder.holds_slot = True
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['running'] = self._running
+            stats['max_concurrent'] = self.max_concurrent
+        return stats
+
+
+# Shared by the bot handlers and Streamlit sessions of this process; configured from the ADMISSION_* settings
+admission = AdmissionController()
+metrics.register_stats('admission', admission.get_stats, "Query admission control")
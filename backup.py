@@ -0,0 +1,308 @@
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+from catalog import catalog, DATABASE_DIR
+from metrics import metrics
+from sqlite_handler import result_cache
+
+SNAPSHOT_SUFFIX = ".db.gz"
+PAGES_PER_STEP = 1024
+MAX_RESTARTS = 3  # Incremental passes restarted by concurrent writes before the rest is copied in one step
+LOCK_TIMEOUT = 3600  # Seconds after which the lock of a crashed snapshot is ignored
+BACKUP_SECONDS = metrics.histogram('backup_seconds', "Duration of snapshots and restores", ['operation'])
+BACKUP_BYTES = metrics.counter('backup_bytes_total', "Database bytes copied by snapshots and restores",
+                               ['operation'])
+
+
+class Snapshot:
+    __slots__ = ('database', 'name', 'path', 'created_at', 'size')
+
+    def __init__(self, database, name, path, created_at, size):
+        self.database = database
+        self.name = name  # e.g. 20240501-031500 or 20240501-031500-pre-restore
+        self.path = path
+        self.created_at = created_at
+        self.size = size  # Compressed bytes
+
+
+class BackupResult:
+    """What a snapshot or restore copied and how fast."""
+    __slots__ = ('snapshot', 'pages', 'bytes', 'seconds', 'restarts')
+
+    def __init__(self, snapshot, pages, size, seconds, restarts):
+        self.snapshot = snapshot
+        self.pages = pages
+        self.bytes = size  # Database bytes copied
+        self.seconds = seconds
+        self.restarts = restarts
+
+    @property
+    def throughput(self):
+        """Megabytes per second."""
+        return self.bytes / 1024 / 1024 / self.seconds if self.seconds else 0.0
+
+    def describe(self):
+        return (f"{self.bytes / 1024 / 1024:.1f} MB ({self.pages:,} pages) in {self.seconds:.1f}s, "
+                f"{self.throughput:.1f} MB/s")
+
+
+class _Restarted(Exception):
+    pass
+
+
+class BackupManager:
+    def __init__(self, directory=None, database_dir=DATABASE_DIR, interval=0, keep=7, pages_per_step=PAGES_PER_STEP,
+                 step_pause=0.0):
+        """
+        Online snapshots of the SQLite databases with the sqlite3 backup API.
+
+        A snapshot copies pages_per_step pages at a time from a read-only connection, so readers and writers of
+        the database keep working between the steps (step_pause adds a pause to give writers more room). When
+        other connections write while the copy runs SQLite restarts it; after MAX_RESTARTS restarts the rest is
+        copied in a single step, which in WAL mode only holds a read transaction. The copy is gzipped into
+        <directory>/<database>/<timestamp>.db.gz and only the newest `keep` snapshots of a database are kept.
+        A restore copies a snapshot back through the backup API into the live database after saving the
+        current state as a "pre-restore" snapshot, so open connections see the restored data on their next read.
+
+        :param directory: Directory of the snapshots; backups are disabled while it is None.
+        :param database_dir: Directory of the live databases.
+        :param interval: Seconds between scheduled snapshots of a changed database, 0 for none.
+        :param keep: Snapshots kept per database.
+        :param pages_per_step: Pages copied by one backup step.
+        :param step_pause: Seconds slept between two steps.
+        """
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.stats = {'snapshots': 0, 'restores': 0, 'failures': 0, 'bytes_copied': 0, 'restarts': 0,
+                      'last_throughput_mb_s': 0.0}
+        self.configure(directory, database_dir, interval, keep, pages_per_step, step_pause)
+
+    def configure(self, directory=None, database_dir=DATABASE_DIR, interval=0, keep=7,
+                  pages_per_step=PAGES_PER_STEP, step_pause=0.0):
+        self.directory = os.path.abspath(directory) if directory else None
+        self.database_dir = database_dir
+        self.interval = interval
+        self.keep = keep
+        self.pages_per_step = pages_per_step
+        self.step_pause = step_pause
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def _database_path(self, db_name):
+        if os.path.basename(db_name) != db_name or db_name not in catalog.databases():
+            raise RuntimeError(f"Unknown database: {db_name}")
+        return os.path.join(self.database_dir, db_name)
+
+    def snapshots(self, db_name):
+        """Snapshots of a database, newest first."""
+        if not self.enabled:
+            return []
+        directory = os.path.join(self.directory, db_name)
+        try:
+            names = [name for name in os.listdir(directory) if name.endswith(SNAPSHOT_SUFFIX)]
+        except OSError:
+            return []
+        snapshots = []
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Pruned by another process meanwhile
+            snapshots.append(Snapshot(db_name, name[:-len(SNAPSHOT_SUFFIX)], path, stat.st_mtime, stat.st_size))
+        snapshots.sort(key=lambda snapshot: snapshot.name, reverse=True)
+        return snapshots
+
+    def _copy(self, source, target, progress):
+        """Run the backup in steps; returns (pages, restarts)."""
+        state = {'remaining': None, 'restarts': 0, 'pages': 0}
+
+        def step(status, remaining, total):
+            if state['remaining'] is not None and remaining > state['remaining']:
+                state['restarts'] += 1  # Another connection wrote to the source, SQLite started over
+                if state['restarts'] > MAX_RESTARTS:
+                    raise _Restarted()
+            state['remaining'] = remaining
+            state['pages'] = total
+            if progress is not None:
+                progress(total - remaining, total)
+            if self.step_pause:
+                time.sleep(self.step_pause)
+
+        try:
+            source.backup(target, pages=self.pages_per_step, progress=step)
+        except _Restarted:
+            source.backup(target)
+        return state['pages'] or source.execute("PRAGMA page_count").fetchone()[0], state['restarts']
+
+    def snapshot(self, db_name, label=None, progress=None):
+        """
+        Take a snapshot of a database now.
+
+        :param label: Appended to the snapshot name, e.g. "pre-restore".
+        :param progress: Optional callable(pages_done, pages_total) called after every step.
+        :return: A BackupResult.
+        """
+        if not self.enabled:
+            raise RuntimeError("Backups are not enabled (set BACKUP_DIR).")
+        path = self._database_path(db_name)
+        directory = os.path.join(self.directory, db_name)
+        os.makedirs(directory, exist_ok=True)
+        name = time.strftime("%Y%m%d-%H%M%S") + (f"-{label}" if label else "")
+        if os.path.exists(os.path.join(directory, name + SNAPSHOT_SUFFIX)):
+            name += f"-{os.getpid()}-{time.monotonic_ns() % 1000000}"
+        copy_path = os.path.join(directory, f".{name}.db.tmp")
+        compressed_path = copy_path + ".gz"
+        started = time.perf_counter()
+        try:
+            source = sqlite3.connect(f"file:{pathname2url(os.path.abspath(path))}?mode=ro", uri=True)
+            target = sqlite3.connect(copy_path)
+            try:
+                pages, restarts = self._copy(source, target, progress)
+                page_size = source.execute("PRAGMA page_size").fetchone()[0]
+            finally:
+                target.close()
+                source.close()
+            with open(copy_path, 'rb') as copy, gzip.open(compressed_path, 'wb', compresslevel=6) as compressed:
+                shutil.copyfileobj(copy, compressed, 1024 * 1024)
+            final_path = os.path.join(directory, name + SNAPSHOT_SUFFIX)
+            os.replace(compressed_path, final_path)
+        except (sqlite3.Error, OSError) as e:
+            self.stats['failures'] += 1
+            raise RuntimeError(f"Snapshot of {db_name} failed: {e}") from e
+        finally:
+            for temporary in (copy_path, compressed_path):
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+        seconds = time.perf_counter() - started
+        result = BackupResult(Snapshot(db_name, name, final_path, time.time(), os.path.getsize(final_path)),
+                              pages, pages * page_size, seconds, restarts)
+        self._record('snapshot', result)
+        self.prune(db_name)
+        return result
+
+    def restore(self, db_name, snapshot_name, progress=None):
+        """
+        Replace the contents of a live database with a snapshot.
+
+        :return: (BackupResult of the restore, BackupResult of the "pre-restore" snapshot of the previous state)
+        """
+        path = self._database_path(db_name)
+        snapshot = next((snapshot for snapshot in self.snapshots(db_name) if snapshot.name == snapshot_name), None)
+        if snapshot is None:
+            raise RuntimeError(f"No snapshot {snapshot_name} of {db_name}.")
+        copy_path = os.path.join(self.directory, db_name, f".restore-{os.getpid()}.db.tmp")
+        started = time.perf_counter()
+        try:
+            # Read the snapshot before the pre-restore snapshot prunes it away when it is the oldest one kept
+            with gzip.open(snapshot.path, 'rb') as compressed, open(copy_path, 'wb') as copy:
+                shutil.copyfileobj(compressed, copy, 1024 * 1024)
+            saved = self.snapshot(db_name, label="pre-restore")
+            source = sqlite3.connect(copy_path)
+            target = sqlite3.connect(path, timeout=30)
+            try:
+                pages, restarts = self._copy(source, target, progress)
+                page_size = source.execute("PRAGMA page_size").fetchone()[0]
+            finally:
+                target.close()
+                source.close()
+        except (sqlite3.Error, OSError) as e:
+            self.stats['failures'] += 1
+            raise RuntimeError(f"Restore of {db_name} failed: {e}") from e
+        finally:
+            if os.path.exists(copy_path):
+                os.remove(copy_path)
+        result = BackupResult(snapshot, pages, pages * page_size, time.perf_counter() - started, restarts)
+        self._record('restore', result)
+        result_cache.invalidate(path)
+        return result, saved
+
+    def _record(self, operation, result):
+        BACKUP_SECONDS.observe(result.seconds, operation)
+        BACKUP_BYTES.inc(operation, amount=result.bytes)
+        with self._lock:
+            self.stats['snapshots' if operation == 'snapshot' else 'restores'] += 1
+            self.stats['bytes_copied'] += result.bytes
+            self.stats['restarts'] += result.restarts
+            self.stats['last_throughput_mb_s'] = result.throughput
+
+    def prune(self, db_name):
+        """Remove all but the newest `keep` snapshots of a database."""
+        for snapshot in self.snapshots(db_name)[self.keep:]:
+            try:
+                os.remove(snapshot.path)
+            except OSError:
+                pass  # Removed by another process
+
+    def due(self, db_name):
+        """True if a scheduled snapshot is due: the newest one is older than the interval and than the database."""
+        snapshots = self.snapshots(db_name)
+        if not snapshots:
+            return True
+        newest = max(snapshot.created_at for snapshot in snapshots)
+        if time.time() - newest < self.interval:
+            return False
+        path = os.path.join(self.database_dir, db_name)
+        modified = max((os.path.getmtime(name) for name in (path, path + "-wal") if os.path.exists(name)), default=0)
+        return modified > newest
+
+    def run_schedule(self):
+        """Snapshot every database that is due; the lock file keeps other processes from doing the same."""
+        for db_name in catalog.databases():
+            if self._stop.is_set():
+                return
+            if not self.due(db_name):
+                continue
+            lock_path = os.path.join(self.directory, db_name, ".lock")
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            try:
+                if time.time() - os.path.getmtime(lock_path) > LOCK_TIMEOUT:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            try:
+                if self.due(db_name):
+                    result = self.snapshot(db_name)
+                    print(f"[backup] {db_name}: {result.describe()}", flush=True)
+            except RuntimeError as e:
+                print(f"[backup] {e}", flush=True)
+            finally:
+                os.remove(lock_path)
+
+    def _run(self):
+        while not self._stop.wait(min(self.interval, 60)):
+            self.run_schedule()
+
+    def start(self):
+        """Take scheduled snapshots on a background thread (every process may do this, see run_schedule)."""
+        if not self.enabled or not self.interval or self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='backup-scheduler', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stop.set()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['directory'] = self.directory
+        stats['interval'] = self.interval
+        return stats
+
+
+# Shared by the bot and the Streamlit sessions of this process; configured from the BACKUP_* settings
+backup_manager = BackupManager()
+metrics.register_stats('backup', backup_manager.get_stats, "Database snapshots")
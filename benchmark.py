@@ -0,0 +1,266 @@
+"""
+Benchmarks for the SQLite query and export paths.
+
+    python benchmark.py run --scales 10000,100000 --output results.json
+    python benchmark.py compare base.json results.json
+
+`run` generates synthetic databases (SQLite_databases/bench_<rows>.db, reused when present) and measures
+latency, throughput and peak RSS of table listing, SELECT into a DataFrame, paginated fetches and CSV
+exports. Each measurement runs in a fresh child process so peak RSS belongs to that operation alone.
+`compare` prints the change of every measurement and exits non-zero when one regressed past the threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from multiprocessing import get_context
+
+DATABASE_DIR = "SQLite_databases"
+DEFAULT_SCALES = [10_000, 100_000, 1_000_000, 10_000_000]
+CATEGORIES = ["books", "games", "music", "movies", "garden", "tools", "toys", "food"]
+INSERT_BATCH = 50_000
+
+
+def database_path(rows):
+    return os.path.join(DATABASE_DIR, f"bench_{rows}.db")
+
+
+def generate_database(rows, seed=42):
+    """Create a database with an `items` table of the given size (deterministic for a given seed)."""
+    path = database_path(rows)
+    if os.path.exists(path):
+        with sqlite3.connect(path) as connection:
+            try:
+                if connection.execute("SELECT COUNT(*) FROM items").fetchone()[0] == rows:
+                    return path
+            except sqlite3.OperationalError:
+                pass
+        os.remove(path)
+
+    rng = random.Random(seed)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT, category TEXT, price REAL, "
+                       "quantity INTEGER, created_at TEXT)")
+    for start in range(0, rows, INSERT_BATCH):
+        batch = [(i, f"item-{i}-{rng.randrange(10 ** 6):06d}", rng.choice(CATEGORIES), round(rng.uniform(1, 500), 2),
+                  rng.randrange(1000), f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}")
+                 for i in range(start, min(start + INSERT_BATCH, rows))]
+        connection.executemany("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)", batch)
+    connection.commit()
+    connection.close()
+    return path
+
+
+def _viewer(path):
+    from sqlite_handler import SQLViewer, ConnectionPool, ResultCache
+    # A private pool and a cache that stores nothing, so repeated runs measure the real work
+    return SQLViewer(path, pool=ConnectionPool(), cache=ResultCache(max_bytes=0))
+
+
+def op_listing(path, page_size):
+    sv = _viewer(path)
+    tables = sv.simple_view("SELECT name FROM sqlite_master WHERE type='table';")
+    columns = sv.simple_view("PRAGMA table_info(items);")
+    return len(tables) + len(columns), 0
+
+
+def op_select_df(path, page_size):
+    df = _viewer(path).view_query_as_df("SELECT * FROM items;")
+    return len(df), int(df.memory_usage(deep=True).sum())
+
+
+def op_page_first(path, page_size):
+    df = _viewer(path).view_page_as_df("items", ["id", "name", "category", "price"], 0, page_size)
+    return len(df), 0
+
+
+def op_page_last(path, page_size):
+    sv = _viewer(path)
+    with sv.pool.connection(path) as connection:
+        rows = connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+    df = sv.view_page_as_df("items", ["id", "name", "category", "price"], max(0, (rows - 1) // page_size), page_size)
+    return len(df), 0
+
+
+def op_export_csv(path, page_size):
+    output = _viewer(path).export_query_to_csv("SELECT * FROM items;")
+    size = len(output.getbuffer())
+    return None, size
+
+
+def op_stream_csv(path, page_size):
+    size = 0
+    for _, part in _viewer(path).stream_query_to_csv("SELECT * FROM items;", max_part_size=None):
+        with part:
+            part.seek(0, os.SEEK_END)
+            size += part.tell()
+    return None, size
+
+
+def op_stream_csv_gzip(path, page_size):
+    size = 0
+    for _, part in _viewer(path).stream_query_to_csv("SELECT * FROM items;", compress=True, max_part_size=None):
+        with part:
+            part.seek(0, os.SEEK_END)
+            size += part.tell()
+    return None, size
+
+
+def op_stream_parquet(path, page_size):
+    size = 0
+    for _, part in _viewer(path).stream_query_export("SELECT * FROM items;", "parquet", max_part_size=None):
+        with part:
+            part.seek(0, os.SEEK_END)
+            size += part.tell()
+    return None, size
+
+
+def op_select_arrow(path, page_size):
+    table = _viewer(path).view_query_as_arrow("SELECT * FROM items;")
+    return table.num_rows, table.nbytes
+
+
+OPERATIONS = {
+    "listing": op_listing,
+    "select_df": op_select_df,
+    "select_arrow": op_select_arrow,
+    "page_first": op_page_first,
+    "page_last": op_page_last,
+    "export_csv": op_export_csv,
+    "stream_csv": op_stream_csv,
+    "stream_csv_gzip": op_stream_csv_gzip,
+    "stream_parquet": op_stream_parquet,
+}
+
+
+def _measure(operation, path, page_size):
+    """Runs in a child process: returns (seconds, rows, bytes_produced, peak_rss_bytes, start_rss_bytes)."""
+    # Imported up front so module load time is not part of the measurement; sqlite_handler only loads
+    # pandas and pyarrow on first use, so they are imported explicitly
+    import pandas
+    import pyarrow
+    import pyarrow.parquet
+    import sqlite_handler
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    rows, produced = OPERATIONS[operation](path, page_size)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, KiB on Linux
+    return elapsed, rows, produced, peak * scale, rss_before * scale
+
+
+def run_benchmarks(scales, operations, repeat, page_size):
+    context = get_context("spawn")  # Fresh interpreter per measurement, so peak RSS is not inherited
+    results = []
+    for rows in scales:
+        started = time.perf_counter()
+        # Generated in a child as well: children inherit the parent's peak RSS through fork and exec
+        with context.Pool(1) as pool:
+            path = pool.apply(generate_database, (rows,))
+        print(f"{rows:>10} rows: database ready in {time.perf_counter() - started:.1f}s", flush=True)
+        for operation in operations:
+            samples = []
+            for _ in range(repeat):
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    samples.append(pool.apply(_measure, (operation, path, page_size)))
+            latencies = [sample[0] for sample in samples]
+            result_rows = samples[0][1] if samples[0][1] is not None else rows
+            median = statistics.median(latencies)
+            result = {
+                "operation": operation,
+                "rows": rows,
+                "result_rows": result_rows,
+                "latency_min_s": min(latencies),
+                "latency_median_s": median,
+                "throughput_rows_per_s": result_rows / median if median else None,
+                "bytes_produced": samples[0][2],
+                "peak_rss_bytes": max(sample[3] for sample in samples),
+                "baseline_rss_bytes": min(sample[4] for sample in samples),
+            }
+            results.append(result)
+            print(f"{rows:>10} {operation:<16} {median * 1000:>10.1f} ms  "
+                  f"{result['peak_rss_bytes'] / 2 ** 20:>8.1f} MB peak RSS", flush=True)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(base_file, new_file, threshold):
+    """Print relative changes between two result files; returns the number of regressions."""
+    with open(base_file) as file:
+        base = {(r["operation"], r["rows"]): r for r in json.load(file)["results"]}
+    with open(new_file) as file:
+        new = json.load(file)["results"]
+    regressions = 0
+    print(f"{'rows':>10} {'operation':<16} {'latency':>10} {'peak RSS':>10}")
+    for result in new:
+        old = base.get((result["operation"], result["rows"]))
+        if old is None:
+            continue
+        latency = result["latency_median_s"] / old["latency_median_s"] - 1 if old["latency_median_s"] else 0
+        rss = result["peak_rss_bytes"] / old["peak_rss_bytes"] - 1 if old["peak_rss_bytes"] else 0
+        regressed = latency * 100 > threshold or rss * 100 > threshold
+        regressions += regressed
+        print(f"{result['rows']:>10} {result['operation']:<16} {latency:>+10.1%} {rss:>+10.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="Generate databases and run the benchmarks")
+    run.add_argument("--scales", default=",".join(str(scale) for scale in DEFAULT_SCALES),
+                     help="Comma-separated row counts")
+    run.add_argument("--operations", default=",".join(OPERATIONS), help="Comma-separated operations")
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--page-size", type=int, default=100)
+    run.add_argument("--output", default="benchmark_results.json")
+    diff = commands.add_parser("compare", help="Compare two result files")
+    diff.add_argument("base")
+    diff.add_argument("new")
+    diff.add_argument("--threshold", type=float, default=10.0, help="Allowed slowdown in percent")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        sys.exit(1 if compare(args.base, args.new, args.threshold) else 0)
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    operations = args.operations.split(",")
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"Unknown operations: {', '.join(sorted(unknown))}")
+    results = run_benchmarks(scales, operations, args.repeat, args.page_size)
+    report = {
+        "commit": _git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "page_size": args.page_size,
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
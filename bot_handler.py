@@ -1,52 +1,101 @@
-import telebot
 import os
-import re
-import pexpect
-from sqlite_handler import SQLViewer
-from bot_keyboard_handler import KeyboardMaster
+import time
+from io import BytesIO
+from catalog import catalog
+from sqlite_handler import SQLViewer, export_rows, split_statements
+from bot_keyboard_handler import KeyboardMaster, HANDLER_SECONDS, HANDLER_ERRORS
+from query_engine import QueryEngine
+from session_store import SessionStore
+from mongo_backend import MongoshBackend
+from query_profiler import query_profiler, format_duration
+from index_advisor import IndexAdvisor
+from bulk_import import import_file, import_format, IMPORT_FORMATS
+from job_queue import job_queue
+from admission import admission
+from backup import backup_manager
+from metrics import metrics, observed
+from telegram_delivery import ChatThrottle, ProgressMessage, format_rows, send_text, MESSAGE_LIMIT
+from lazy_imports import LazyModule
+
+telebot = LazyModule('telebot')
+
+WORK_SECONDS = metrics.histogram('bot_work_seconds', "Blocking bot work run on the query engine", ['function'])
+WORK_WAIT_SECONDS = metrics.histogram('bot_work_wait_seconds', "Time bot work waited behind earlier work of its chat")
 
 
 class BotHandler:
-    def __init__(self, api_token, admin_password, mongosh_allowed_commands):
+    def __init__(self, api_token, admin_password, mongosh_allowed_commands, compress_exports=False, export_format='csv',
+                 worker_threads=4, query_timeout=60, session_idle_timeout=3600, session_store_path=None,
+                 mongo_backend=None):
         self.keyboard = None
         self.bot = telebot.TeleBot(api_token)
         self.admin_password = admin_password
-        self.global_status = None
-        self.mongosh_sessions = {}
+        # User/admin mode and keyboard navigation are kept per chat
+        self.sessions = SessionStore(idle_timeout=session_idle_timeout, persist_path=session_store_path)
+        # Pooled mongosh shells by default, or a DriverBackend running commands through pymongo
+        self.mongo_backend = mongo_backend or MongoshBackend()
+        self.sql_viewers = {}
+        # Database and table names are answered from the shared in-memory catalog
+        self.catalog = catalog
+        # Heavy queries submitted with $$job run in worker processes; results are pushed when they finish
+        self.jobs = job_queue
+        # Reads of users are rate limited, cost checked and run under a row and time budget
+        self.admission = admission
+        # Admins can snapshot a database and restore it with $$backup / $$restore
+        self.backups = backup_manager
         self.setup_keyboard()
         self.mongosh_allowed_commands = mongosh_allowed_commands
+        self.compress_exports = compress_exports
+        self.export_format = export_format
+        # Edits of progress messages are coalesced per chat to stay below Telegram's rate limits
+        self.throttle = ChatThrottle()
+        # Blocking work runs on the engine's worker pool; with no workers it runs inline on the polling thread
+        self.engine = QueryEngine(max_workers=worker_threads, query_timeout=query_timeout) if worker_threads else None
+        if self.engine:
+            metrics.register_stats('query_engine', self.engine.get_stats, "Bot query engine")
+        metrics.register_stats('mongo_backend', self.mongo_backend.get_stats, "MongoDB backend of the bot")
+
+    def get_status(self, message):
+        return self.sessions.get(message.chat.id).status
 
+    def set_status(self, message, status):
+        session = self.sessions.get(message.chat.id)
+        session.status = status
+        self.sessions.save(session)
+
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def user_handler(self, message):
-        self.global_status = 'user'
+        self.set_status(message, 'user')
         self.bot.send_message(message.chat.id, "User mode selected.")
 
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def admin_handler(self, message):
         """Handle admin password input."""
-        self.global_status = 'admin'
+        self.set_status(message, 'admin')
         self.bot.send_message(message.chat.id, "Admin mode selected.")
 
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def list_databases_mongodb(self, message):
         self.bot.send_message(message.chat.id, "Enter mongosh command or type $$back to exit:")
-        if self.global_status == 'admin':
+        if self.get_status(message) == 'admin':
             self.bot.register_next_step_handler(message, lambda m: self.send_mongosh_command(m))
         else:
             self.bot.register_next_step_handler(message, lambda m: self.send_mongosh_command(m, simplified=True))
 
-    def start_mongosh_session(self, chat_id):
-        if chat_id not in self.mongosh_sessions:
-            self.mongosh_sessions[chat_id] = pexpect.spawn('mongosh', encoding='utf-8')
-            self.mongosh_sessions[chat_id].expect('>')  # Wait for the prompt
-
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def send_mongosh_command(self, message, simplified=False):
         """Send mongosh commands and return output."""
         chat_id = message.chat.id
         if message.text == "$$back":
-            self.clean_exit_mongosh(chat_id)
+            self.cancel_running_work(chat_id)
+            self.run_in_worker(message, self.clean_exit_mongosh, chat_id)
             self.go_back_to_user_or_admin(message)
             return
 
-        self.start_mongosh_session(chat_id)
-        session = self.mongosh_sessions[chat_id]
+        if message.text == "$$cancel":
+            self.cancel_running_work(chat_id, notify=True)
+            self.request_next_mongosh_command(message, simplified)
+            return
 
         # Handle simplified user commands
         if simplified and not self.is_command_allowed_for_user(message.text):
@@ -54,32 +103,23 @@ class BotHandler:
             self.request_next_mongosh_command(message, simplified)
             return
 
-        session.sendline(message.text)
-        session.expect('>')  # Wait for the prompt
+        # Accept the next command (or $$cancel) while this one is still running
+        self.bot.register_next_step_handler(message, lambda m: self.send_mongosh_command(m, simplified=simplified))
+        self.run_in_worker(message, self.run_mongosh_command, message, simplified,
+                           cancel=lambda: self.interrupt_mongosh(chat_id))
 
-        output = self.clean_output(session.before)
-
-        # Split the output into chunks if it exceeds Telegram's message limit
-        max_message_length = 4096
-        for i in range(0, len(output), max_message_length):
-            self.bot.send_message(chat_id, output[i:i + max_message_length])
+    def run_mongosh_command(self, message, simplified=False):
+        chat_id = message.chat.id
+        output = self.mongo_backend.run(chat_id, message.text, read_only=simplified)
+        # Long output arrives as one preview message and one compressed file instead of a burst of messages
+        send_text(self.bot, chat_id, output, file_name="mongosh_output.txt")
+        self.bot.send_message(chat_id, "Enter another mongosh command or type $$back to exit:")
 
-        self.request_next_mongosh_command(message, simplified)
+    def interrupt_mongosh(self, chat_id):
+        self.mongo_backend.interrupt(chat_id)
 
     def clean_exit_mongosh(self, chat_id):
-        if chat_id in self.mongosh_sessions:
-            session = self.mongosh_sessions[chat_id]
-            session.sendline('exit')
-            session.close()
-            del self.mongosh_sessions[chat_id]
-
-    def clean_output(self, output):
-        """Remove escape characters and format output."""
-        cleaned_output = re.sub(r'\x1B[@-_][0-?]*[ -/]*[@-~]', '', output)
-        cleaned_output_lines = cleaned_output.splitlines()
-        if cleaned_output_lines:
-            cleaned_output_lines[-1] += ' >'
-        return '\n'.join(cleaned_output_lines)
+        self.mongo_backend.release(chat_id)
 
     def is_command_allowed_for_user(self, command):
         allowed_commands = self.mongosh_allowed_commands
@@ -91,65 +131,395 @@ class BotHandler:
         next_step = lambda m: self.send_mongosh_command(m, simplified=simplified)
         self.bot.register_next_step_handler(message, next_step)
 
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def list_databases_sqlite(self, message):
-        dbs_list = os.listdir("SQLite_databases")
+        dbs_list = self.catalog.databases()
         dbs_list_str = '\n'.join(dbs_list)
         self.bot.send_message(message.chat.id, f"Available databases:\n{dbs_list_str}")
-        self.bot.send_message(message.chat.id, "Enter the database name (or type $$back):")
+        self.bot.send_message(message.chat.id,
+                              "Enter the database name, $$find <name> to search tables and columns (or type $$back):")
         self.bot.register_next_step_handler(message, self.process_database_choice)
 
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def process_database_choice(self, message):
-        db_name = message.text
+        db_name = message.text or ''  # None for photos, stickers and documents
         if db_name == "$$back":
             self.go_back_to_user_or_admin(message)
-        elif db_name in os.listdir("SQLite_databases"):
+        elif db_name.startswith("$$find "):
+            self.send_search_results(message, db_name[len("$$find "):])
+            self.bot.register_next_step_handler(message, self.process_database_choice)
+        elif db_name in self.catalog:
             self.handle_db_choice(message, db_name)
         else:
             self.bot.send_message(message.chat.id, "Invalid database name.")
             self.bot.register_next_step_handler(message, self.process_database_choice)
 
+    def get_sql_viewer(self, db_name, message):
+        """Reuse one SQLViewer per database and access mode; users only get read-only connections."""
+        read_only = self.get_status(message) != 'admin'
+        if (db_name, read_only) not in self.sql_viewers:
+            self.sql_viewers[db_name, read_only] = SQLViewer(f"SQLite_databases/{db_name}", read_only=read_only)
+        return self.sql_viewers[db_name, read_only]
+
+    def send_search_results(self, message, text):
+        matches = self.catalog.search(text)
+        lines = [db_name if table is None else f"{db_name}: {table}" if column is None else f"{db_name}: {table}.{column}"
+                 for db_name, table, column in matches]
+        self.bot.send_message(message.chat.id, '\n'.join(lines) if lines else "Nothing found.")
+
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def handle_db_choice(self, message, db_name):
-        sv = SQLViewer(f"SQLite_databases/{db_name}")
-        tables_in_db = sv.simple_view("SELECT name FROM sqlite_master WHERE type='table';")
-        tables_str = '\n'.join([item[0] for item in tables_in_db])
+        tables_str = '\n'.join(self.catalog.tables(db_name))
         self.bot.send_message(message.chat.id, f"{db_name} has tables:\n{tables_str}")
-        self.bot.send_message(message.chat.id, "Enter SQL query (or type $$back):")
+        self.bot.send_message(message.chat.id, "Enter SQL query, $$job <query> to run a long one in the background "
+                                               "(or type $$back):")
+        if self.get_status(message) == 'admin':
+            self.bot.send_message(message.chat.id, f"You can also upload a file ({', '.join(IMPORT_FORMATS)}) to "
+                                                   f"import it (the caption names the target table), or an .sql "
+                                                   f"script to run it in one transaction. $$backup takes a snapshot "
+                                                   f"of the database, $$backups lists them and $$restore <name> "
+                                                   f"restores one.")
         next_step = lambda m: self.process_query(m, db_name)
         self.bot.register_next_step_handler(message, next_step)
 
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def process_query(self, message, db_name):
         query = message.text
-        if query == "$$back":
+        if message.content_type == 'document':
+            self.bot.register_next_step_handler(message, lambda m: self.process_query(m, db_name))
+            file_name = message.document.file_name or ''  # Optional in the Bot API
+            if self.get_status(message) != 'admin':
+                self.bot.send_message(message.chat.id, "Imports are not allowed.")
+            elif file_name.lower().endswith('.sql'):
+                self.run_in_worker(message, self.run_script_document, self.get_sql_viewer(db_name, message), message)
+            elif import_format(file_name) is None:
+                self.bot.send_message(message.chat.id, f"Upload one of: {', '.join(IMPORT_FORMATS)} or an .sql script.")
+            else:
+                self.run_in_worker(message, self.import_document, self.get_sql_viewer(db_name, message), message)
+        elif query is None:
+            self.bot.send_message(message.chat.id, "Send the query as text.")
+            self.bot.register_next_step_handler(message, lambda m: self.process_query(m, db_name))
+        elif query == "$$back":
             self.list_databases_sqlite(message)
+        elif query == "$$cancel":
+            self.cancel_running_work(message.chat.id, notify=True)
+            self.bot.register_next_step_handler(message, lambda m: self.process_query(m, db_name))
+        elif query.startswith(("$$job ", "$$jobs", "$$canceljob ")):
+            self.handle_job_command(message, db_name, query)
+            self.bot.register_next_step_handler(message, lambda m: self.process_query(m, db_name))
+        elif query in ("$$backup", "$$backups") or query.startswith("$$restore "):
+            self.bot.register_next_step_handler(message, lambda m: self.process_query(m, db_name))
+            if self.get_status(message) != 'admin':
+                self.bot.send_message(message.chat.id, "Backups are only available to admins.")
+            else:
+                self.run_in_worker(message, self.handle_backup_command, message.chat.id, db_name, query)
         else:
-            sv = SQLViewer(f"SQLite_databases/{db_name}")
-            self.execute_sql_query(sv, message, query, db_name)
-
-    def execute_sql_query(self, sv, message, query, db_name):
-        query_lower = query.strip().lower()
-        if query_lower.startswith(("insert", "update", "delete", "drop", "create", "alter")):
-            if self.global_status=='admin':
-                # Process modification queries (INSERT, UPDATE, DELETE, DROP, CREATE, ALTER)
+            sv = self.get_sql_viewer(db_name, message)
+            # Accept the next query (or $$cancel) while this one is still running
+            self.bot.register_next_step_handler(message, lambda m: self.process_query(m, db_name))
+            self.run_in_worker(message, self.execute_sql_query, sv, message, query)
+
+    def execute_sql_query(self, sv, message, query):
+        is_admin = self.get_status(message) == 'admin'
+        if len(split_statements(query)) > 1:
+            if is_admin:
+                self.run_script(sv, message.chat.id, query)
+            else:
+                self.bot.send_message(message.chat.id, "Enter one statement at a time.")
+            self.bot.send_message(message.chat.id, "Enter another query, $$cancel to stop a running one, or $$back.")
+            return
+        try:
+            # SQLite itself reports what the statement would do, so no prefix guessing is needed
+            statement = sv.classify(query)
+        except Exception as e:
+            self.bot.send_message(message.chat.id, f"Error: {str(e)}")
+            self.bot.send_message(message.chat.id, "Enter another query, $$cancel to stop a running one, or $$back.")
+            return
+        if not statement.read_only:
+            if is_admin:
+                # Process modification queries (INSERT, UPDATE, DELETE, DROP, CREATE, ALTER, PRAGMA assignments...)
                 try:
-                    sv.executor(message.text)
+                    sv.executor(query)
                     self.bot.send_message(message.chat.id, "Query processed successfully.")
                 except Exception as e:
                     self.bot.send_message(message.chat.id, f"Error processing query: {str(e)}")
             else:
                 self.bot.send_message(message.chat.id, "Modification queries are not allowed.")
         else:
+            self.send_read_result(sv, message.chat.id, query, is_admin=is_admin)
+        self.bot.send_message(message.chat.id, "Enter another query, $$cancel to stop a running one, or $$back.")
+
+    def import_document(self, sv, message):
+        """Download an uploaded file and load it into the table named by the caption, reporting progress."""
+        document = message.document
+        data = self.bot.download_file(self.bot.get_file(document.file_id).file_path)
+        status = self.bot.send_message(message.chat.id, f"Importing {document.file_name}...")
+
+        def progress(rows, total_rows):
+            done = f"{rows:,} of {total_rows:,}" if total_rows else f"{rows:,}"
+            try:
+                self.bot.edit_message_text(f"Importing {document.file_name}: {done} rows", message.chat.id,
+                                           status.message_id)
+            except Exception:
+                pass  # e.g. "message is not modified" or rate limited; the next update will catch up
+
+        try:
+            table, rows, seconds = import_file(sv, BytesIO(data), document.file_name,
+                                               table=(message.caption or '').strip() or None, progress=progress)
+            self.bot.send_message(message.chat.id, f"Imported {rows:,} rows into {table} in {format_duration(seconds)} "
+                                                   f"({rows / max(seconds, 1e-9):,.0f} rows/s).")
+        except Exception as e:
+            self.bot.send_message(message.chat.id, f"Error importing {document.file_name}: {str(e)}")
+        self.bot.send_message(message.chat.id, "Enter another query, $$cancel to stop a running one, or $$back.")
+
+    def run_script_document(self, sv, message):
+        data = self.bot.download_file(self.bot.get_file(message.document.file_id).file_path)
+        self.run_script(sv, message.chat.id, data.decode('utf-8'))
+        self.bot.send_message(message.chat.id, "Enter another query, $$cancel to stop a running one, or $$back.")
+
+    def run_script(self, sv, chat_id, script):
+        """Run an admin script in one transaction and report its outcome, with per-statement timings."""
+        try:
+            results = sv.execute_script(script)
+        except Exception as e:
+            self.bot.send_message(chat_id, f"Error processing script: {str(e)}")
+            return
+        failed = results[-1] if results and results[-1].error else None
+        if failed:
+            self.bot.send_message(chat_id, f"Statement {len(results)} failed, nothing was changed: {failed.error}\n"
+                                           f"{failed.statement[:1000]}")
+        else:
+            seconds = sum(result.seconds for result in results)
+            self.bot.send_message(chat_id, f"Script committed: {len(results)} statements in "
+                                           f"{format_duration(seconds)}.")
+        report = []
+        for number, result in enumerate(results, 1):
+            # rowcount is -1 for statements that neither change nor return rows (CREATE, DROP...)
+            rows = result.rows if result.rows is not None and result.rows >= 0 else ''
+            report.append((number, format_duration(result.seconds), rows, result.error or '', result.statement))
+        if len(results) <= 10:
+            lines = [f"{number}. {duration}" + (f", {rows} rows" if rows != '' else '') +
+                     (f", {error}" if error else '') + f"\n{statement[:200]}"
+                     for number, duration, rows, error, statement in report]
+            self.bot.send_message(chat_id, "\n".join(lines)[:4096])
+            return
+        for file_name, report_file in export_rows(['#', 'Time', 'Rows', 'Error', 'Statement'], [report],
+                                                  file_name="script_report"):
+            with report_file:
+                self.bot.send_document(chat_id, report_file, visible_file_name=file_name)
+
+    def handle_job_command(self, message, db_name, command):
+        """$$job <query> queues a background export, $$jobs lists the chat's jobs, $$canceljob <id> cancels one."""
+        owner = f"chat:{message.chat.id}"
+        if command.startswith("$$job "):
             try:
-                csv_file = sv.export_query_to_csv(query)
-                self.bot.send_document(message.chat.id, csv_file, visible_file_name="query_result.csv")
+                job_id = self.jobs.submit(owner, f"SQLite_databases/{db_name}", command[len("$$job "):],
+                                          self.export_format, self.compress_exports,
+                                          privileged=self.get_status(message) == 'admin')
+                self.bot.send_message(message.chat.id, f"Job {job_id} queued. The result will be sent here when it "
+                                                       f"is ready; $$jobs shows the progress.")
             except Exception as e:
                 self.bot.send_message(message.chat.id, f"Error: {str(e)}")
-        self.bot.send_message(message.chat.id, "Enter another query or type $$back.")
-        self.bot.register_next_step_handler(message, lambda m: self.process_query(m, db_name))
+        elif command.startswith("$$canceljob "):
+            job_id = command[len("$$canceljob "):].strip()
+            cancelled = job_id.isdigit() and self.jobs.cancel(int(job_id), owner)
+            self.bot.send_message(message.chat.id, f"Job {job_id} cancelled." if cancelled else "No such running job.")
+        else:
+            lines = [f"{job.id}. {job.status}, {job.rows:,} rows: {job.query[:100]}" for job in self.jobs.jobs(owner)]
+            self.bot.send_message(message.chat.id, "\n".join(lines) if lines else "No jobs.")
+
+    def handle_backup_command(self, chat_id, db_name, command):
+        """$$backup snapshots the database, $$backups lists its snapshots, $$restore <name> restores one."""
+        try:
+            if command == "$$backup":
+                progress_message = ProgressMessage(self.bot, chat_id, f"Backing up {db_name}…", self.throttle)
+                result = self.backups.snapshot(
+                    db_name, progress=lambda done, total: progress_message.update(
+                        f"Backing up {db_name}… {done:,} of {total:,} pages"))
+                progress_message.finish(f"Snapshot {result.snapshot.name} of {db_name}: {result.describe()}, "
+                                        f"{result.snapshot.size / 1024 / 1024:.1f} MB compressed.")
+            elif command == "$$backups":
+                lines = [f"{snapshot.name}  {snapshot.size / 1024 / 1024:.1f} MB"
+                         for snapshot in self.backups.snapshots(db_name)]
+                self.bot.send_message(chat_id, "\n".join(lines) if lines else "No snapshots.")
+            else:
+                result, saved = self.backups.restore(db_name, command[len("$$restore "):].strip())
+                self.bot.send_message(chat_id, f"{db_name} restored from {result.snapshot.name}: "
+                                               f"{result.describe()}. The previous state was saved as "
+                                               f"{saved.snapshot.name}.")
+        except RuntimeError as e:
+            self.bot.send_message(chat_id, f"Error: {str(e)}")
+
+    def deliver_job(self, job):
+        """Push the outcome of a finished background job to the chat that submitted it."""
+        chat_id = int(job.owner.split(':', 1)[1])
+        if job.status == 'done':
+            self.bot.send_message(chat_id, f"Job {job.id} finished: {job.rows:,} rows.")
+            for path in job.files:
+                with open(path, 'rb') as result_file:
+                    self.bot.send_document(chat_id, result_file, visible_file_name=os.path.basename(path))
+        elif job.status == 'failed':
+            self.bot.send_message(chat_id, f"Job {job.id} failed: {job.error}")
 
+    def send_read_result(self, sv, chat_id, query, is_admin=False):
+        """
+        Send the result of a read statement once admission control lets it run.
+
+        Small results are sent as text. For larger ones the first rows are shown at once in a message that is
+        edited with the row count while the rest is exported, then the export follows as a document (a single
+        one unless it exceeds Telegram's upload limit).
+        """
+        progress_message = None
+        fetched = files_sent = 0
+
+        def progress(rows):
+            nonlocal fetched
+            fetched = rows
+            with self.admission.released():
+                progress_message.update(f"{preview}\n\nFetching the rest… {rows:,} rows so far")
+
+        try:
+            with self.admission.admit(f"chat:{chat_id}", sv, query, privileged=is_admin):
+                for kind, result in sv.execute_read(query, enforce_read_only=not is_admin,
+                                                    export_format=self.export_format, compress=self.compress_exports,
+                                                    progress=progress):
+                    # Sending takes no slot from other queries (nor time from the budget, see QueryBudget)
+                    with self.admission.released():
+                        if kind == 'scalar':
+                            self.bot.send_message(chat_id, f"{result[0]}: {result[1]}")
+                        elif kind == 'rows':
+                            self.send_rows(chat_id, *result)
+                        elif kind == 'preview':
+                            preview = format_rows(*result)[:MESSAGE_LIMIT - 100]
+                            progress_message = ProgressMessage(self.bot, chat_id,
+                                                               f"{preview}\n\nFetching the rest…", self.throttle)
+                        else:
+                            file_name, result_file = result
+                            with result_file:
+                                self.bot.send_document(chat_id, result_file, visible_file_name=file_name)
+                            files_sent += 1
+        except Exception as e:
+            if progress_message is not None:
+                progress_message.finish(f"{preview}\n\nFailed.")
+            self.bot.send_message(chat_id, f"Error: {str(e)}")
+            return
+        if progress_message is not None:
+            files = "the attached file" if files_sent == 1 else f"the {files_sent} attached files"
+            progress_message.finish(f"{preview}\n\n{fetched:,} rows, see {files}.")
+
+    def send_rows(self, chat_id, columns, rows):
+        """Send a small result as a text table, or as an export file when it does not fit in a message."""
+        text = format_rows(columns, rows)
+        if len(text) <= MESSAGE_LIMIT:
+            self.bot.send_message(chat_id, text)
+            return
+        for file_name, result_file in export_rows(columns, [rows], self.export_format, self.compress_exports):
+            with result_file:
+                self.bot.send_document(chat_id, result_file, visible_file_name=file_name)
+
+    def run_in_worker(self, message, func, *args, cancel=None):
+        """Run blocking work on the query engine, queued behind earlier work of the same chat."""
+        submitted = time.perf_counter()
+
+        def work(*work_args):
+            WORK_WAIT_SECONDS.observe(time.perf_counter() - submitted)
+            with WORK_SECONDS.time(func.__name__):
+                return func(*work_args)
+
+        if self.engine is None:
+            work(*args)
+            return
+        chat_id = message.chat.id
+        timeout_message = (f"The request took longer than {self.engine.query_timeout}s and was cancelled. "
+                           f"Use $$job <query> to run a long query in the background.")
+        future = self.engine.submit(chat_id, work, *args, cancel=cancel,
+                                    on_timeout=lambda: self.bot.send_message(chat_id, timeout_message))
+        future.add_done_callback(lambda f: self.report_worker_error(chat_id, f))
+
+    def report_worker_error(self, chat_id, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None and not isinstance(error, TimeoutError):
+            self.bot.send_message(chat_id, f"Error: {str(error)}")
+
+    def cancel_running_work(self, chat_id, notify=False):
+        cancelled = self.engine.cancel(chat_id) if self.engine else False
+        if notify:
+            self.bot.send_message(chat_id, "Cancelled." if cancelled else "Nothing is running.")
+
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
+    def send_slowest_queries(self, message):
+        """Send the latency percentiles and the slowest logged statements (admin keyboard only)."""
+        if self.get_status(message) != 'admin':
+            return
+        lines = [f"{operation}: {stats['calls']} calls, p50 {format_duration(stats['p50'])}, "
+                 f"p95 {format_duration(stats['p95'])}, p99 {format_duration(stats['p99'])}"
+                 for operation, stats in query_profiler.percentiles().items()]
+        self.bot.send_message(message.chat.id, "\n".join(lines) if lines else "No queries recorded yet.")
+        for record in query_profiler.slowest(5):
+            size = f"{record['rows']} rows" if record['rows'] is not None else f"{record['bytes']} bytes"
+            text = (f"{format_duration(record['duration'])} on {record['database']} ({record['operation']}, {size})\n"
+                    f"{record['query']}")
+            if record['plan']:
+                text += f"\n\nPlan:\n{record['plan']}"
+            self.bot.send_message(message.chat.id, text[:4096])
+
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
+    def request_advisor_database(self, message):
+        if self.get_status(message) != 'admin':
+            return
+        self.bot.send_message(message.chat.id, "Enter the database to advise indexes for (or type $$back):")
+        self.bot.register_next_step_handler(message, self.process_advisor_database)
+
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
+    def process_advisor_database(self, message):
+        db_name = message.text
+        if db_name == "$$back":
+            self.go_back_to_user_or_admin(message)
+        elif db_name in self.catalog:
+            self.bot.send_message(message.chat.id, "Replaying the observed queries on a copy of the database...")
+            self.run_in_worker(message, self.advise_indexes, message, db_name)
+        else:
+            self.bot.send_message(message.chat.id, "Invalid database name.")
+            self.bot.register_next_step_handler(message, self.process_advisor_database)
+
+    def advise_indexes(self, message, db_name):
+        suggestions = IndexAdvisor(f"SQLite_databases/{db_name}").suggest()
+        if not suggestions:
+            self.bot.send_message(message.chat.id, "No index would speed up the queries observed so far.")
+            self.go_back_to_user_or_admin(message)
+            return
+        for number, suggestion in enumerate(suggestions, 1):
+            self.bot.send_message(message.chat.id,
+                                  f"{number}. {suggestion.statement}\n{suggestion.calls} calls, replay "
+                                  f"{format_duration(suggestion.baseline)} -> {format_duration(suggestion.indexed)}, "
+                                  f"about {format_duration(suggestion.benefit)} saved so far")
+        self.bot.send_message(message.chat.id, "Enter a number to create that index (or type $$back):")
+        next_step = lambda m: self.apply_index_suggestion(m, db_name, suggestions)
+        self.bot.register_next_step_handler(message, next_step)
+
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
+    def apply_index_suggestion(self, message, db_name, suggestions):
+        text = message.text or ''
+        if text == "$$back" or not text.isdigit() or not 1 <= int(text) <= len(suggestions):
+            self.go_back_to_user_or_admin(message)
+            return
+        statement = suggestions[int(text) - 1].statement
+        try:
+            self.get_sql_viewer(db_name, message).executor(statement)
+            self.bot.send_message(message.chat.id, "Index created.")
+        except Exception as e:
+            self.bot.send_message(message.chat.id, f"Error processing query: {str(e)}")
+        self.bot.send_message(message.chat.id, "Enter another number (or type $$back):")
+        self.bot.register_next_step_handler(message, lambda m: self.apply_index_suggestion(m, db_name, suggestions))
+
+    @observed(HANDLER_SECONDS, HANDLER_ERRORS)
     def go_back_to_user_or_admin(self, message):
-        if self.global_status == 'user':
+        status = self.get_status(message)
+        if status == 'user':
             self.user_handler(message)
-        elif self.global_status == 'admin':
+        elif status == 'admin':
             self.admin_handler(message)
 
     def setup_keyboard(self):
@@ -160,7 +530,9 @@ class BotHandler:
             ], False, None),
             ("Continue as Admin", self.admin_handler, [
                 ("Choose SQLite Database", self.list_databases_sqlite, None, False, None),
-                ("Enter mongosh Command Line", self.list_databases_mongodb, None, False, None)
+                ("Enter mongosh Command Line", self.list_databases_mongodb, None, False, None),
+                ("Slowest Queries", self.send_slowest_queries, None, False, None),
+                ("Index Advisor", self.request_advisor_database, None, False, None)
             ], True, self.admin_password)
         ]
 
@@ -168,8 +540,18 @@ class BotHandler:
             bot=self.bot,
             command='start',
             initial_buttons=initial_buttons,
+            sessions=self.sessions,
         )
         keyboard.setup_button_handler()
 
     def run(self):
-        self.bot.polling()
+        if self.engine:
+            self.engine.start()
+        self.jobs.start(deliver=self.deliver_job, owner_prefix="chat:")
+        try:
+            self.bot.polling()
+        finally:
+            if self.engine:
+                self.engine.shutdown()
+            self.jobs.shutdown()
+            self.mongo_backend.close_all()
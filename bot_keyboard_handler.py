@@ -1,8 +1,15 @@
-from telebot import types
+from lazy_imports import LazyModule
+from session_store import SessionStore
+from metrics import metrics
+
+types = LazyModule('telebot.types')
+
+HANDLER_SECONDS = metrics.histogram('bot_handler_seconds', "Time spent in bot message handlers", ['handler'])
+HANDLER_ERRORS = metrics.counter('bot_handler_errors_total', "Bot message handlers that raised", ['handler'])
 
 
 class KeyboardMaster:
-    def __init__(self, bot, command, initial_buttons):
+    def __init__(self, bot, command, initial_buttons, sessions=None):
         """
         Initialize the KeyboardMaster class.
 
@@ -10,48 +17,62 @@ class KeyboardMaster:
         :param command: The command on which the initial keyboard will appear.
         :param initial_buttons: A list of tuples where each tuple contains (button_text, button_action, next_buttons,
                                 requires_input, expected_input).
+        :param sessions: The SessionStore holding the navigation state of each chat.
         """
         self.bot = bot
         self.command = command
         self.initial_buttons = initial_buttons
-        self.navigation_stack = []
-        self.current_buttons = initial_buttons
-        self.waiting_for_input = False  # Flag to indicate if we are waiting for user input
-        self.expected_input = None  # Expected input after a button click
-        self.next_buttons_after_input = None  # Buttons to display if the input is correct
-        self.pending_action_after_input = None  # Action to execute after correct input
+        self.sessions = sessions if sessions is not None else SessionStore()
         self.setup_command_handler()
 
     def setup_command_handler(self):
         """Set up the command handler for the bot."""
         @self.bot.message_handler(commands=[self.command])
         def command_handler(message):
-            self.navigation_stack = []  # Reset navigation stack on start
-            self.display_keyboard(message.chat.id, self.initial_buttons)
+            with HANDLER_SECONDS.time('command_handler'):
+                session = self.sessions.get(message.chat.id)
+                session.navigation = []  # Reset navigation on start
+                session.pending_button = None
+                self.sessions.save(session)
+                self.display_keyboard(message.chat.id, self.initial_buttons)
+
+    def current_buttons(self, session):
+        """Walk the button tree along the session's navigation path and return the buttons shown there."""
+        buttons = self.initial_buttons
+        for index, label in enumerate(session.navigation):
+            next_buttons = next((button[2] for button in buttons if button[0] == label), None)
+            if not next_buttons:
+                # The keyboard changed since the path was stored, start over from this level
+                session.navigation = session.navigation[:index]
+                break
+            buttons = next_buttons
+        return buttons
 
     def display_keyboard(self, chat_id, buttons):
         """Display a keyboard with the given buttons."""
         markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=len(buttons))
         for button_text, _, _, _, _ in buttons:
             markup.add(types.KeyboardButton(button_text))
-        if self.navigation_stack:
+        if self.sessions.get(chat_id).navigation:
             markup.add(types.KeyboardButton("$$back"))
         self.bot.send_message(chat_id, "Choose an option:", reply_markup=markup)
-        self.current_buttons = buttons
 
-    def handle_input(self, message):
+    def handle_input(self, message, session):
         """Handle user input and check if it matches the expected input."""
-        if message.text == '$$back':
-            self.waiting_for_input = False  # Reset input waiting state
+        buttons = self.current_buttons(session)
+        button = next((button for button in buttons if button[0] == session.pending_button), None)
 
-        elif message.text == self.expected_input:
+        if message.text == '$$back' or button is None:
+            session.pending_button = None  # Reset input waiting state
+
+        elif message.text == button[4]:
             # If the input is correct, proceed to the next buttons
-            # self.bot.send_message(message.chat.id, "Input correct!")
-            if self.pending_action_after_input:
-                self.pending_action_after_input(message)  # Execute the action (e.g., admin_handler)
-            self.navigation_stack.append(self.current_buttons)  # Save current buttons to stack
-            self.display_keyboard(message.chat.id, self.next_buttons_after_input)
-            self.waiting_for_input = False  # Reset input waiting state
+            button_text, button_action, next_buttons, _, _ = button
+            if button_action:
+                button_action(message)  # Execute the action (e.g., admin_handler)
+            session.navigation.append(button_text)  # Remember where we came from
+            session.pending_button = None  # Reset input waiting state
+            self.display_keyboard(message.chat.id, next_buttons)
         else:
             # If the input is incorrect, prompt again
             self.bot.send_message(message.chat.id, "Incorrect password, please try again. (or $$back to go back)")
@@ -60,31 +81,39 @@ class KeyboardMaster:
         """Set up the button handler for dynamic buttons."""
         @self.bot.message_handler(func=lambda message: True)
         def button_handler(message):
-            if self.waiting_for_input:
-                # If we are waiting for input, handle it
-                self.handle_input(message)
-                return
+            with HANDLER_SECONDS.time('button_handler'):
+                session = self.sessions.get(message.chat.id)
+                try:
+                    self.handle_button(message, session)
+                except Exception:
+                    HANDLER_ERRORS.inc('button_handler')
+                    raise
+                finally:
+                    self.sessions.save(session)
+
+    def handle_button(self, message, session):
+        if session.pending_button:
+            # If we are waiting for input, handle it
+            self.handle_input(message, session)
+            return
 
-            if message.text == "$$back" and self.navigation_stack:
-                # Navigate back to the previous level
-                self.current_buttons = self.navigation_stack.pop()
-                self.display_keyboard(message.chat.id, self.current_buttons)
-            else:
-                for button_text, button_action, next_buttons, requires_input, expected_input in self.current_buttons:
-                    if message.text == button_text:
-                        if requires_input:
-                            # If input is required, ask for input and store the expected value and action
-                            self.bot.send_message(message.chat.id, "Please, enter your password:")
-                            self.waiting_for_input = True
-                            self.expected_input = expected_input
-                            self.next_buttons_after_input = next_buttons
-                            self.pending_action_after_input = button_action  # Save the action to execute after correct input
-                        else:
-                            if button_action:
-                                button_action(message)  # Execute the action (e.g., user_handler)
-                            if next_buttons:
-                                # Push the current buttons to the stack before navigating deeper
-                                self.navigation_stack.append(self.current_buttons)
-                                self.display_keyboard(message.chat.id, next_buttons)
-                        return  # Exit after handling the correct button
+        if message.text == "$$back" and session.navigation:
+            # Navigate back to the previous level
+            session.navigation.pop()
+            self.display_keyboard(message.chat.id, self.current_buttons(session))
+            return
 
+        for button_text, button_action, next_buttons, requires_input, expected_input in self.current_buttons(session):
+            if message.text == button_text:
+                if requires_input:
+                    # If input is required, ask for it and remember which button is waiting
+                    self.bot.send_message(message.chat.id, "Please, enter your password:")
+                    session.pending_button = button_text
+                else:
+                    if button_action:
+                        button_action(message)  # Execute the action (e.g., user_handler)
+                    if next_buttons:
+                        # Record the step before navigating deeper
+                        session.navigation.append(button_text)
+                        self.display_keyboard(message.chat.id, next_buttons)
+                return  # Exit after handling the correct button
@@ -0,0 +1,150 @@
+import gzip
+import os
+import re
+import time
+from lazy_imports import LazyModule
+from sqlite_handler import quote_identifier
+
+pa = LazyModule('pyarrow')
+pa_csv = LazyModule('pyarrow.csv')
+pq = LazyModule('pyarrow.parquet')
+
+IMPORT_BATCH_SIZE = 50000
+IMPORT_FORMATS = ('csv', 'parquet', 'arrow', 'feather')
+CSV_BLOCK_SIZE = 4 * 1024 * 1024  # Column types are inferred from the first block of a CSV file
+# Applied for the duration of an import; the whole file is loaded in one transaction, so a crash
+# cannot leave a half-imported table behind. synchronous=NORMAL skips most fsyncs in WAL mode but,
+# unlike OFF, cannot corrupt the database on power loss (the import may be lost, the database is not)
+IMPORT_PRAGMAS = (('synchronous', 'NORMAL'), ('temp_store', 'MEMORY'), ('cache_size', '-262144'))
+
+
+def import_format(file_name):
+    """Format of an uploaded file from its name (a .gz suffix is allowed for CSV), or None if unsupported."""
+    name = file_name.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+        return 'csv' if name.endswith('.csv') else None
+    extension = os.path.splitext(name)[1].lstrip('.')
+    return extension if extension in IMPORT_FORMATS else None
+
+
+def table_name_for(file_name):
+    """Default table name for a file: its name without extensions, reduced to word characters."""
+    stem = os.path.basename(file_name).split('.')[0]
+    return re.sub(r'\W+', '_', stem).strip('_') or 'imported'
+
+
+def read_batches(file, file_name, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Open an uploaded file and return (schema, total_rows or None, iterator of RecordBatches).
+
+    Batches are read one at a time, so the file is never loaded completely. CSV files are parsed by pyarrow's
+    streaming reader, which infers the column types from the first block.
+    """
+    export_format = import_format(file_name)
+    if export_format == 'csv':
+        if file_name.lower().endswith('.gz'):
+            file = gzip.GzipFile(fileobj=file, mode='rb')
+        reader = pa_csv.open_csv(file, read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                                 convert_options=pa_csv.ConvertOptions(strings_can_be_null=True))
+        return reader.schema, None, iter(reader)
+    if export_format == 'parquet':
+        parquet = pq.ParquetFile(file)
+        return parquet.schema_arrow, parquet.metadata.num_rows, parquet.iter_batches(batch_size=batch_size)
+    if export_format in ('arrow', 'feather'):
+        reader = pa.ipc.open_file(file)
+        # count_rows() only reads the batch headers; older pyarrow versions report no total, like CSV
+        total_rows = reader.count_rows() if hasattr(reader, 'count_rows') else None
+        return reader.schema, total_rows, (reader.get_batch(index) for index in range(reader.num_record_batches))
+    raise ValueError(f"Unsupported file {file_name}, upload one of: {', '.join(IMPORT_FORMATS)} (CSV may be gzipped)")
+
+
+def sqlite_type(arrow_type):
+    if pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type):
+        return 'INTEGER'
+    if pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return 'REAL'
+    if pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type):
+        return 'BLOB'
+    return 'TEXT'
+
+
+def _storable(column):
+    """Cast an Arrow column to a type whose Python values sqlite3 can bind (dates and times become ISO text)."""
+    if pa.types.is_decimal(column.type):
+        return column.cast(pa.float64())
+    if pa.types.is_temporal(column.type):
+        return column.cast(pa.string())
+    if pa.types.is_nested(column.type) or pa.types.is_dictionary(column.type):
+        return pa.array([None if value is None else str(value) for value in column.to_pylist()], type=pa.string())
+    return column
+
+
+def _rows(batch):
+    return list(zip(*(_storable(column).to_pylist() for column in batch.columns)))
+
+
+def import_file(viewer, file, file_name, table=None, if_exists='append', batch_size=IMPORT_BATCH_SIZE,
+                progress=None, progress_interval=1.0):
+    """
+    Load a CSV (optionally gzipped), Parquet, Arrow IPC or Feather file into a table of the viewer's database.
+
+    Batches of batch_size rows are written with executemany inside a single transaction, with the
+    IMPORT_PRAGMAS in effect, so a failed import leaves the database unchanged. The table is created from
+    the file's schema when it does not exist.
+
+    :param viewer: SQLViewer of the target database (read-write).
+    :param file: Binary file object with the uploaded data.
+    :param file_name: Uploaded file name, used to detect the format and as the default table name.
+    :param table: Target table; defaults to table_name_for(file_name).
+    :param if_exists: 'append' to add rows to an existing table, 'replace' to drop it first or 'fail'.
+    :param progress: Optional callable(rows_imported, total_rows or None) called every progress_interval seconds.
+    :return: (table, rows_imported, seconds)
+    """
+    if if_exists not in ('append', 'replace', 'fail'):
+        raise ValueError("if_exists must be 'append', 'replace' or 'fail'")
+    table = table or table_name_for(file_name)
+    started = time.monotonic()
+    try:
+        schema, total_rows, batches = read_batches(file, file_name, batch_size)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, OSError) as e:
+        raise RuntimeError(f"Could not read {file_name}: {e}")
+    columns = ', '.join(quote_identifier(name) for name in schema.names)
+    placeholders = ', '.join('?' * len(schema.names))
+    rows_imported = 0
+    last_report = started
+    with viewer.connection() as connection:
+        previous = [(name, connection.execute(f"PRAGMA {name}").fetchone()[0]) for name, _ in IMPORT_PRAGMAS]
+        for name, value in IMPORT_PRAGMAS:
+            connection.execute(f"PRAGMA {name}={value}")
+        try:
+            connection.execute("BEGIN")
+            exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                        (table,)).fetchone()
+            if exists and if_exists == 'fail':
+                raise RuntimeError(f"Table {table} already exists.")
+            if exists and if_exists == 'replace':
+                connection.execute(f"DROP TABLE {quote_identifier(table)}")
+            if not exists or if_exists == 'replace':
+                definitions = ', '.join(f"{quote_identifier(field.name)} {sqlite_type(field.type)}" for field in schema)
+                connection.execute(f"CREATE TABLE {quote_identifier(table)} ({definitions})")
+            insert = f"INSERT INTO {quote_identifier(table)} ({columns}) VALUES ({placeholders})"
+            for batch in batches:
+                connection.executemany(insert, _rows(batch))
+                rows_imported += batch.num_rows
+                if progress is not None and time.monotonic() - last_report >= progress_interval:
+                    last_report = time.monotonic()
+                    progress(rows_imported, total_rows)
+            connection.commit()
+        except Exception as e:
+            connection.rollback()
+            if isinstance(e, (pa.ArrowInvalid, pa.ArrowTypeError)):
+                raise RuntimeError(f"Could not read {file_name}: {e}")
+            raise
+        finally:
+            for name, value in previous:
+                connection.execute(f"PRAGMA {name}={value}")
+            viewer.cache.invalidate(viewer.database_name)
+    if progress is not None:
+        progress(rows_imported, total_rows)
+    return table, rows_imported, time.monotonic() - started
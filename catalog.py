@@ -0,0 +1,196 @@
+import os
+import sqlite3
+import threading
+import time
+from sqlite_handler import connection_pool, file_version, quote_identifier
+from metrics import metrics
+
+DATABASE_DIR = "SQLite_databases"
+
+
+class TableInfo:
+    __slots__ = ('name', 'columns', 'column_types', 'indexes', 'row_estimate')
+
+    def __init__(self, name, columns, column_types, indexes, row_estimate):
+        self.name = name
+        self.columns = columns
+        self.column_types = column_types
+        self.indexes = indexes  # list of (index_name, [column, ...], unique)
+        self.row_estimate = row_estimate  # None when it cannot be estimated cheaply
+
+
+class DatabaseInfo:
+    __slots__ = ('name', 'path', 'version', 'tables', 'error')
+
+    def __init__(self, name, path, version, tables, error=None):
+        self.name = name
+        self.path = path
+        self.version = version
+        self.tables = tables  # table name -> TableInfo, in sqlite_master order
+        self.error = error  # Why the file could not be read, e.g. it is not a SQLite database
+
+
+class Catalog:
+    def __init__(self, directory=DATABASE_DIR, pool=None, listing_interval=2):
+        """
+        In-memory index of the databases in a directory: their tables, columns, indexes and row estimates.
+
+        The directory is listed again only when its mtime changes (checked at most every listing_interval
+        seconds), and a database is re-scanned only when its file version (see file_version) changes, so
+        navigation is answered from memory with a couple of stat calls.
+
+        :param directory: Directory holding the SQLite database files.
+        :param pool: ConnectionPool used for scanning (read-only connections of the shared one by default).
+        :param listing_interval: Minimum seconds between two checks of the directory mtime.
+        """
+        self.directory = directory
+        self.pool = pool or connection_pool
+        self.listing_interval = listing_interval
+        self._lock = threading.RLock()
+        self._names = []
+        self._directory_mtime = None
+        self._last_listing = None
+        self._databases = {}  # file name -> DatabaseInfo
+        self.stats = {'listings': 0, 'scans': 0, 'scan_time': 0.0}
+
+    def databases(self):
+        """Sorted file names of the databases in the directory."""
+        with self._lock:
+            now = time.monotonic()
+            if self._last_listing is None or now - self._last_listing >= self.listing_interval:
+                self._last_listing = now
+                try:
+                    mtime = os.stat(self.directory).st_mtime_ns
+                except OSError:
+                    mtime = None
+                if mtime != self._directory_mtime:
+                    self._directory_mtime = mtime
+                    self._list()
+            return list(self._names)
+
+    def _list(self):
+        try:
+            names = sorted(name for name in os.listdir(self.directory)
+                           if os.path.isfile(os.path.join(self.directory, name)) and
+                           not name.endswith(('-wal', '-shm', '-journal')))
+        except OSError:
+            names = []
+        self._names = names
+        for name in set(self._databases) - set(names):
+            del self._databases[name]
+        self.stats['listings'] += 1
+
+    def __contains__(self, db_name):
+        return db_name in self.databases()
+
+    def database(self, db_name):
+        """Return the DatabaseInfo of a database, scanning it if it changed; None for unknown names."""
+        if db_name not in self.databases():
+            return None
+        path = os.path.join(self.directory, db_name)
+        version = file_version(path)
+        with self._lock:
+            info = self._databases.get(db_name)
+            if info is not None and info.version == version:
+                return info
+        info = self._scan(db_name, path, version)
+        with self._lock:
+            self._databases[db_name] = info
+        return info
+
+    def _scan(self, db_name, path, version):
+        started = time.monotonic()
+        tables = {}
+        try:
+            with self.pool.connection(path, read_only=True) as connection:
+                names = [row[0] for row in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'")]
+                stats = self._table_stats(connection)
+                for name in names:
+                    tables[name] = self._scan_table(connection, name, stats.get(name))
+            error = None
+        except (sqlite3.Error, RuntimeError) as e:
+            error = str(e)
+        with self._lock:
+            self.stats['scans'] += 1
+            self.stats['scan_time'] += time.monotonic() - started
+        return DatabaseInfo(db_name, path, version, tables, error)
+
+    @staticmethod
+    def _table_stats(connection):
+        """Row counts recorded by ANALYZE, when the database has been analyzed."""
+        try:
+            rows = connection.execute("SELECT tbl, stat FROM sqlite_stat1").fetchall()
+        except sqlite3.OperationalError:
+            return {}
+        stats = {}
+        for table, stat in rows:  # The first number of every entry is the row count of the table
+            try:
+                stats.setdefault(table, int(stat.split()[0]))
+            except (AttributeError, ValueError, IndexError):
+                pass
+        return stats
+
+    @staticmethod
+    def _scan_table(connection, name, analyzed_rows):
+        table = quote_identifier(name)
+        info = connection.execute(f"PRAGMA table_info({table})").fetchall()
+        indexes = []
+        for _, index_name, unique, *_ in connection.execute(f"PRAGMA index_list({table})").fetchall():
+            index_columns = [row[2] for row in
+                             connection.execute(f"PRAGMA index_info({quote_identifier(index_name)})").fetchall()]
+            indexes.append((index_name, index_columns, bool(unique)))
+        row_estimate = analyzed_rows
+        if row_estimate is None:
+            try:
+                # The largest rowid is a b-tree descent, unlike COUNT(*)
+                row_estimate = connection.execute(f"SELECT max(rowid) FROM {table}").fetchone()[0] or 0
+            except sqlite3.OperationalError:
+                pass  # WITHOUT ROWID table
+        return TableInfo(name, [row[1] for row in info], [row[2] for row in info], indexes, row_estimate)
+
+    def tables(self, db_name):
+        info = self.database(db_name)
+        return list(info.tables) if info is not None else []
+
+    def table(self, db_name, table_name):
+        info = self.database(db_name)
+        return info.tables.get(table_name) if info is not None else None
+
+    def columns(self, db_name, table_name):
+        table = self.table(db_name, table_name)
+        return list(table.columns) if table is not None else []
+
+    def search(self, text, limit=50):
+        """
+        Find databases, tables and columns whose name contains text (case-insensitive).
+
+        :return: A list of (db_name, table_name or None, column_name or None) tuples.
+        """
+        text = text.strip().lower()
+        if not text:
+            return []
+        matches = []
+        for db_name in self.databases():
+            if text in db_name.lower():
+                matches.append((db_name, None, None))
+            info = self.database(db_name)
+            for table in info.tables.values() if info is not None else ():
+                if text in table.name.lower():
+                    matches.append((db_name, table.name, None))
+                matches.extend((db_name, table.name, column) for column in table.columns if text in column.lower())
+            if len(matches) >= limit:
+                break
+        return matches[:limit]
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['databases'] = len(self._names)
+            stats['scanned'] = len(self._databases)
+        return stats
+
+
+# Shared by the bot handlers or the Streamlit sessions of this process
+catalog = Catalog()
+metrics.register_stats('catalog', catalog.get_stats, "Database catalog")
@@ -0,0 +1,163 @@
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from sqlite_handler import SQLViewer, PROGRESS_HANDLER_INTERVAL, quote_identifier
+from query_profiler import query_profiler
+
+REPLAY_TIMEOUT = 10  # Seconds a replayed query may run on the copy
+MIN_IMPROVEMENT = 0.2  # Fraction of the replay time an index has to save to be suggested
+# Plan steps that read a whole table, build a temporary index or sort in a temporary b-tree
+_COSTLY_STEP = re.compile(r'^SCAN (?!.*\bINDEX\b)|\bAUTOMATIC\b|^USE TEMP B-TREE')
+
+
+class IndexSuggestion:
+    __slots__ = ('table', 'columns', 'name', 'statement', 'queries', 'baseline', 'indexed', 'benefit')
+
+    def __init__(self, table, columns, queries):
+        self.table = table
+        self.columns = columns
+        self.name = re.sub(r'\W', '_', f"idx_{table}_{'_'.join(columns)}")
+        self.statement = (f"CREATE INDEX IF NOT EXISTS {quote_identifier(self.name)} ON {quote_identifier(table)} "
+                          f"({', '.join(quote_identifier(column) for column in columns)})")
+        self.queries = queries  # (query, calls) of the workload statements whose plan the index improves
+        self.baseline = None  # Seconds to replay the statements once without the index
+        self.indexed = None  # ... and with it
+        self.benefit = 0.0  # Estimated seconds saved over the observed workload
+
+    @property
+    def calls(self):
+        return sum(calls for _, calls in self.queries)
+
+
+class IndexAdvisor:
+    def __init__(self, database_name, profiler=None, replay_timeout=REPLAY_TIMEOUT, max_queries=50):
+        """
+        Proposes indexes for the read statements observed on a database.
+
+        Candidate columns are the ones the statements read (as reported by the SQLite authorizer). Each
+        candidate is first tried on an empty copy of the schema, where only the query plans are compared; the
+        ones that remove a full scan, an automatic index or a temporary sort are then validated by replaying
+        the affected statements on a full copy of the database with and without the index.
+
+        :param database_name: Path of the SQLite database file.
+        :param profiler: QueryProfiler providing the workload (the shared one by default).
+        :param replay_timeout: Seconds after which a replayed statement is interrupted.
+        :param max_queries: Number of most expensive workload statements considered.
+        """
+        self.viewer = SQLViewer(database_name, read_only=True)
+        self.profiler = profiler or query_profiler
+        self.replay_timeout = replay_timeout
+        self.max_queries = max_queries
+
+    def workload(self):
+        """Read-only statements of the workload with their columns: a list of (query, calls, {(table, column)})."""
+        workload = []
+        for query, calls, _ in self.profiler.workload(self.viewer.database_name)[:self.max_queries]:
+            try:
+                info = self.viewer.classify(query)
+            except sqlite3.Error:
+                continue
+            if not info.read_only:
+                continue
+            columns = {(table, column) for action, table, column, database in info.actions
+                       if action == sqlite3.SQLITE_READ and database == 'main' and column and
+                       not table.startswith('sqlite_')}
+            if columns:
+                workload.append((query, calls, columns))
+        return workload
+
+    def _schema_copy(self):
+        """An in-memory database with the same tables, indexes and views but no rows."""
+        with self.viewer.connection() as connection:
+            statements = connection.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND "
+                                            "name NOT LIKE 'sqlite_%' ORDER BY type = 'table' DESC").fetchall()
+        copy = sqlite3.connect(":memory:")
+        for statement, in statements:
+            try:
+                copy.execute(statement)
+            except sqlite3.Error:
+                pass  # e.g. a virtual table whose module is not available here
+        return copy
+
+    @staticmethod
+    def plan_cost(connection, query):
+        """Number of costly steps in the query plan (see _COSTLY_STEP)."""
+        plan = connection.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+        return sum(1 for *_, detail in plan if _COSTLY_STEP.search(detail))
+
+    def candidates(self, workload):
+        """Single-column indexes that make the plan of at least one statement cheaper, most used first."""
+        schema = self._schema_copy()
+        try:
+            costs = [self.plan_cost(schema, query) for query, _, _ in workload]
+            columns = sorted({column for index, (_, _, read) in enumerate(workload) if costs[index]
+                              for column in read})
+            suggestions = []
+            for table, column in columns:
+                try:
+                    schema.execute(f"CREATE INDEX advisor_candidate ON {quote_identifier(table)} "
+                                   f"({quote_identifier(column)})")
+                except sqlite3.OperationalError:
+                    continue  # rowid alias or a column of a view
+                improved = [index for index, (query, _, read) in enumerate(workload) if costs[index] and
+                            (table, column) in read and self.plan_cost(schema, query) < costs[index]]
+                schema.execute("DROP INDEX advisor_candidate")
+                if improved:
+                    suggestions.append(IndexSuggestion(table, [column], [workload[index][:2] for index in improved]))
+        finally:
+            schema.close()
+        suggestions.sort(key=lambda suggestion: suggestion.calls, reverse=True)
+        return suggestions
+
+    def _replay(self, connection, query):
+        """Run a statement to completion on the copy and return the elapsed seconds (capped at replay_timeout)."""
+        started = time.perf_counter()
+        deadline = started + self.replay_timeout
+        connection.set_progress_handler(lambda: time.perf_counter() > deadline, PROGRESS_HANDLER_INTERVAL)
+        try:
+            for _ in connection.execute(query):
+                pass
+        except sqlite3.OperationalError:
+            pass  # Interrupted at the deadline
+        finally:
+            connection.set_progress_handler(None, 0)
+        return min(time.perf_counter() - started, self.replay_timeout)
+
+    def validate(self, suggestions):
+        """Replay the statements of each suggestion on a copy of the database, with and without its index."""
+        directory = tempfile.mkdtemp(prefix="index_advisor_")
+        try:
+            copy = sqlite3.connect(os.path.join(directory, "copy.db"))
+            try:
+                with self.viewer.connection() as connection:
+                    connection.backup(copy)
+                baselines = {}
+                for suggestion in suggestions:
+                    for query, _ in suggestion.queries:
+                        if query not in baselines:
+                            baselines[query] = self._replay(copy, query)
+                    copy.execute(suggestion.statement)
+                    indexed = {query: self._replay(copy, query) for query, _ in suggestion.queries}
+                    copy.execute(f"DROP INDEX {quote_identifier(suggestion.name)}")
+                    suggestion.baseline = sum(baselines[query] for query in indexed)
+                    suggestion.indexed = sum(indexed.values())
+                    suggestion.benefit = sum(calls * (baselines[query] - indexed[query])
+                                             for query, calls in suggestion.queries)
+            finally:
+                copy.close()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        return [suggestion for suggestion in suggestions
+                if suggestion.indexed <= suggestion.baseline * (1 - MIN_IMPROVEMENT)]
+
+    def suggest(self, max_suggestions=5):
+        """Return validated IndexSuggestions, largest estimated benefit first."""
+        workload = self.workload()
+        if not workload:
+            return []
+        suggestions = self.validate(self.candidates(workload)[:max_suggestions * 2])
+        suggestions.sort(key=lambda suggestion: suggestion.benefit, reverse=True)
+        return suggestions[:max_suggestions]
@@ -0,0 +1,427 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import liveness
+from admission import admission
+from metrics import metrics
+from sqlite_handler import (SQLViewer, QueryBudget, budget_scope, connection_pool, cancellation_scope, export_rows,
+                            fetch_batches, DEFAULT_PRAGMAS, EXPORT_BATCH_SIZE, TELEGRAM_UPLOAD_LIMIT)
+
+JOB_STATUSES = ('queued', 'running', 'done', 'failed', 'cancelled')
+FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+POLL_INTERVAL = 0.5  # Seconds between two looks at the queue
+PROGRESS_INTERVAL = 1.0  # Seconds between two progress updates written by a worker
+CLEANUP_INTERVAL = 600
+DISPATCHER_TIMEOUT = 300  # A dispatcher round (including result deliveries) taking longer than this is stalled
+_COLUMNS = ('id', 'owner', 'database', 'query', 'export_format', 'compress', 'status', 'rows', 'submitted_at',
+            'started_at', 'finished_at', 'error', 'files')
+
+
+class Job:
+    """A row of the jobs table."""
+    __slots__ = _COLUMNS
+
+    def __init__(self, id, owner, database, query, export_format, compress, status, rows, submitted_at, started_at,
+                 finished_at, error, files):
+        self.id = id
+        self.owner = owner  # 'chat:<chat_id>' for the bot, 'streamlit:<session key>' for Streamlit
+        self.database = database  # Path of the SQLite database
+        self.query = query
+        self.export_format = export_format
+        self.compress = bool(compress)
+        self.status = status  # One of JOB_STATUSES
+        self.rows = rows  # Rows exported so far
+        self.submitted_at = submitted_at
+        self.started_at = started_at
+        self.finished_at = finished_at
+        self.error = error
+        self.files = files.split('\n') if files else []  # Paths of the result files, once done
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+def _cancel_requested(connection, job_id):
+    try:
+        row = connection.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    except sqlite3.Error:
+        return False  # Busy, look again later
+    return row is None or bool(row[0])  # A deleted job is cancelled too
+
+
+def _init_worker(pragmas, database_pragmas):
+    connection_pool.configure(pragmas, database_pragmas)
+
+
+def _run_job(path, job_id, database_name, query, export_format, compress, result_dir, timeout, max_rows=None):
+    """
+    Runs in a worker process: export the result of a job into result_dir/<job_id>/ and record the outcome.
+
+    A watcher thread interrupts the statement (through the progress handler of the pooled connection) when
+    the job is cancelled in the queue or runs past its timeout; so does fetching more than max_rows rows.
+    """
+    jobs = _connect(path)
+    cancel = threading.Event()
+    stop = threading.Event()
+    deadline = time.monotonic() + timeout
+    reason = []
+
+    def watch():
+        watcher = _connect(path)
+        try:
+            while not stop.wait(PROGRESS_INTERVAL):
+                if time.monotonic() > deadline:
+                    reason.append(f"The job took longer than {timeout}s and was cancelled.")
+                elif _cancel_requested(watcher, job_id):
+                    reason.append(None)
+                else:
+                    continue
+                cancel.set()
+                return
+        finally:
+            watcher.close()
+
+    threading.Thread(target=watch, name=f'job-{job_id}-watcher', daemon=True).start()
+    directory = os.path.join(result_dir, str(job_id))
+    os.makedirs(directory, exist_ok=True)
+    rows = 0
+    files = []
+    try:
+        with cancellation_scope(cancel), budget_scope(QueryBudget(max_rows) if max_rows else None), \
+                SQLViewer(database_name, read_only=True).connection() as connection:
+            cursor = connection.execute(query)
+            header = [column[0] for column in cursor.description or []]
+
+            def batches():
+                nonlocal rows
+                reported = time.monotonic()
+                for batch in fetch_batches(cursor, EXPORT_BATCH_SIZE):
+                    rows += len(batch)
+                    if time.monotonic() - reported >= PROGRESS_INTERVAL:
+                        reported = time.monotonic()
+                        jobs.execute("UPDATE jobs SET rows = ? WHERE id = ?", (rows, job_id))
+                    yield batch
+
+            for file_name, part in export_rows(header, batches(), export_format, compress, TELEGRAM_UPLOAD_LIMIT,
+                                               f"job_{job_id}"):
+                with part, open(os.path.join(directory, file_name), 'wb') as output:
+                    shutil.copyfileobj(part, output)
+                files.append(os.path.join(directory, file_name))
+        status, error = 'done', None
+    except Exception as e:
+        shutil.rmtree(directory, ignore_errors=True)
+        files = []
+        if cancel.is_set():
+            status, error = ('failed', reason[0]) if reason and reason[0] else ('cancelled', None)
+        else:
+            status, error = 'failed', str(e)
+    finally:
+        stop.set()
+    jobs.execute("UPDATE jobs SET status = ?, rows = ?, finished_at = ?, error = ?, files = ? WHERE id = ?",
+                 (status, rows, time.time(), error, '\n'.join(files), job_id))
+    jobs.close()
+    return status
+
+
+class JobQueue:
+    def __init__(self, path=None, result_dir="job_results", workers=2, max_per_owner=1, max_per_database=2,
+                 job_timeout=3600, result_ttl=86400, max_queued_per_owner=5, max_rows=10000000):
+        """
+        Persistent queue of long-running read queries, exported to files by a pool of worker processes.
+
+        Jobs are rows of a SQLite table, so the bot and the Streamlit app share one queue: each process that
+        calls start() dispatches queued jobs to its own workers, and the concurrency limits are checked in the
+        same transaction that claims a job. Jobs left running by a process that died are queued again.
+
+        :param path: SQLite file of the queue; jobs are refused until one is configured.
+        :param result_dir: Directory receiving the result files, one subdirectory per job.
+        :param workers: Worker processes of this process.
+        :param max_per_owner: Jobs of one chat or Streamlit session running at the same time.
+        :param max_per_database: Jobs running at the same time on one database.
+        :param job_timeout: Seconds after which a running job is cancelled.
+        :param result_ttl: Seconds finished jobs and their files are kept.
+        :param max_queued_per_owner: Jobs of one chat or Streamlit session waiting to run.
+        :param max_rows: Rows a user's job may export; admin jobs have no limit.
+        """
+        self._lock = threading.RLock()
+        self._connection = None
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._futures = {}  # job id -> Future of the jobs this process runs
+        self._deliver = None
+        self._owner_prefix = None
+        self.path = None
+        self.stats = {'submitted': 0, 'dispatched': 0, 'requeued': 0, 'delivered': 0, 'cleaned': 0}
+        self.configure(path, result_dir, workers, max_per_owner, max_per_database, job_timeout, result_ttl,
+                       max_queued_per_owner=max_queued_per_owner, max_rows=max_rows)
+
+    def configure(self, path=None, result_dir="job_results", workers=2, max_per_owner=1, max_per_database=2,
+                  job_timeout=3600, result_ttl=86400, pragmas=DEFAULT_PRAGMAS, database_pragmas=None,
+                  max_queued_per_owner=5, max_rows=10000000):
+        with self._lock:
+            self.max_queued_per_owner = max_queued_per_owner
+            self.max_rows = max_rows
+            self.result_dir = result_dir
+            self.workers = workers
+            self.max_per_owner = max_per_owner
+            self.max_per_database = max_per_database
+            self.job_timeout = job_timeout
+            self.result_ttl = result_ttl
+            self.pragmas = pragmas
+            self.database_pragmas = database_pragmas or {}
+            # Workers run in other processes, possibly with another working directory
+            path = os.path.abspath(path) if path else None
+            self.result_dir = os.path.abspath(result_dir)
+            if path == self.path:
+                return
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            self.path = path
+            if path:
+                self._connection = _connect(path)
+                self._connection.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, owner TEXT, "
+                                         "database TEXT, query TEXT, export_format TEXT, compress INTEGER, "
+                                         "status TEXT, rows INTEGER DEFAULT 0, submitted_at REAL, started_at REAL, "
+                                         "finished_at REAL, error TEXT, files TEXT, cancel_requested INTEGER "
+                                         "DEFAULT 0, delivered INTEGER DEFAULT 0, dispatcher_pid INTEGER)")
+                self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+                columns = [row[1] for row in self._connection.execute("PRAGMA table_info(jobs)")]
+                if 'max_rows' not in columns:  # Queues created before the row limit
+                    self._connection.execute("ALTER TABLE jobs ADD COLUMN max_rows INTEGER")
+
+    @property
+    def enabled(self):
+        return self._connection is not None
+
+    def submit(self, owner, database_name, query, export_format='csv', compress=False, privileged=False):
+        """
+        Queue a read-only query; its result will be exported to files of export_format.
+
+        Jobs of users go through admission control like their other queries (the cost limit and the token
+        buckets, charged now) and export at most max_rows rows; an owner has at most max_queued_per_owner
+        jobs waiting. Raises RuntimeError saying why a job is refused.
+
+        :param privileged: Admin jobs skip admission control and the row limit.
+        :return: The job id.
+        """
+        if not self.enabled:
+            raise RuntimeError("Background jobs are not enabled (set JOB_QUEUE_PATH).")
+        viewer = SQLViewer(database_name, read_only=True)
+        if not viewer.classify(query).read_only:
+            raise RuntimeError("Only read queries can run as background jobs.")
+        with self._lock:
+            queued = self._connection.execute("SELECT COUNT(*) FROM jobs WHERE owner = ? AND status = 'queued'",
+                                              (owner,)).fetchone()[0]
+            if queued >= self.max_queued_per_owner:
+                raise RuntimeError(f"You already have {queued} jobs waiting, wait for them or cancel one.")
+            if not privileged:
+                admission.charge(owner, viewer, query)
+            cursor = self._connection.execute(
+                "INSERT INTO jobs (owner, database, query, export_format, compress, status, submitted_at, max_rows) "
+                "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (owner, database_name, query, export_format, int(compress), time.time(),
+                 None if privileged else self.max_rows))
+            self.stats['submitted'] += 1
+            return cursor.lastrowid
+
+    def _select(self, where, parameters):
+        with self._lock:
+            rows = self._connection.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE {where}",
+                                            parameters).fetchall()
+        return [Job(*row) for row in rows]
+
+    def job(self, job_id):
+        jobs = self._select("id = ?", (job_id,)) if self.enabled else []
+        return jobs[0] if jobs else None
+
+    def jobs(self, owner, limit=20):
+        """Most recent jobs of an owner, newest first."""
+        return self._select("owner = ? ORDER BY id DESC LIMIT ?", (owner, limit)) if self.enabled else []
+
+    def cancel(self, job_id, owner=None):
+        """Cancel a queued or running job (of the given owner). Returns True if it was still unfinished."""
+        if not self.enabled:
+            return False
+        owner_clause, parameters = ("AND owner = ?", (owner,)) if owner is not None else ("", ())
+        with self._lock:
+            queued = self._connection.execute(
+                f"UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued' "
+                f"{owner_clause}", (time.time(), job_id) + parameters).rowcount
+            running = self._connection.execute(
+                f"UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running' {owner_clause}",
+                (job_id,) + parameters).rowcount
+        return bool(queued or running)
+
+    def start(self, deliver=None, owner_prefix=None):
+        """
+        Start dispatching queued jobs to this process's workers.
+
+        :param deliver: Optional callable(Job) called once for every finished job whose owner starts with
+                        owner_prefix, whichever process ran it.
+        """
+        with self._lock:
+            if not self.enabled or self._thread is not None:
+                return
+            self._deliver = deliver
+            self._owner_prefix = owner_prefix
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"),
+                                                 initializer=_init_worker,
+                                                 initargs=(self.pragmas, self.database_pragmas))
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='job-dispatcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        self._requeue_orphans()
+        last_cleanup = 0
+        while not self._stop.wait(POLL_INTERVAL):
+            liveness.beat('job-dispatcher', DISPATCHER_TIMEOUT)
+            try:
+                self._dispatch()
+                if self._deliver is not None:
+                    self._deliver_finished()
+                if time.monotonic() - last_cleanup >= CLEANUP_INTERVAL:
+                    last_cleanup = time.monotonic()
+                    self._requeue_orphans()
+                    self.cleanup()
+            except sqlite3.Error:
+                pass  # The queue is busy, try again on the next round
+        liveness.stopped('job-dispatcher')
+
+    def _requeue_orphans(self):
+        """Queue again the jobs left running by a process that is gone."""
+        with self._lock:
+            running = self._connection.execute(
+                "SELECT id, dispatcher_pid FROM jobs WHERE status = 'running'").fetchall()
+            for job_id, pid in running:
+                if (pid == os.getpid() and job_id in self._futures) or (pid != os.getpid() and _is_alive(pid)):
+                    continue
+                self._connection.execute("UPDATE jobs SET status = 'queued', rows = 0, started_at = NULL "
+                                         "WHERE id = ? AND status = 'running'", (job_id,))
+                self.stats['requeued'] += 1
+
+    def _dispatch(self):
+        with self._lock:
+            free = self.workers - len(self._futures)
+            if free <= 0:
+                return
+            claimed = []
+            # IMMEDIATE takes the write lock up front, so two processes cannot claim past the limits
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                per_owner, per_database = {}, {}
+                for owner, database in self._connection.execute(
+                        "SELECT owner, database FROM jobs WHERE status = 'running'"):
+                    per_owner[owner] = per_owner.get(owner, 0) + 1
+                    per_database[database] = per_database.get(database, 0) + 1
+                queued = self._connection.execute("SELECT id, owner, database, query, export_format, compress, "
+                                                  "max_rows FROM jobs WHERE status = 'queued' ORDER BY id").fetchall()
+                for job in queued:
+                    _, owner, database, *_ = job
+                    if per_owner.get(owner, 0) >= self.max_per_owner or \
+                            per_database.get(database, 0) >= self.max_per_database:
+                        continue
+                    self._connection.execute("UPDATE jobs SET status = 'running', started_at = ?, dispatcher_pid = ? "
+                                             "WHERE id = ?", (time.time(), os.getpid(), job[0]))
+                    per_owner[owner] = per_owner.get(owner, 0) + 1
+                    per_database[database] = per_database.get(database, 0) + 1
+                    claimed.append(job)
+                    if len(claimed) == free:
+                        break
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            for job_id, _, database, query, export_format, compress, max_rows in claimed:
+                future = self._executor.submit(_run_job, self.path, job_id, database, query, export_format,
+                                               bool(compress), self.result_dir, self.job_timeout, max_rows)
+                self._futures[job_id] = future
+                future.add_done_callback(lambda f, job_id=job_id: self._job_done(job_id, f))
+                self.stats['dispatched'] += 1
+
+    def _job_done(self, job_id, future):
+        with self._lock:
+            self._futures.pop(job_id, None)
+            error = None if future.cancelled() else future.exception()
+            if future.cancelled() or error is not None:
+                # The worker could not record the outcome itself, e.g. its process was killed
+                self._connection.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = ? "
+                                         "WHERE id = ? AND status = 'running'",
+                                         (time.time(), str(error or "The worker was stopped."), job_id))
+
+    def _deliver_finished(self):
+        with self._lock:
+            finished = self._select(f"status IN {FINISHED_STATUSES} AND delivered = 0 AND owner LIKE ? || '%'",
+                                    (self._owner_prefix or '',))
+            # Claimed one by one, so a job is delivered once even when several processes deliver
+            finished = [job for job in finished if self._connection.execute(
+                "UPDATE jobs SET delivered = 1 WHERE id = ? AND delivered = 0", (job.id,)).rowcount]
+        for job in finished:
+            try:
+                self._deliver(job)
+                self.stats['delivered'] += 1
+            except Exception:
+                pass  # e.g. the chat blocked the bot
+
+    def cleanup(self):
+        """Delete finished jobs older than result_ttl together with their result files."""
+        if not self.enabled:
+            return
+        with self._lock:
+            expired = [row[0] for row in self._connection.execute(
+                f"SELECT id FROM jobs WHERE status IN {FINISHED_STATUSES} AND finished_at < ?",
+                (time.time() - self.result_ttl,))]
+            for job_id in expired:
+                shutil.rmtree(os.path.join(self.result_dir, str(job_id)), ignore_errors=True)
+                self._connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.stats['cleaned'] += len(expired)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['running_here'] = len(self._futures)
+        stats['workers'] = self.workers
+        if self.enabled:
+            with self._lock:
+                stats.update(self._connection.execute("SELECT status, count(*) FROM jobs GROUP BY status").fetchall())
+        return stats
+
+    def shutdown(self):
+        """Stop dispatching and cancel the jobs running in this process (they are not queued again)."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            for job_id in list(self._futures):
+                self.cancel(job_id)
+        if thread is not None:
+            self._stop.set()
+            thread.join(timeout=5)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, TypeError):
+        return pid is not None
+    return True
+
+
+# Shared by the bot handlers or the Streamlit sessions of this process
+job_queue = JobQueue()
+metrics.register_stats('job_queue', job_queue.get_stats, "Background job queue")
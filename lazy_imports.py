@@ -0,0 +1,43 @@
+import importlib
+import sys
+import time
+
+import_seconds = {}  # module name -> seconds its import took when a LazyModule first needed it
+
+
+class LazyModule:
+    def __init__(self, name):
+        """
+        Stand-in for a heavy module (pandas, pyarrow, pexpect, telebot) that imports it on first attribute access.
+
+        A process that never uses the module, like a bot that only sends CSV results, does not pay for the
+        import at startup. The first use pays once and the time it took is recorded in import_seconds.
+
+        :param name: Module to import, e.g. "pyarrow.parquet".
+        """
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            name = self.__dict__['_name']
+            imported = name in sys.modules
+            started = time.perf_counter()
+            module = importlib.import_module(name)
+            if not imported:
+                import_seconds.setdefault(name, time.perf_counter() - started)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__['_module'] is not None else "not loaded"
+        return f"<LazyModule {self.__dict__['_name']} ({state})>"
+
+
+def loaded(name):
+    """True if the module has been imported in this process, e.g. before an isinstance check against its types."""
+    return name in sys.modules
@@ -0,0 +1,22 @@
+import time
+
+_deadlines = {}  # work loop name -> monotonic time by which it has to beat again
+
+
+def beat(name, timeout):
+    """
+    Record that a work loop of this process made progress, e.g. the query engine's event loop or the job
+    dispatcher. The loop counts as stalled if it does not beat again within timeout seconds.
+    """
+    _deadlines[name] = time.monotonic() + timeout
+
+
+def stopped(name):
+    """The loop ended on purpose (shutdown) and no longer has to beat."""
+    _deadlines.pop(name, None)
+
+
+def stalled():
+    """Names of the loops that missed their deadline; main.py stops sending the child's heartbeat then."""
+    now = time.monotonic()
+    return [name for name, deadline in list(_deadlines.items()) if deadline < now]
@@ -1,24 +1,263 @@
-from multiprocessing import Process
+"""
+Supervisor for the Telegram bot, the Streamlit server and optional background job runners.
+
+    python main.py            # start everything and keep it running
+    python main.py status     # print the status written by the running supervisor
+
+Children are forked from a forkserver that has already imported pandas, pyarrow and the SQLite modules,
+so a (re)start does not pay for those imports again. A child that exits, stops sending heartbeats or (for
+Streamlit) fails its health check is restarted with exponential backoff. A child sends heartbeats while its
+work loops keep beating (see liveness): the query engine's event loop and the job dispatcher. Telegram polling
+itself is not covered, telebot's loop has no hook, so for it the heartbeat only shows the interpreter is alive.
+SIGINT/SIGTERM stop the children gracefully. Startup times and restart counts are written to SUPERVISOR_STATUS_PATH.
+"""
+import importlib
+import json
 import os
+import signal
+import sys
+import threading
+import time
+import urllib.request
+from multiprocessing import get_context
+import liveness
+from settings_reader import load_settings
 
+PRELOADED_MODULES = ['pandas', 'pyarrow', 'pyarrow.parquet', 'pyarrow.csv', 'telebot', 'sqlite_handler', 'catalog',
+                     'query_profiler', 'result_store']
+HEARTBEAT_INTERVAL = 2
+HEALTH_CHECK_FAILURES = 3  # Consecutive failed HTTP health checks before a restart
 
-def run_streamlit():
-    os.system("./run_streamlit.sh")
 
+def _exit_on_sigterm(signum, frame):
+    sys.exit(0)  # Unwinds the child's finally blocks (worker pools, mongosh shells...)
 
-def run_bot():
-    os.system("python run_bot.py")
 
+def _beat(heartbeat):
+    """Publish the heartbeat as long as no work loop of the child is stalled."""
+    while True:
+        if not liveness.stalled():
+            heartbeat.value = time.time()
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def _child_main(target, args, heartbeat):
+    """Entry point of every child: import the target, start the heartbeat, then run it."""
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    module_name, function_name = target.split(':')
+    function = getattr(importlib.import_module(module_name), function_name)
+    threading.Thread(target=_beat, args=(heartbeat,), name='heartbeat', daemon=True).start()
+    function(*args)
+
+
+def run_streamlit(app_path, port):
+    from streamlit.web import cli
+    sys.argv = ["streamlit", "run", app_path, "--server.port", str(port), "--server.headless", "true"]
+    sys.exit(cli.main())
+
+
+def run_job_runner():
+    """Dispatch background jobs without a front end, configured like the bot."""
+    import run_bot
+    from job_queue import job_queue
+    run_bot.connection_pool.configure(run_bot.SQLITE_PRAGMAS, run_bot.SQLITE_DATABASE_PRAGMAS)
+    job_queue.configure(run_bot.JOB_QUEUE_PATH, run_bot.JOB_RESULT_DIR, workers=run_bot.JOB_WORKERS,
+                        max_per_owner=run_bot.JOB_MAX_PER_USER, max_per_database=run_bot.JOB_MAX_PER_DATABASE,
+                        job_timeout=run_bot.JOB_TIMEOUT, pragmas=run_bot.SQLITE_PRAGMAS,
+                        database_pragmas=run_bot.SQLITE_DATABASE_PRAGMAS,
+                        max_queued_per_owner=run_bot.JOB_MAX_QUEUED_PER_USER, max_rows=run_bot.JOB_MAX_ROWS)
+    job_queue.start()
+    try:
+        threading.Event().wait()
+    finally:
+        job_queue.shutdown()
+
+
+class Child:
+    def __init__(self, name, target, args=(), health_url=None):
+        """
+        A supervised process.
+
+        :param target: 'module:function' run in the child.
+        :param health_url: Optional URL that must answer 200 once the child is up (Streamlit's health endpoint).
+        """
+        self.name = name
+        self.target = target
+        self.args = args
+        self.health_url = health_url
+        self.process = None
+        self.heartbeat = None
+        self.started_at = None
+        self.ready_at = None
+        self.startup_seconds = None  # From fork until ready, for the latest start
+        self.restarts = 0
+        self.failures = 0  # Consecutive short-lived runs, drives the backoff
+        self.failed_checks = 0
+        self.next_start = 0.0
+        self.last_exit = None
+
+    def is_ready(self):
+        if self.health_url is None:
+            return self.heartbeat.value > 0
+        try:
+            with urllib.request.urlopen(self.health_url, timeout=2) as response:
+                return response.status == 200
+        except OSError:
+            return False
 
-if __name__ == '__main__':
-    # Create processes
-    streamlit_process = Process(target=run_streamlit)
-    bot_process = Process(target=run_bot)
 
-    # Start processes
-    streamlit_process.start()
-    bot_process.start()
+class Supervisor:
+    def __init__(self, children, check_interval=5, heartbeat_timeout=30, backoff_base=1, backoff_max=60,
+                 stable_after=60, startup_timeout=120, shutdown_timeout=10, status_path=None):
+        """
+        :param children: Child objects to run.
+        :param check_interval: Seconds between two liveness checks.
+        :param heartbeat_timeout: Seconds without a heartbeat after which a child is considered hung.
+        :param backoff_base: Delay before the first restart; doubled after every run shorter than stable_after.
+        :param backoff_max: Maximum restart delay.
+        :param stable_after: Seconds a child must run before its backoff is reset.
+        :param startup_timeout: Seconds a child may take to become ready.
+        :param shutdown_timeout: Seconds a child gets to exit after SIGTERM before it is killed.
+        :param status_path: Optional JSON file the status is written to after every check.
+        """
+        self.children = children
+        self.check_interval = check_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.startup_timeout = startup_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.status_path = status_path
+        self.context = get_context("forkserver")
+        self.context.set_forkserver_preload(PRELOADED_MODULES)
+        self.started_at = time.time()
+        self._stop = threading.Event()
 
-    # Join processes
-    streamlit_process.join()
-    bot_process.join()
+    def start_child(self, child):
+        child.heartbeat = self.context.Value('d', 0.0, lock=False)
+        child.process = self.context.Process(target=_child_main, args=(child.target, child.args, child.heartbeat),
+                                             name=child.name)
+        child.started_at = time.monotonic()
+        child.ready_at = None
+        child.failed_checks = 0
+        child.process.start()
+        print(f"[supervisor] started {child.name} (pid {child.process.pid})", flush=True)
+
+    def stop_child(self, child):
+        process, child.process = child.process, None
+        if process is None:
+            return
+        if process.is_alive():
+            process.terminate()
+            process.join(self.shutdown_timeout)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        child.last_exit = process.exitcode
+        child.ready_at = None
+
+    def check(self, child):
+        """Return None while the child is fine, otherwise why it has to be restarted."""
+        now = time.monotonic()
+        if not child.process.is_alive():
+            return f"exited with code {child.process.exitcode}"
+        if child.ready_at is None:
+            if child.is_ready():
+                child.ready_at = now
+                child.startup_seconds = now - child.started_at
+                print(f"[supervisor] {child.name} ready in {child.startup_seconds:.1f}s", flush=True)
+            elif now - child.started_at > self.startup_timeout:
+                return f"not ready after {self.startup_timeout}s"
+            return None
+        if child.heartbeat.value and time.time() - child.heartbeat.value > self.heartbeat_timeout:
+            return f"no heartbeat for {time.time() - child.heartbeat.value:.0f}s"
+        if child.health_url is not None:
+            child.failed_checks = 0 if child.is_ready() else child.failed_checks + 1
+            if child.failed_checks >= HEALTH_CHECK_FAILURES:
+                return "health check failed"
+        if now - child.started_at >= self.stable_after:
+            child.failures = 0
+        return None
+
+    def restart_later(self, child, reason):
+        self.stop_child(child)
+        delay = min(self.backoff_base * 2 ** child.failures, self.backoff_max)
+        child.failures += 1
+        child.restarts += 1
+        child.next_start = time.monotonic() + delay
+        print(f"[supervisor] {child.name} {reason}, restarting in {delay:.1f}s", flush=True)
+
+    def run(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self._stop.set())
+        try:
+            while not self._stop.is_set():
+                for child in self.children:
+                    if child.process is None:
+                        if time.monotonic() >= child.next_start:
+                            self.start_child(child)
+                        continue
+                    reason = self.check(child)
+                    if reason is not None:
+                        self.restart_later(child, reason)
+                self.write_status()
+                self._stop.wait(self.check_interval)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for child in self.children:
+            if child.process is not None:
+                child.process.terminate()
+        for child in self.children:
+            self.stop_child(child)
+        self.write_status()
+        print("[supervisor] stopped", flush=True)
+
+    def status(self):
+        return {
+            'started_at': self.started_at,
+            'uptime_seconds': time.time() - self.started_at,
+            'pid': os.getpid(),
+            'children': {child.name: {'pid': child.process.pid if child.process else None,
+                                      'alive': bool(child.process and child.process.is_alive()),
+                                      'ready': child.ready_at is not None,
+                                      'startup_seconds': child.startup_seconds,
+                                      'restarts': child.restarts,
+                                      'last_exit_code': child.last_exit}
+                         for child in self.children},
+        }
+
+    def write_status(self):
+        if not self.status_path:
+            return
+        temporary = f"{self.status_path}.tmp"
+        with open(temporary, 'w') as file:
+            json.dump(self.status(), file, indent=2)
+        os.replace(temporary, self.status_path)
+
+
+def main():
+    settings = load_settings('settings.txt')
+    status_path = settings.get_optional('SUPERVISOR_STATUS_PATH')
+    if sys.argv[1:] == ['status']:
+        if not status_path or not os.path.exists(status_path):
+            sys.exit("No supervisor status found (is SUPERVISOR_STATUS_PATH set and the supervisor running?)")
+        with open(status_path) as file:
+            print(file.read())
+        return
+    port = settings.get_int('STREAMLIT_PORT', 8501)
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_app.py")
+    children = [
+        Child('bot', 'run_bot:run_bot'),
+        Child('streamlit', 'main:run_streamlit', (app_path, port),
+              health_url=f"http://127.0.0.1:{port}/_stcore/health"),
+    ]
+    children += [Child(f'job_runner_{number}', 'main:run_job_runner')
+                 for number in range(1, settings.get_int('SUPERVISED_JOB_RUNNERS') + 1)]
+    Supervisor(children, status_path=status_path).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import bisect
+import functools
+import math
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 16384, 131072, 1048576, 8388608, 67108864, 536870912)
+_SAMPLE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})?\s+(\S+)')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        """A monotonically increasing count, one per combination of label values."""
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> count
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                  for labels, value in values]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        Observations counted into cumulative buckets (rendered with le labels), with their count and sum.
+
+        :param buckets: Sorted upper bounds; +Inf is added.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the seconds spent in the with block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(labels, list(counts)) for labels, counts in self._values.items()]
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound if bound == math.inf else float(bound)) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        Metrics of this process, rendered in the Prometheus text format.
+
+        Hot paths update Counters and Histograms (a dictionary update under a lock). The get_stats()
+        dictionaries of the shared pools and caches are registered as collectors and only read when the
+        metrics are rendered, so they cost nothing between two scrapes.
+        """
+        self._lock = threading.Lock()
+        self._metrics = {}  # name -> Counter or Histogram
+        self._collectors = {}  # prefix -> (get_stats, documentation)
+        self._server = None
+        self._server_address = None
+
+    def _register(self, metric):
+        with self._lock:
+            # Modules re-executed by Streamlit reruns get the metric registered the first time
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_stats(self, prefix, get_stats, documentation=""):
+        """Expose the numeric values of get_stats() as <prefix>_<key> samples (replacing an earlier prefix)."""
+        with self._lock:
+            self._collectors[prefix] = (get_stats, documentation)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors.items())
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for prefix, (get_stats, documentation) in collectors:
+            try:
+                stats = get_stats()
+            except Exception as e:  # A failing collector must not break the whole scrape
+                lines.append(f"# {prefix}: {type(e).__name__}: {e}".replace("\n", " "))
+                continue
+            for key, value in stats.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                name = re.sub(r'\W', '_', f"{prefix}_{key}")
+                lines += [f"# HELP {name} {documentation or prefix} ({key})", f"# TYPE {name} gauge",
+                          f"{name} {_format_value(value)}"]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve the metrics at http://host:port/metrics from a daemon thread; later calls are ignored.
+
+        A port that is already taken (e.g. by a second Streamlit app) is reported once and left alone.
+        """
+        with self._lock:
+            if self._server_address is not None:
+                return self._server
+            self._server_address = (host, port)
+            registry = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/metrics', '/'):
+                        self.send_error(404)
+                        return
+                    body = registry.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass  # Scrapes every few seconds would flood the output
+
+            try:
+                self._server = ThreadingHTTPServer((host, port), Handler)
+            except OSError as e:
+                print(f"[metrics] cannot serve on {host}:{port}: {e}", flush=True)
+                return None
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+            return self._server
+
+
+def observed(histogram, errors=None):
+    """Decorator observing the seconds of every call in a histogram labelled with the function name."""
+    def decorate(function):
+        name = function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorate
+
+
+def parse_metrics(text):
+    """Parse the Prometheus text format into a list of (name, labels dict, value)."""
+    samples = []
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if match is None or line.startswith('#'):
+            continue
+        name, labels, value = match.groups()
+        labels = {key: re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+                  for key, value in _LABEL.findall(labels or '')}
+        samples.append((name, labels, float(value)))
+    return samples
+
+
+def fetch_metrics(url, timeout=5):
+    """Samples of another process's metrics endpoint (e.g. the bot's, for the Streamlit dashboard)."""
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return parse_metrics(response.read().decode('utf-8'))
+
+
+def histogram_summary(samples):
+    """
+    Count, mean and approximate quantiles of every histogram series in parsed samples.
+
+    :return: A list of (name, labels dict, count, mean, p50, p95, p99); quantiles are bucket upper bounds.
+    """
+    series = {}
+    for name, labels, value in samples:
+        if not name.endswith(('_bucket', '_sum', '_count')):
+            continue
+        base, _, suffix = name.rpartition('_')
+        key = (base, tuple(sorted((k, v) for k, v in labels.items() if k != 'le')))
+        entry = series.setdefault(key, {'buckets': [], 'sum': 0.0, 'count': 0.0})
+        if suffix == 'bucket':
+            entry['buckets'].append((float(labels['le']), value))
+        else:
+            entry[suffix] = value
+    summary = []
+    for (name, labels), entry in series.items():
+        if not entry['buckets']:
+            continue  # A counter that happens to end in _count
+        buckets = sorted(entry['buckets'])
+        count = entry['count']
+
+        def quantile(q):
+            for bound, cumulative in buckets:
+                if count and cumulative >= q * count:
+                    return bound
+            return None
+
+        summary.append((name, dict(labels), int(count), entry['sum'] / count if count else None,
+                        quantile(0.5), quantile(0.95), quantile(0.99)))
+    return summary
+
+
+# Shared by every module of this process; exposed on METRICS_PORT by the bot and METRICS_STREAMLIT_PORT by Streamlit
+metrics = MetricsRegistry()
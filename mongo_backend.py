@@ -0,0 +1,410 @@
+import json
+import re
+import threading
+from datetime import datetime
+from mongosh_pool import mongosh_pool
+
+DEFAULT_MONGO_URI = 'mongodb://localhost:27017'
+MAX_MESSAGE_DOCUMENTS = 1000
+
+READ_METHODS = {'find', 'findOne', 'countDocuments', 'estimatedDocumentCount', 'aggregate', 'distinct'}
+WRITE_METHODS = {'insertOne', 'insertMany', 'updateOne', 'updateMany', 'replaceOne', 'deleteOne', 'deleteMany',
+                 'drop'}
+# Methods that may be chained after each cursor method; toArray and pretty change nothing because results are
+# always returned as a list of indented documents
+CURSOR_MODIFIERS = {'find': {'limit', 'skip', 'sort', 'batchSize', 'count', 'toArray', 'pretty'},
+                    'aggregate': {'batchSize', 'toArray', 'pretty'}}
+
+
+def clean_output(output):
+    """Remove escape characters from mongosh output and put the prompt back on the last line."""
+    cleaned_output = re.sub(r'\x1B[@-_][0-?]*[ -/]*[@-~]', '', output)
+    cleaned_output_lines = cleaned_output.splitlines()
+    if cleaned_output_lines:
+        cleaned_output_lines[-1] += ' >'
+    return '\n'.join(cleaned_output_lines)
+
+
+class MongoCommand:
+    """A parsed shell command: show dbs/collections, use <db> or db.<collection>.<method>(...) with modifiers."""
+    __slots__ = ('kind', 'database', 'collection', 'method', 'args', 'modifiers')
+
+    def __init__(self, kind, database=None, collection=None, method=None, args=(), modifiers=()):
+        self.kind = kind
+        self.database = database
+        self.collection = collection
+        self.method = method
+        self.args = list(args)
+        self.modifiers = list(modifiers)  # (name, args) pairs chained after the method call
+
+    @property
+    def is_write(self):
+        if self.kind != 'collection':
+            return False
+        if self.method in WRITE_METHODS:
+            return True
+        # $out and $merge stages write the aggregation result into a collection
+        return self.method == 'aggregate' and any(
+            isinstance(stage, dict) and ('$out' in stage or '$merge' in stage) for stage in (self.args or [[]])[0])
+
+
+class CommandParseError(ValueError):
+    pass
+
+
+class _LiteralParser:
+    """Parses the JavaScript object literals accepted by the shell (unquoted keys, single quotes, ObjectId(...))."""
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def error(self, message):
+        raise CommandParseError(f"{message} at position {self.pos}: {self.text[self.pos:self.pos + 20]!r}")
+
+    def skip_ws(self):
+        while self.pos < len(self.text) and self.text[self.pos].isspace():
+            self.pos += 1
+
+    def peek(self):
+        self.skip_ws()
+        return self.text[self.pos] if self.pos < len(self.text) else ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            self.error(f"Expected {char!r}")
+        self.pos += 1
+
+    def identifier(self):
+        self.skip_ws()
+        match = re.compile(r'[A-Za-z_$][\w$]*').match(self.text, self.pos)
+        if not match:
+            self.error("Expected a name")
+        self.pos = match.end()
+        return match.group()
+
+    def value(self):
+        char = self.peek()
+        if char == '{':
+            return self.object()
+        if char == '[':
+            return self.array()
+        if char in '"\'':
+            return self.string()
+        if char == '-' or char.isdigit():
+            return self.number()
+        if char == '/':
+            return self.regex()
+        name = self.identifier()
+        if name == 'new':
+            name = self.identifier()
+        literals = {'true': True, 'false': False, 'null': None, 'undefined': None}
+        if name in literals:
+            return literals[name]
+        if self.peek() == '(':
+            return self.constructor(name, self.arguments())
+        self.error(f"Unknown value {name!r}")
+
+    def object(self):
+        self.expect('{')
+        result = {}
+        while self.peek() != '}':
+            key = self.string() if self.peek() in '"\'' else self.identifier()
+            self.expect(':')
+            result[key] = self.value()
+            if self.peek() == ',':
+                self.pos += 1
+        self.expect('}')
+        return result
+
+    def array(self):
+        self.expect('[')
+        result = []
+        while self.peek() != ']':
+            result.append(self.value())
+            if self.peek() == ',':
+                self.pos += 1
+        self.expect(']')
+        return result
+
+    def string(self):
+        quote = self.peek()
+        self.pos += 1
+        chars = []
+        while self.pos < len(self.text) and self.text[self.pos] != quote:
+            if self.text[self.pos] == '\\':
+                self.pos += 1
+            chars.append(self.text[self.pos])
+            self.pos += 1
+        self.expect(quote)
+        return ''.join(chars)
+
+    def number(self):
+        match = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?').match(self.text, self.pos)
+        if not match:
+            self.error("Expected a number")
+        self.pos = match.end()
+        return float(match.group()) if match.group(1) or match.group(2) else int(match.group())
+
+    def regex(self):
+        match = re.compile(r'/((?:\\.|[^/\\])*)/([imsx]*)').match(self.text, self.pos)
+        if not match:
+            self.error("Expected a regular expression")
+        self.pos = match.end()
+        result = {'$regex': match.group(1)}
+        if match.group(2):
+            result['$options'] = match.group(2)
+        return result
+
+    def arguments(self):
+        self.expect('(')
+        args = []
+        while self.peek() != ')':
+            args.append(self.value())
+            if self.peek() == ',':
+                self.pos += 1
+        self.expect(')')
+        return args
+
+    @staticmethod
+    def constructor(name, args):
+        if name == 'ObjectId':
+            try:
+                from bson import ObjectId
+                return ObjectId(*args)
+            except ImportError:
+                return args[0] if args else None
+        if name in ('ISODate', 'Date'):
+            return datetime.fromisoformat(args[0].replace('Z', '+00:00')) if args else datetime.now()
+        if name in ('NumberInt', 'NumberLong', 'Int32', 'Long'):
+            return int(args[0])
+        if name in ('NumberDecimal', 'Decimal128', 'Double'):
+            return float(args[0])
+        raise CommandParseError(f"Unsupported constructor {name}()")
+
+
+def parse_command(text):
+    """Parse the subset of mongosh commands the driver backend can execute."""
+    text = text.strip().rstrip(';').strip()
+    words = text.split()
+    if words in (['show', 'dbs'], ['show', 'databases']):
+        return MongoCommand('show_dbs')
+    if words == ['show', 'collections'] or text == 'db.getCollectionNames()':
+        return MongoCommand('show_collections')
+    if len(words) == 2 and words[0] == 'use':
+        return MongoCommand('use', database=words[1])
+
+    parser = _LiteralParser(text)
+    if parser.identifier() != 'db':
+        raise CommandParseError(f"Unsupported command: {text}")
+    names = []
+    while parser.peek() == '.':
+        parser.pos += 1
+        names.append(parser.identifier())
+        if parser.peek() == '(':
+            break
+    if len(names) < 2 or parser.peek() != '(':
+        raise CommandParseError(f"Expected db.<collection>.<method>(...): {text}")
+    method = names[-1]
+    if method not in READ_METHODS | WRITE_METHODS:
+        raise CommandParseError(f"Unsupported method {method}()")
+    args = parser.arguments()
+    modifiers = []
+    while parser.peek() == '.':
+        parser.pos += 1
+        name = parser.identifier()
+        if name not in CURSOR_MODIFIERS.get(method, ()):
+            raise CommandParseError(f"Unsupported method {name}() after {method}()")
+        modifier_args = parser.arguments()
+        if name in ('limit', 'skip', 'batchSize'):
+            valid = len(modifier_args) == 1 and isinstance(modifier_args[0], int) and modifier_args[0] >= 0
+        elif name == 'sort':
+            valid = len(modifier_args) == 1 and isinstance(modifier_args[0], dict)
+        else:
+            valid = not modifier_args
+        if not valid:
+            raise CommandParseError(f"Invalid arguments for {name}()")
+        modifiers.append((name, modifier_args))
+    if parser.peek():
+        parser.error("Unexpected text")
+    return MongoCommand('collection', collection='.'.join(names[:-1]), method=method, args=args, modifiers=modifiers)
+
+
+def format_documents(documents, truncated=False):
+    lines = [json.dumps(document, default=str, ensure_ascii=False, indent=2) for document in documents]
+    if truncated:
+        lines.append(f"... output truncated after {len(lines)} documents")
+    return '\n'.join(lines) if lines else '(no documents)'
+
+
+class MongoshBackend:
+    """Executes commands as text in a pooled mongosh shell (the original behaviour)."""
+
+    def __init__(self, pool=None):
+        self.pool = pool or mongosh_pool
+
+    def run(self, key, command, read_only=False):
+        # Read-only users are limited by MONGOSH_ALLOWED_COMMANDS before reaching the shell
+        return clean_output(self.pool.run(key, command))
+
+    def interrupt(self, key):
+        self.pool.interrupt(key)
+
+    def release(self, key):
+        self.pool.release(key)
+
+    def close_all(self):
+        self.pool.close_all()
+
+    def get_stats(self):
+        return self.pool.get_stats()
+
+
+class DriverBackend:
+    def __init__(self, uri=DEFAULT_MONGO_URI, client=None, default_database='test', batch_size=100,
+                 max_documents=MAX_MESSAGE_DOCUMENTS, max_pool_size=10, command_timeout=30):
+        """
+        Executes parsed shell commands through a pymongo client instead of scraping mongosh output.
+
+        The client keeps its own connection pool shared by all chats; only the current database of each
+        chat is tracked here. Cursors are read in batches of batch_size and stop after max_documents.
+
+        :param uri: MongoDB connection string, used when no client is given.
+        :param client: Any object with the pymongo MongoClient API (e.g. an in-process stand-in for tests).
+        :param default_database: Database selected before the first `use`.
+        :param batch_size: Documents fetched per round trip.
+        :param max_documents: Maximum documents returned for one command.
+        :param max_pool_size: Size of pymongo's connection pool.
+        :param command_timeout: Seconds a command may run on the server.
+        """
+        self.uri = uri
+        self._client = client
+        self.default_database = default_database
+        self.batch_size = batch_size
+        self.max_documents = max_documents
+        self.max_pool_size = max_pool_size
+        self.command_timeout = command_timeout
+        self._lock = threading.Lock()
+        self._databases = {}  # key -> current database name
+        self._cursors = {}  # key -> cursor being read
+        self.stats = {'commands': 0, 'documents': 0, 'errors': 0}
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                import pymongo
+                self._client = pymongo.MongoClient(self.uri, maxPoolSize=self.max_pool_size,
+                                                   serverSelectionTimeoutMS=5000)
+            return self._client
+
+    def execute(self, key, text, read_only=False):
+        """
+        Run a command and return its result: a list of names, a scalar, a status dict, or a generator of
+        documents for cursors. Writes raise PermissionError when read_only is set.
+        """
+        command = parse_command(text)
+        if read_only and command.is_write:
+            raise PermissionError("Only read-only commands are allowed.")
+        self.stats['commands'] += 1
+        if command.kind == 'show_dbs':
+            return self.client.list_database_names()
+        if command.kind == 'use':
+            self._databases[key] = command.database
+            return f"switched to db {command.database}"
+        database = self.client[self._databases.get(key, self.default_database)]
+        if command.kind == 'show_collections':
+            return sorted(database.list_collection_names())
+        return self._execute_collection(key, database[command.collection], command)
+
+    def _execute_collection(self, key, collection, command):
+        method, args = command.method, command.args
+        modifiers = dict(command.modifiers)
+        max_time_ms = int(self.command_timeout * 1000)
+        batch_size = modifiers['batchSize'][0] if 'batchSize' in modifiers else self.batch_size
+        if method == 'find':
+            if 'count' in modifiers:
+                return collection.count_documents(args[0] if args else {}, maxTimeMS=max_time_ms)
+            cursor = collection.find(*args[:2]).max_time_ms(max_time_ms)
+            for name, modifier_args in command.modifiers:
+                if name == 'sort':
+                    cursor = cursor.sort(list(modifier_args[0].items()))
+                elif name == 'skip':
+                    cursor = cursor.skip(modifier_args[0])
+                elif name == 'limit':
+                    cursor = cursor.limit(modifier_args[0])
+            cursor = cursor.batch_size(batch_size)
+            return self._stream(key, cursor)
+        if method == 'findOne':
+            return collection.find_one(*args[:2], max_time_ms=max_time_ms)
+        if method == 'countDocuments':
+            return collection.count_documents(args[0] if args else {}, maxTimeMS=max_time_ms)
+        if method == 'estimatedDocumentCount':
+            return collection.estimated_document_count(maxTimeMS=max_time_ms)
+        if method == 'distinct':
+            return collection.distinct(*args[:2], maxTimeMS=max_time_ms)
+        if method == 'aggregate':
+            cursor = collection.aggregate(args[0] if args else [], batchSize=batch_size, maxTimeMS=max_time_ms)
+            return self._stream(key, cursor)
+        if method == 'drop':
+            collection.drop()
+            return True
+        # insertOne -> insert_one, deleteMany -> delete_many, ...
+        result = getattr(collection, re.sub(r'([A-Z])', r'_\1', method).lower())(*args)
+        return {name: getattr(result, name) for name in
+                ('acknowledged', 'inserted_id', 'inserted_ids', 'matched_count', 'modified_count', 'deleted_count')
+                if hasattr(result, name)}
+
+    def _stream(self, key, cursor):
+        """Yield documents from a cursor, at most max_documents + 1; the extra one means the result was cut off."""
+        self._cursors[key] = cursor
+        try:
+            for count, document in enumerate(cursor):
+                if count > self.max_documents:
+                    break
+                self.stats['documents'] += 1
+                yield document
+        finally:
+            self._cursors.pop(key, None)
+            cursor.close()
+
+    def run(self, key, text, read_only=False):
+        """Execute a command and format the result as text for the chat and Streamlit front ends."""
+        try:
+            result = self.execute(key, text, read_only=read_only)
+            if hasattr(result, '__next__'):
+                documents = list(result)
+                return format_documents(documents[:self.max_documents], truncated=len(documents) > self.max_documents)
+            if isinstance(result, list):
+                return '\n'.join(str(item) for item in result)
+            if isinstance(result, dict):
+                return format_documents([result])
+            return 'null' if result is None else str(result)
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+
+    def interrupt(self, key):
+        cursor = self._cursors.get(key)
+        if cursor is not None:
+            cursor.close()
+
+    def release(self, key):
+        self._databases.pop(key, None)
+        self.interrupt(key)
+
+    def close_all(self):
+        if self._client is not None:
+            self._client.close()
+
+    def get_stats(self):
+        return dict(self.stats, sessions=len(self._databases))
+
+
+def create_backend(kind='mongosh', uri=DEFAULT_MONGO_URI):
+    """Build the MongoDB backend selected in settings.txt (MONGO_BACKEND = mongosh or driver)."""
+    if kind == 'driver':
+        return DriverBackend(uri=uri)
+    if kind == 'mongosh':
+        return MongoshBackend()
+    raise ValueError(f"Unknown MongoDB backend: {kind}")
@@ -0,0 +1,249 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from lazy_imports import LazyModule
+from metrics import metrics
+
+pexpect = LazyModule('pexpect')
+
+MONGOSH_COMMAND = 'mongosh'  # Connects to localhost by default, add a connection string here to change it
+PROMPT = '>'
+
+COMMAND_SECONDS = metrics.histogram('mongosh_command_seconds', "Round trip of a command through a mongosh shell")
+COMMAND_ERRORS = metrics.counter('mongosh_command_errors_total', "mongosh round trips that failed", ['error'])
+SPAWN_SECONDS = metrics.histogram('mongosh_spawn_seconds', "Time until a new mongosh shell shows its prompt")
+
+
+class _Shell:
+    __slots__ = ('process', 'started_at', 'last_used', 'busy')
+
+    def __init__(self, process):
+        self.process = process
+        self.started_at = time.monotonic()
+        self.last_used = self.started_at
+        self.busy = False
+
+
+class MongoshPool:
+    def __init__(self, command=MONGOSH_COMMAND, prewarm=1, max_processes=10, idle_timeout=600,
+                 startup_timeout=30, command_timeout=30, reap_interval=30):
+        """
+        Manages the mongosh processes used by the bot and the Streamlit app.
+
+        Each chat (or Streamlit session) gets its own shell, so `use <db>` does not leak between users.
+        A few shells are started ahead of time to hide mongosh's startup latency, the total number of
+        processes is capped (the least recently used idle shell is closed to make room), shells idle for
+        longer than idle_timeout are reaped and shells that died are restarted on next use.
+
+        :param command: Command line used to start a shell.
+        :param prewarm: Number of spare shells kept started.
+        :param max_processes: Maximum number of live mongosh processes, spares included.
+        :param idle_timeout: Seconds after which an unused shell is closed.
+        :param startup_timeout: Seconds to wait for the first prompt of a new shell.
+        :param command_timeout: Seconds to wait for the prompt after a command.
+        :param reap_interval: Seconds between background reaping and prewarming passes.
+        """
+        self.command = command
+        self.prewarm = prewarm
+        self.max_processes = max_processes
+        self.idle_timeout = idle_timeout
+        self.startup_timeout = startup_timeout
+        self.command_timeout = command_timeout
+        self.reap_interval = reap_interval
+        self._lock = threading.RLock()
+        self._shells = OrderedDict()  # key -> _Shell, least recently used first
+        self._spares = []
+        self._starting = 0
+        self._maintenance = None
+        self._stopped = threading.Event()
+        self.stats = {'started': 0, 'restarts': 0, 'evictions': 0, 'reaped': 0, 'startup_time_total': 0.0,
+                      'startup_time_last': 0.0, 'commands': 0}
+
+    def _spawn(self):
+        started = time.monotonic()
+        process = pexpect.spawn(self.command, encoding='utf-8')
+        try:
+            process.expect(PROMPT, timeout=self.startup_timeout)  # Wait for the prompt
+        except (pexpect.TIMEOUT, pexpect.EOF):
+            process.close(force=True)
+            raise RuntimeError("mongosh did not start.")
+        elapsed = time.monotonic() - started
+        SPAWN_SECONDS.observe(elapsed)
+        with self._lock:
+            self.stats['started'] += 1
+            self.stats['startup_time_total'] += elapsed
+            self.stats['startup_time_last'] = elapsed
+        return _Shell(process)
+
+    def _live_count(self):
+        return len(self._shells) + len(self._spares) + self._starting
+
+    def _make_room(self):
+        """Close the least recently used idle shell when the process cap is reached. Call with the lock held."""
+        if self._live_count() < self.max_processes:
+            return True
+        if self._spares:
+            self._close(self._spares.pop())
+            return True
+        for key, shell in self._shells.items():
+            if not shell.busy:
+                del self._shells[key]
+                self._close(shell)
+                self.stats['evictions'] += 1
+                return True
+        return False
+
+    @staticmethod
+    def _close(shell):
+        try:
+            shell.process.sendline('exit')
+            shell.process.close(force=True)
+        except (OSError, pexpect.ExceptionPexpect):
+            pass
+
+    def acquire(self, key):
+        """Return the shell of a key, taking a prewarmed one or starting a new one if needed."""
+        self.start()
+        with self._lock:
+            shell = self._shells.get(key)
+            if shell is not None and not shell.process.isalive():
+                del self._shells[key]
+                self.stats['restarts'] += 1
+                shell = None
+            if shell is None:
+                while self._spares and shell is None:
+                    spare = self._spares.pop()
+                    if spare.process.isalive():
+                        shell = spare
+                    else:
+                        self._close(spare)
+            if shell is None:
+                if not self._make_room():
+                    raise RuntimeError("All mongosh sessions are busy, try again later.")
+                self._starting += 1
+        if shell is None:
+            try:
+                shell = self._spawn()
+            finally:
+                with self._lock:
+                    self._starting -= 1
+        with self._lock:
+            self._shells[key] = shell
+            self._shells.move_to_end(key)
+            shell.last_used = time.monotonic()
+        return shell
+
+    def run(self, key, command):
+        """Send a command to the key's shell and return the raw text printed before the next prompt."""
+        shell = self.acquire(key)
+        shell.busy = True
+        started = time.perf_counter()
+        try:
+            shell.process.sendline(command)
+            shell.process.expect(PROMPT, timeout=self.command_timeout)  # Wait for the prompt
+            self.stats['commands'] += 1
+            COMMAND_SECONDS.observe(time.perf_counter() - started)
+            return shell.process.before
+        except pexpect.TIMEOUT:
+            COMMAND_ERRORS.inc('timeout')
+            raise
+        except pexpect.EOF:
+            COMMAND_ERRORS.inc('exited')
+            # The shell crashed; it is replaced on the next command
+            with self._lock:
+                if self._shells.get(key) is shell:
+                    del self._shells[key]
+                self.stats['restarts'] += 1
+            self._close(shell)
+            raise RuntimeError("mongosh exited unexpectedly, a new session will be started.")
+        finally:
+            shell.busy = False
+            shell.last_used = time.monotonic()
+
+    def interrupt(self, key):
+        shell = self._shells.get(key)
+        if shell is not None:
+            shell.process.sendintr()
+
+    def release(self, key):
+        """Close the shell of a key (e.g. when the user leaves the mongosh prompt)."""
+        with self._lock:
+            shell = self._shells.pop(key, None)
+        if shell is not None:
+            self._close(shell)
+
+    def reap_idle(self):
+        """Close shells that have been idle for longer than idle_timeout and replace dead spares."""
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, shell in self._shells.items()
+                    if not shell.busy and now - shell.last_used > self.idle_timeout]
+            for key in idle:
+                self._close(self._shells.pop(key))
+            self.stats['reaped'] += len(idle)
+            self._spares = [spare for spare in self._spares if spare.process.isalive()]
+        return idle
+
+    def fill_spares(self):
+        """Start shells until `prewarm` spares are available or the process cap is reached."""
+        while not self._stopped.is_set():
+            with self._lock:
+                if len(self._spares) + self._starting >= self.prewarm or self._live_count() >= self.max_processes:
+                    return
+                self._starting += 1
+            try:
+                shell = self._spawn()
+            except (RuntimeError, pexpect.ExceptionPexpect, OSError):
+                return
+            finally:
+                with self._lock:
+                    self._starting -= 1
+            with self._lock:
+                self._spares.append(shell)
+
+    def _maintain(self):
+        while not self._stopped.is_set():
+            self.reap_idle()
+            self.fill_spares()
+            self._stopped.wait(self.reap_interval)
+
+    def start(self):
+        """Start the background thread that prewarms spares and reaps idle shells."""
+        with self._lock:
+            if self._maintenance is None:
+                self._maintenance = threading.Thread(target=self._maintain, name='mongosh-pool', daemon=True)
+                self._maintenance.start()
+
+    def close_all(self):
+        self._stopped.set()
+        with self._lock:
+            shells = list(self._shells.values()) + self._spares
+            self._shells.clear()
+            self._spares = []
+        for shell in shells:
+            self._close(shell)
+
+    def get_stats(self):
+        with self._lock:
+            processes = [shell.process for shell in list(self._shells.values()) + self._spares]
+            stats = dict(self.stats)
+            stats['sessions'] = len(self._shells)
+            stats['spares'] = len(self._spares)
+        stats['live_processes'] = sum(1 for process in processes if process.isalive())
+        stats['memory_rss_bytes'] = sum(_rss_bytes(process.pid) for process in processes)
+        stats['startup_time_avg'] = stats['startup_time_total'] / stats['started'] if stats['started'] else 0.0
+        return stats
+
+
+def _rss_bytes(pid):
+    """Resident memory of a process from /proc (0 where it is unavailable)."""
+    try:
+        with open(f'/proc/{pid}/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+# Shared by the bot handlers or the Streamlit sessions of this process; started on first use
+mongosh_pool = MongoshPool()
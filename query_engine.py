@@ -0,0 +1,192 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import liveness
+from sqlite_handler import cancellation_scope
+
+BEAT_INTERVAL = 2  # Seconds between two liveness beats of the event loop
+BEAT_TIMEOUT = 30  # An event loop that has not run a callback for this long is stalled
+
+
+class _Job:
+    def __init__(self, func, args, cancel, on_timeout):
+        self.func = func
+        self.args = args
+        self.cancel_callback = cancel
+        self.on_timeout = on_timeout
+        self.cancel_event = threading.Event()
+        self.future = Future()
+
+    def run(self):
+        with cancellation_scope(self.cancel_event):
+            return self.func(*self.args)
+
+    def cancel(self):
+        self.cancel_event.set()
+        if self.cancel_callback:
+            try:
+                self.cancel_callback()
+            except Exception:
+                pass
+
+
+class QueryEngine:
+    def __init__(self, max_workers=4, query_timeout=60, max_pending_per_chat=10, idle_chat_timeout=300,
+                 cancel_grace=5):
+        """
+        Runs blocking bot work (SQL queries, exports, mongosh round trips) off the polling thread.
+
+        An asyncio event loop on a background thread keeps one queue per chat, so work of a single chat
+        runs in order while different chats run in parallel on a bounded thread pool. Each job gets a
+        timeout after which it is cancelled: SQLite statements are interrupted through the progress
+        handler installed by the connection pool, and other work through the job's cancel callback.
+        Work that ignores the cancellation (an upload to Telegram, a mongosh round trip) keeps its thread, so
+        the chat's next job only starts once the timed-out one has really returned; until then it counts
+        as running and is cancelled again every cancel_grace seconds.
+
+        :param max_workers: Number of threads executing jobs.
+        :param query_timeout: Seconds a single job may run before it is cancelled.
+        :param max_pending_per_chat: Jobs a chat may have waiting before new ones are rejected.
+        :param idle_chat_timeout: Seconds after which an idle chat's queue is dropped.
+        :param cancel_grace: Seconds between two cancellations of a timed-out job that has not returned yet.
+        """
+        self.max_workers = max_workers
+        self.query_timeout = query_timeout
+        self.max_pending_per_chat = max_pending_per_chat
+        self.idle_chat_timeout = idle_chat_timeout
+        self.cancel_grace = cancel_grace
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='query-worker')
+        self._thread = threading.Thread(target=self._run_loop, name='query-engine', daemon=True)
+        self._queues = {}  # chat_id -> asyncio.Queue of pending jobs
+        self._running = {}  # chat_id -> job currently executing
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'timeouts': 0, 'cancelled': 0,
+                      'overran': 0}
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._beat)
+        self.loop.run_forever()
+
+    def _beat(self):
+        liveness.beat('query-engine', BEAT_TIMEOUT)
+        self.loop.call_later(BEAT_INTERVAL, self._beat)
+
+    def start(self):
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def submit(self, chat_id, func, *args, cancel=None, on_timeout=None):
+        """
+        Queue func(*args) behind earlier work of the same chat.
+
+        :param cancel: Optional callable invoked when the job is cancelled or times out.
+        :param on_timeout: Optional callable invoked (on a worker thread) after the job timed out.
+        :return: A concurrent.futures.Future with the result of func.
+        """
+        job = _Job(func, args, cancel, on_timeout)
+        self.loop.call_soon_threadsafe(self._enqueue, chat_id, job)
+        return job.future
+
+    def _enqueue(self, chat_id, job):
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue(maxsize=self.max_pending_per_chat)
+            self.loop.create_task(self._chat_worker(chat_id, queue))
+        try:
+            queue.put_nowait(job)
+            self.stats['submitted'] += 1
+        except asyncio.QueueFull:
+            self.stats['rejected'] += 1
+            job.future.set_exception(RuntimeError("Too many pending queries, wait for the previous ones to finish."))
+
+    async def _chat_worker(self, chat_id, queue):
+        while True:
+            try:
+                job = await asyncio.wait_for(queue.get(), self.idle_chat_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self._queues[chat_id]
+                    return
+                continue
+            if not job.future.set_running_or_notify_cancel():
+                continue  # Cancelled while waiting in the queue
+            self._running[chat_id] = job
+            running = self.loop.run_in_executor(self.executor, job.run)
+            try:
+                # Shielded: the timeout must not detach the job from its thread, which keeps running
+                result = await asyncio.wait_for(asyncio.shield(running), self.query_timeout)
+                job.future.set_result(result)
+                self.stats['completed'] += 1
+            except asyncio.TimeoutError:
+                self.stats['timeouts'] += 1
+                job.cancel()
+                job.future.set_exception(TimeoutError(f"Query exceeded {self.query_timeout}s and was cancelled."))
+                if job.on_timeout:
+                    self.loop.run_in_executor(self.executor, job.on_timeout)
+                await self._wait_returned(job, running)
+            except Exception as e:
+                self.stats['failed'] += 1
+                job.future.set_exception(e)
+            finally:
+                self._running.pop(chat_id, None)
+
+    async def _wait_returned(self, job, running):
+        """Wait until a cancelled job's thread returns, cancelling it again every cancel_grace seconds."""
+        overran = False
+        while True:
+            try:
+                await asyncio.wait_for(asyncio.shield(running), self.cancel_grace)
+                return
+            except asyncio.TimeoutError:
+                if not overran:
+                    overran = True
+                    self.stats['overran'] += 1
+                job.cancel()
+            except Exception:
+                return  # The job failed after its timeout; its future already holds the TimeoutError
+
+    def cancel(self, chat_id):
+        """Cancel the running job of a chat and drop its pending jobs. Returns True if anything was cancelled."""
+        done = Future()
+
+        def cancel_in_loop():
+            cancelled = False
+            queue = self._queues.get(chat_id)
+            while queue is not None and not queue.empty():
+                queue.get_nowait().future.cancel()
+                cancelled = True
+            job = self._running.get(chat_id)
+            if job is not None:
+                job.cancel()
+                cancelled = True
+            if cancelled:
+                self.stats['cancelled'] += 1
+            done.set_result(cancelled)
+
+        self.loop.call_soon_threadsafe(cancel_in_loop)
+        return done.result(timeout=5)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['running'] = len(self._running)
+        stats['queued'] = sum(queue.qsize() for queue in list(self._queues.values()))
+        stats['workers'] = self.max_workers
+        return stats
+
+    async def _stop_workers(self):
+        tasks = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        liveness.stopped('query-engine')
+        self.loop.stop()
+
+    def shutdown(self):
+        """Cancel running jobs, stop the chat workers and the event loop."""
+        for chat_id in list(self._running):
+            self.cancel(chat_id)
+        if self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self._stop_workers(), self.loop)
+            self._thread.join(timeout=5)
+        self.executor.shutdown(wait=False, cancel_futures=True)
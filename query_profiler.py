@@ -0,0 +1,211 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from metrics import metrics, SIZE_BUCKETS
+
+SLOW_QUERY_SECONDS = 1.0
+PERCENTILES = (50, 95, 99)
+MAX_WORKLOAD_QUERIES = 500  # Distinct read statements remembered per database
+
+OPERATION_SECONDS = metrics.histogram('sqlite_operation_seconds', "Wall time of SQLViewer operations", ['operation'])
+OPERATION_ERRORS = metrics.counter('sqlite_operation_errors_total', "SQLViewer operations that raised", ['operation'])
+OPERATION_ROWS = metrics.counter('sqlite_rows_total', "Rows returned or exported by SQLViewer operations",
+                                 ['operation'])
+OPERATION_BYTES = metrics.histogram('sqlite_result_bytes', "Size of SQLViewer results and exports", ['operation'],
+                                    buckets=SIZE_BUCKETS)
+
+
+class Measurement:
+    """Filled in by the profiled code: how many rows and bytes the statement produced."""
+    __slots__ = ('rows', 'bytes')
+
+    def __init__(self):
+        self.rows = None
+        self.bytes = None
+
+
+class QueryProfiler:
+    def __init__(self, log_path=None, slow_threshold=SLOW_QUERY_SECONDS, max_records=10000, window=2000):
+        """
+        Records the wall time, rows and bytes of SQLViewer calls and keeps a log of slow statements.
+
+        Latencies of the last `window` calls per operation are kept in memory for percentiles. Statements
+        slower than slow_threshold are stored with their EXPLAIN QUERY PLAN, in a SQLite table when log_path
+        is set (shared by the bot and Streamlit processes, rotated to max_records rows) or in memory otherwise.
+
+        :param log_path: Optional SQLite file for the slow-query log.
+        :param slow_threshold: Seconds from which a statement is logged as slow.
+        :param max_records: Maximum number of slow statements kept.
+        :param window: Number of recent latencies per operation used for percentiles.
+        """
+        self.max_records = max_records
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = {}  # operation -> deque of seconds
+        self._counts = {}  # operation -> calls since start
+        self._slow = deque(maxlen=max_records)
+        self._workload = {}  # database path -> OrderedDict of query -> [calls, total seconds]
+        self._connection = None
+        self._inserted = 0
+        self.log_path = None
+        self.configure(log_path, slow_threshold)
+
+    def configure(self, log_path=None, slow_threshold=SLOW_QUERY_SECONDS):
+        with self._lock:
+            self.slow_threshold = slow_threshold
+            if log_path == self.log_path:
+                return
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            self.log_path = log_path
+            if log_path:
+                self._connection = sqlite3.connect(log_path, check_same_thread=False)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute("PRAGMA busy_timeout=5000")
+                self._connection.execute("CREATE TABLE IF NOT EXISTS slow_queries (id INTEGER PRIMARY KEY, "
+                                         "recorded_at REAL, database TEXT, operation TEXT, query TEXT, "
+                                         "duration REAL, rows INTEGER, bytes INTEGER, plan TEXT, pid INTEGER)")
+                self._connection.commit()
+
+    @contextmanager
+    def measure(self, viewer, operation, query):
+        """Time the with block; statements that fail are not recorded."""
+        measurement = Measurement()
+        started = time.perf_counter()
+        try:
+            yield measurement
+        except Exception:
+            OPERATION_ERRORS.inc(operation)
+            raise
+        self.record(viewer, operation, query, time.perf_counter() - started, measurement)
+
+    def record(self, viewer, operation, query, duration, measurement):
+        OPERATION_SECONDS.observe(duration, operation)
+        if measurement.rows:
+            OPERATION_ROWS.inc(operation, amount=measurement.rows)
+        if measurement.bytes is not None:
+            OPERATION_BYTES.observe(measurement.bytes, operation)
+        with self._lock:
+            latencies = self._latencies.get(operation)
+            if latencies is None:
+                latencies = self._latencies[operation] = deque(maxlen=self.window)
+            latencies.append(duration)
+            self._counts[operation] = self._counts.get(operation, 0) + 1
+            if operation != 'executor':
+                self._add_to_workload(os.path.abspath(viewer.database_name), " ".join(query.split()), duration)
+        if duration >= self.slow_threshold:
+            self._log_slow(viewer, operation, query, duration, measurement)
+
+    def _add_to_workload(self, path, query, duration):
+        queries = self._workload.setdefault(path, OrderedDict())
+        entry = queries.pop(query, None) or [0, 0.0]
+        entry[0] += 1
+        entry[1] += duration
+        queries[query] = entry
+        if len(queries) > MAX_WORKLOAD_QUERIES:
+            del queries[next(iter(queries))]  # Least recently run
+
+    def workload(self, database_name):
+        """
+        Read statements run on a database: those seen by this process plus the slow log of every process.
+
+        :return: A list of (query, calls, total_seconds), most expensive first.
+        """
+        with self._lock:
+            workload = {query: list(entry) for query, entry in
+                        self._workload.get(os.path.abspath(database_name), {}).items()}
+            logged = []
+            if self._connection is not None:
+                logged = self._connection.execute(
+                    "SELECT query, count(*), sum(duration) FROM slow_queries WHERE database = ? AND operation != "
+                    "'executor' GROUP BY query", (os.path.basename(database_name),)).fetchall()
+        for query, calls, total in logged:
+            query = " ".join(query.split())
+            if query not in workload:
+                workload[query] = [calls, total]
+        return sorted(((query, calls, total) for query, (calls, total) in workload.items()),
+                      key=lambda item: item[2], reverse=True)
+
+    def _log_slow(self, viewer, operation, query, duration, measurement):
+        plan = explain_query_plan(viewer, query)
+        record = (time.time(), os.path.basename(viewer.database_name), operation, query, duration,
+                  measurement.rows, measurement.bytes, plan, os.getpid())
+        with self._lock:
+            if self._connection is None:
+                self._slow.append(record)
+                return
+            try:
+                self._connection.execute("INSERT INTO slow_queries (recorded_at, database, operation, query, "
+                                         "duration, rows, bytes, plan, pid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                         record)
+                self._inserted += 1
+                if self._inserted % 100 == 0:
+                    self._connection.execute("DELETE FROM slow_queries WHERE id <= "
+                                             "(SELECT max(id) FROM slow_queries) - ?", (self.max_records,))
+                self._connection.commit()
+            except sqlite3.Error:
+                self._connection.rollback()
+                self._slow.append(record)  # The log file is busy or gone, keep the record in memory
+
+    def percentiles(self):
+        """Return {operation: {'calls', 'p50', 'p95', 'p99', 'max'}} over the recent window, in seconds."""
+        with self._lock:
+            snapshot = {operation: (sorted(latencies), self._counts[operation])
+                        for operation, latencies in self._latencies.items()}
+        result = {}
+        for operation, (latencies, calls) in sorted(snapshot.items()):
+            stats = {'calls': calls}
+            for percentile in PERCENTILES:
+                stats[f'p{percentile}'] = latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+            stats['max'] = latencies[-1]
+            result[operation] = stats
+        return result
+
+    def slowest(self, limit=10, since=None):
+        """
+        Return the slowest logged statements, slowest first.
+
+        :return: A list of dicts with recorded_at, database, operation, query, duration, rows, bytes and plan.
+        """
+        columns = ('recorded_at', 'database', 'operation', 'query', 'duration', 'rows', 'bytes', 'plan')
+        with self._lock:
+            records = [record[:len(columns)] for record in self._slow]
+            if self._connection is not None:
+                records += self._connection.execute(
+                    f"SELECT {', '.join(columns)} FROM slow_queries WHERE recorded_at >= ? "
+                    f"ORDER BY duration DESC LIMIT ?", (since or 0, limit)).fetchall()
+        records = [record for record in records if since is None or record[0] >= since]
+        records.sort(key=lambda record: record[4], reverse=True)
+        return [dict(zip(columns, record)) for record in records[:limit]]
+
+    def get_stats(self):
+        with self._lock:
+            return {'operations': dict(self._counts), 'slow_in_memory': len(self._slow),
+                    'slow_threshold': self.slow_threshold, 'log_path': self.log_path}
+
+
+def explain_query_plan(viewer, query):
+    """EXPLAIN QUERY PLAN of a statement as indented text, or None when it cannot be explained."""
+    try:
+        with viewer.connection() as connection:
+            rows = connection.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+    except (sqlite3.Error, RuntimeError):
+        return None
+    depth = {0: 0}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, 0) + 1
+        lines.append("  " * (depth[node_id] - 1) + detail)
+    return "\n".join(lines)
+
+
+def format_duration(seconds):
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.2f} s"
+
+
+# Shared by every SQLViewer in the process
+query_profiler = QueryProfiler()
@@ -0,0 +1,187 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from lazy_imports import LazyModule, loaded
+from metrics import metrics
+
+pd = LazyModule('pandas')
+pa = LazyModule('pyarrow')
+
+MIN_COMPUTE_SECONDS = 0.1  # Cheaper results are recomputed rather than written to disk
+TOUCH_INTERVAL = 60  # Seconds between two last_used updates of the same entry
+
+
+class SharedResultStore:
+    def __init__(self, directory=None, max_bytes=512 * 1024 * 1024, ttl=3600, min_compute_seconds=MIN_COMPUTE_SECONDS):
+        """
+        Query results shared between processes through a cache directory with a SQLite index.
+
+        Results are stored under a hash of the ResultCache key (database path, normalized query, database file
+        version and operation), so a result computed by the bot is found by Streamlit and the other way round,
+        and a write to the database makes the old entries unreachable. Arrow tables and DataFrames are stored
+        as Arrow IPC files and memory-mapped when read; other results are pickled. The least recently used
+        entries are evicted once the files exceed max_bytes.
+
+        :param directory: Cache directory; the store is disabled while it is None.
+        :param max_bytes: Size budget of the stored files.
+        :param ttl: Seconds after which an entry is no longer used.
+        :param min_compute_seconds: Results computed faster than this are not stored.
+        """
+        self._lock = threading.Lock()
+        self._connection = None
+        self.directory = None
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0, 'errors': 0}
+        self.configure(directory, max_bytes, ttl, min_compute_seconds)
+
+    def configure(self, directory=None, max_bytes=512 * 1024 * 1024, ttl=3600,
+                  min_compute_seconds=MIN_COMPUTE_SECONDS):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            self.min_compute_seconds = min_compute_seconds
+            directory = os.path.abspath(directory) if directory else None
+            if directory == self.directory:
+                return
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            self.directory = directory
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                self._connection = sqlite3.connect(os.path.join(directory, "index.db"), timeout=5,
+                                                   check_same_thread=False, isolation_level=None)
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, database TEXT, "
+                                         "file TEXT, kind TEXT, size INTEGER, created_at REAL, last_used REAL)")
+                self._connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+
+    @property
+    def enabled(self):
+        return self._connection is not None
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return (found, value) for a ResultCache key."""
+        if not self.enabled:
+            return False, None
+        digest = self.digest(key)
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._connection.execute("SELECT file, kind, last_used FROM entries WHERE key = ? AND "
+                                               "created_at >= ?", (digest, now - self.ttl)).fetchone()
+                if row is not None and now - row[2] >= TOUCH_INTERVAL:
+                    self._connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, digest))
+            if row is not None:
+                value = self._read(os.path.join(self.directory, row[0]), row[1])
+                self.stats['hits'] += 1
+                return True, value
+        except (sqlite3.Error, OSError, pa.ArrowException, pickle.UnpicklingError):
+            self.stats['errors'] += 1  # Busy index, or the file was evicted by another process meanwhile
+        self.stats['misses'] += 1
+        return False, None
+
+    @staticmethod
+    def _read(path, kind):
+        if kind == 'pickle':
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        return table.to_pandas() if kind == 'pandas' else table
+
+    def put(self, key, value, compute_seconds=None):
+        """Store a result unless it was cheap to compute or does not fit in a quarter of the budget."""
+        if not self.enabled or compute_seconds is not None and compute_seconds < self.min_compute_seconds:
+            return
+        digest = self.digest(key)
+        try:
+            kind, data = self._serialize(value)
+            if len(data) > self.max_bytes // 4:
+                return
+            # Written under a temporary name and renamed, so readers never see a partial file
+            handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(handle, 'wb') as file:
+                file.write(data)
+            file_name = f"{digest}.{'pickle' if kind == 'pickle' else 'arrow'}"
+            os.replace(temporary, os.path.join(self.directory, file_name))
+            now = time.time()
+            with self._lock:
+                self._connection.execute("INSERT OR REPLACE INTO entries (key, database, file, kind, size, "
+                                         "created_at, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                         (digest, key[0], file_name, kind, len(data), now, now))
+                self.stats['writes'] += 1
+                self._evict_locked()
+        except (sqlite3.Error, OSError, pa.ArrowException, pickle.PicklingError, TypeError):
+            self.stats['errors'] += 1
+
+    @staticmethod
+    def _serialize(value):
+        if loaded('pandas') and isinstance(value, pd.DataFrame):
+            kind = 'pandas'
+        elif loaded('pyarrow') and isinstance(value, pa.Table):
+            kind = 'arrow'
+        else:
+            kind = 'pickle'
+        if kind == 'pickle':
+            return kind, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            table = pa.Table.from_pandas(value, preserve_index=False) if kind == 'pandas' else value
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return 'pickle', pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)  # e.g. mixed-type columns
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        return kind, sink.getvalue().to_pybytes()
+
+    def _evict_locked(self):
+        total = self._connection.execute("SELECT coalesce(sum(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for digest, file_name, size in self._connection.execute(
+                "SELECT key, file, size FROM entries ORDER BY last_used").fetchall():
+            self._remove_locked(digest, file_name)
+            self.stats['evictions'] += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def _remove_locked(self, digest, file_name):
+        self._connection.execute("DELETE FROM entries WHERE key = ?", (digest,))
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except OSError:
+            pass  # Already removed by another process
+
+    def invalidate(self, database_name=None):
+        """Drop the entries of one database (absolute path), or all of them."""
+        if not self.enabled:
+            return
+        try:
+            with self._lock:
+                where, parameters = ("WHERE database = ?", (database_name,)) if database_name else ("", ())
+                for digest, file_name in self._connection.execute(f"SELECT key, file FROM entries {where}",
+                                                                  parameters).fetchall():
+                    self._remove_locked(digest, file_name)
+        except sqlite3.Error:
+            self.stats['errors'] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['directory'] = self.directory
+        if self.enabled:
+            with self._lock:
+                stats['entries'], stats['bytes'] = self._connection.execute(
+                    "SELECT count(*), coalesce(sum(size), 0) FROM entries").fetchone()
+        return stats
+
+
+# Shared by the result caches of this process; configured from RESULT_STORE_DIR
+result_store = SharedResultStore()
+metrics.register_stats('result_store', result_store.get_stats, "Result store shared between processes")
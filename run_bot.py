@@ -1,16 +1,170 @@
+import os
+import sys
+import time
+from contextlib import contextmanager
 from bot_handler import BotHandler
-from settings_reader import read_settings
+from mongo_backend import create_backend, DEFAULT_MONGO_URI
+from settings_reader import load_settings
+from sqlite_handler import connection_pool, pragma_profiles
+from query_profiler import query_profiler
+from job_queue import job_queue
+from result_store import result_store
+from admission import admission
+from metrics import metrics
+from backup import backup_manager
+from lazy_imports import import_seconds, loaded
 
-API_TOKEN = read_settings('settings.txt')['TELEGRAM_API_TOKEN']
-ADMIN_PASSWORD = read_settings('settings.txt')['ADMIN_PASSWORD']
-MONGOSH_ALLOWED_COMMANDS = read_settings('settings.txt')['MONGOSH_ALLOWED_COMMANDS']
+HEAVY_MODULES = ('pandas', 'pyarrow', 'pexpect', 'telebot')  # Imported on first use, see lazy_imports
+
+# Parsed once; every value below is converted to its type here instead of where it is used
+SETTINGS = load_settings('settings.txt')
+API_TOKEN = SETTINGS['TELEGRAM_API_TOKEN']
+ADMIN_PASSWORD = SETTINGS['ADMIN_PASSWORD']
+MONGOSH_ALLOWED_COMMANDS = SETTINGS['MONGOSH_ALLOWED_COMMANDS']
+COMPRESS_EXPORTS = SETTINGS.get_bool('COMPRESS_EXPORTS')
+EXPORT_FORMAT = SETTINGS.get('EXPORT_FORMAT', 'csv')
+WORKER_THREADS = SETTINGS.get_int('WORKER_THREADS', 4)
+QUERY_TIMEOUT = SETTINGS.get_int('QUERY_TIMEOUT', 60)
+SESSION_IDLE_TIMEOUT = SETTINGS.get_int('SESSION_IDLE_TIMEOUT', 3600)
+SESSION_STORE_PATH = SETTINGS.get_optional('SESSION_STORE_PATH')
+MONGO_BACKEND = SETTINGS.get('MONGO_BACKEND', 'mongosh')
+MONGO_URI = SETTINGS.get('MONGO_URI', DEFAULT_MONGO_URI)
+SQLITE_PRAGMAS, SQLITE_DATABASE_PRAGMAS = pragma_profiles(SETTINGS)
+QUERY_LOG_PATH = SETTINGS.get_optional('QUERY_LOG_PATH')
+SLOW_QUERY_SECONDS = SETTINGS.get_float('SLOW_QUERY_SECONDS', 1)
+JOB_QUEUE_PATH = SETTINGS.get_optional('JOB_QUEUE_PATH')
+JOB_RESULT_DIR = SETTINGS.get('JOB_RESULT_DIR', 'job_results')
+JOB_WORKERS = SETTINGS.get_int('JOB_WORKERS', 2)
+JOB_MAX_PER_USER = SETTINGS.get_int('JOB_MAX_PER_USER', 1)
+JOB_MAX_PER_DATABASE = SETTINGS.get_int('JOB_MAX_PER_DATABASE', 2)
+JOB_TIMEOUT = SETTINGS.get_int('JOB_TIMEOUT', 3600)
+JOB_MAX_QUEUED_PER_USER = SETTINGS.get_int('JOB_MAX_QUEUED_PER_USER', 5)
+JOB_MAX_ROWS = SETTINGS.get_int('JOB_MAX_ROWS', 10000000)
+RESULT_STORE_DIR = SETTINGS.get_optional('RESULT_STORE_DIR')
+RESULT_STORE_MAX_MB = SETTINGS.get_int('RESULT_STORE_MAX_MB', 512)
+ADMISSION_USER_ROWS_PER_SECOND = SETTINGS.get_int('ADMISSION_USER_ROWS_PER_SECOND', 100000)
+ADMISSION_USER_BURST_ROWS = SETTINGS.get_int('ADMISSION_USER_BURST_ROWS', 2000000)
+ADMISSION_DATABASE_ROWS_PER_SECOND = SETTINGS.get_int('ADMISSION_DATABASE_ROWS_PER_SECOND', 1000000)
+ADMISSION_DATABASE_BURST_ROWS = SETTINGS.get_int('ADMISSION_DATABASE_BURST_ROWS', 20000000)
+ADMISSION_MAX_COST_ROWS = SETTINGS.get_int('ADMISSION_MAX_COST_ROWS', 20000000)
+ADMISSION_MAX_CONCURRENT = SETTINGS.get_int('ADMISSION_MAX_CONCURRENT', 4)
+ADMISSION_MAX_WAIT = SETTINGS.get_float('ADMISSION_MAX_WAIT', 10)
+QUERY_MAX_ROWS = SETTINGS.get_int('QUERY_MAX_ROWS', 1000000)
+QUERY_MAX_SECONDS = SETTINGS.get_float('QUERY_MAX_SECONDS', 30)
+METRICS_HOST = SETTINGS.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = SETTINGS.get_int('METRICS_PORT')
+BACKUP_DIR = SETTINGS.get_optional('BACKUP_DIR')
+BACKUP_INTERVAL = SETTINGS.get_int('BACKUP_INTERVAL')
+BACKUP_KEEP = SETTINGS.get_int('BACKUP_KEEP', 7)
+BACKUP_PAGES_PER_STEP = SETTINGS.get_int('BACKUP_PAGES_PER_STEP', 1024)
+BACKUP_STEP_PAUSE = SETTINGS.get_float('BACKUP_STEP_PAUSE')
+
+
+@contextmanager
+def _step(timings, name):
+    started = time.perf_counter()
+    yield
+    if timings is not None:
+        timings.append((name, time.perf_counter() - started))
+
+
+def create_handler(timings=None):
+    """
+    Configure the shared services of this process and build the bot, without connecting to Telegram yet.
+
+    :param timings: Optional list that (step name, seconds) is appended to for every step.
+    """
+    with _step(timings, "connection pool"):
+        connection_pool.configure(SQLITE_PRAGMAS, SQLITE_DATABASE_PRAGMAS)
+    with _step(timings, "query profiler"):
+        query_profiler.configure(QUERY_LOG_PATH, SLOW_QUERY_SECONDS)
+    with _step(timings, "result store"):
+        result_store.configure(RESULT_STORE_DIR, RESULT_STORE_MAX_MB * 1024 * 1024)
+    with _step(timings, "admission control"):
+        admission.configure(ADMISSION_USER_ROWS_PER_SECOND, ADMISSION_USER_BURST_ROWS,
+                            ADMISSION_DATABASE_ROWS_PER_SECOND, ADMISSION_DATABASE_BURST_ROWS,
+                            max_cost=ADMISSION_MAX_COST_ROWS, max_concurrent=ADMISSION_MAX_CONCURRENT,
+                            max_wait=ADMISSION_MAX_WAIT, max_rows=QUERY_MAX_ROWS, max_seconds=QUERY_MAX_SECONDS)
+    if METRICS_PORT:
+        with _step(timings, "metrics endpoint"):
+            metrics.serve(METRICS_PORT, METRICS_HOST)
+    with _step(timings, "backup scheduler"):
+        backup_manager.configure(BACKUP_DIR, interval=BACKUP_INTERVAL, keep=BACKUP_KEEP,
+                                 pages_per_step=BACKUP_PAGES_PER_STEP, step_pause=BACKUP_STEP_PAUSE)
+        backup_manager.start()
+    with _step(timings, "job queue"):
+        job_queue.configure(JOB_QUEUE_PATH, JOB_RESULT_DIR, workers=JOB_WORKERS, max_per_owner=JOB_MAX_PER_USER,
+                            max_per_database=JOB_MAX_PER_DATABASE, job_timeout=JOB_TIMEOUT, pragmas=SQLITE_PRAGMAS,
+                            database_pragmas=SQLITE_DATABASE_PRAGMAS, max_queued_per_owner=JOB_MAX_QUEUED_PER_USER,
+                            max_rows=JOB_MAX_ROWS)
+    with _step(timings, "bot handler"):
+        return BotHandler(api_token=API_TOKEN, admin_password=ADMIN_PASSWORD,
+                          mongosh_allowed_commands=MONGOSH_ALLOWED_COMMANDS, compress_exports=COMPRESS_EXPORTS,
+                          export_format=EXPORT_FORMAT,
+                          worker_threads=WORKER_THREADS, query_timeout=QUERY_TIMEOUT,
+                          session_idle_timeout=SESSION_IDLE_TIMEOUT, session_store_path=SESSION_STORE_PATH,
+                          mongo_backend=create_backend(MONGO_BACKEND, MONGO_URI))
 
 
 def run_bot():
-    handler = BotHandler(api_token=API_TOKEN, admin_password=ADMIN_PASSWORD,
-                         mongosh_allowed_commands=MONGOSH_ALLOWED_COMMANDS)
-    handler.run()
+    create_handler().run()
+
+
+def _import_times():
+    """
+    Cumulative import seconds of run_bot, measured in a fresh `python -X importtime`, with a breakdown:
+    (total, [(module run_bot imports, seconds, [(module that one imports, seconds), ...]), ...]).
+    """
+    import subprocess
+    directory = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [directory, os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import run_bot'], env=env,
+                            capture_output=True, text=True)
+    # A module is listed after the modules it imports, indented by two spaces per level
+    imported, nested = [], []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if not line.startswith('import time:') or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name, seconds = parts[2][1:], int(parts[1]) / 1000000
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name == 'run_bot':
+                return seconds, imported
+            imported, nested = [], []  # Imported by the interpreter itself
+        elif depth == 1:
+            imported.append((name.strip(), seconds, nested))
+            nested = []
+        elif depth == 2:
+            nested.append((name.strip(), seconds))
+    return 0.0, []
+
+
+def profile_startup():
+    """Print where a cold start of the bot spends its time: imports, then every initialization step."""
+    timings = []
+    started = time.perf_counter()
+    create_handler(timings)
+    initialization = time.perf_counter() - started
+    total_import, imported = _import_times()
+    print("Imports (cumulative; a module imported by several others counts where it was imported first):")
+    for name, seconds, nested in sorted(imported, key=lambda item: -item[1]):
+        print(f"  {name:<26} {seconds * 1000:8.1f} ms")
+        for nested_name, nested_seconds in sorted(nested, key=lambda item: -item[1]):
+            print(f"    {nested_name:<24} {nested_seconds * 1000:8.1f} ms")
+    print("Initialization:")
+    for name, seconds in timings:
+        print(f"  {name:<26} {seconds * 1000:8.1f} ms")
+    for name, seconds in import_seconds.items():
+        print(f"  (import {name} on first use: {seconds * 1000:.1f} ms, included above)")
+    print("Heavy modules loaded before the first message: "
+          + (", ".join(name for name in HEAVY_MODULES if loaded(name)) or "none"))
+    print(f"Ready to poll after {(total_import + initialization) * 1000:.0f} ms "
+          f"({total_import * 1000:.0f} ms imports + {initialization * 1000:.0f} ms initialization)")
 
 
 if __name__ == '__main__':
-    run_bot()
+    if sys.argv[1:] == ['--profile-startup']:
+        profile_startup()
+    else:
+        run_bot()
@@ -0,0 +1,83 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class Session:
+    """Per-chat state of the bot. Only labels are stored, so a session can be persisted and restored."""
+    __slots__ = ('chat_id', 'status', 'navigation', 'pending_button', 'last_seen')
+
+    def __init__(self, chat_id, status=None, navigation=None, pending_button=None, last_seen=None):
+        self.chat_id = chat_id
+        self.status = status  # 'user', 'admin' or None
+        self.navigation = navigation or []  # Texts of the buttons pressed from the initial keyboard
+        self.pending_button = pending_button  # Button waiting for input (e.g. a password)
+        self.last_seen = last_seen or time.time()
+
+
+class SessionStore:
+    def __init__(self, idle_timeout=3600, persist_path=None, sweep_interval=60):
+        """
+        Sessions keyed by chat_id, expired after idle_timeout seconds without activity.
+
+        :param idle_timeout: Seconds of inactivity after which a session is dropped.
+        :param persist_path: Optional SQLite file the sessions are written to, so they survive restarts.
+        :param sweep_interval: Minimum seconds between two scans for idle sessions.
+        """
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self._sessions = {}
+        self._lock = threading.RLock()
+        self._last_sweep = time.monotonic()
+        self._connection = None
+        if persist_path:
+            self._connection = sqlite3.connect(persist_path, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, "
+                                     "status TEXT, navigation TEXT, pending_button TEXT, last_seen REAL)")
+            self._connection.commit()
+            self._load()
+
+    def _load(self):
+        rows = self._connection.execute("SELECT chat_id, status, navigation, pending_button, last_seen "
+                                        "FROM sessions").fetchall()
+        for chat_id, status, navigation, pending_button, last_seen in rows:
+            self._sessions[chat_id] = Session(chat_id, status, json.loads(navigation), pending_button, last_seen)
+        self.expire_idle()
+
+    def get(self, chat_id):
+        """Return the session of a chat, creating it if needed, and mark it as active."""
+        with self._lock:
+            if time.monotonic() - self._last_sweep > self.sweep_interval:
+                self.expire_idle()
+            session = self._sessions.get(chat_id)
+            if session is None:
+                session = self._sessions[chat_id] = Session(chat_id)
+            session.last_seen = time.time()
+            return session
+
+    def save(self, session):
+        """Persist a session after it was changed (no-op without persist_path)."""
+        if self._connection is None:
+            return
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)",
+                                     (session.chat_id, session.status, json.dumps(session.navigation),
+                                      session.pending_button, session.last_seen))
+            self._connection.commit()
+
+    def expire_idle(self):
+        """Drop sessions that have been inactive for longer than idle_timeout."""
+        with self._lock:
+            self._last_sweep = time.monotonic()
+            cutoff = time.time() - self.idle_timeout
+            expired = [chat_id for chat_id, session in self._sessions.items() if session.last_seen < cutoff]
+            for chat_id in expired:
+                del self._sessions[chat_id]
+            if self._connection is not None:
+                self._connection.execute("DELETE FROM sessions WHERE last_seen < ?", (cutoff,))
+                self._connection.commit()
+            return expired
+
+    def __len__(self):
+        return len(self._sessions)
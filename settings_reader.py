@@ -1,3 +1,10 @@
+import os
+import threading
+
+_cache = {}  # absolute path -> (modification time, Settings)
+_cache_lock = threading.Lock()
+
+
 def read_settings(file_path):
     settings = {}
     with open(file_path, 'r') as file:
@@ -32,3 +39,41 @@ def read_settings(file_path):
         settings['MONGOSH_ALLOWED_COMMANDS'] = eval(settings['MONGOSH_ALLOWED_COMMANDS'])
 
     return settings
+
+
+class Settings(dict):
+    """The values of a settings file with typed accessors; a missing or empty value gives the default."""
+
+    def get_optional(self, key):
+        """The value, or None if it is missing or empty (e.g. a path that turns a feature off)."""
+        return self.get(key) or None
+
+    def get_int(self, key, default=0):
+        value = self.get(key)
+        return int(value) if value else default
+
+    def get_float(self, key, default=0.0):
+        value = self.get(key)
+        return float(value) if value else default
+
+    def get_bool(self, key, default=False):
+        value = self.get(key)
+        return value.lower() == 'true' if value else default
+
+
+def load_settings(file_path='settings.txt'):
+    """
+    The settings of a file, parsed once per process and again only after the file changes.
+
+    Every caller gets the same Settings object, so it must not be modified.
+    """
+    path = os.path.abspath(file_path)
+    version = os.stat(path).st_mtime_ns
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+    settings = Settings(read_settings(path))
+    with _cache_lock:
+        _cache[path] = (version, settings)
+    return settings
@@ -1,37 +1,1296 @@
+import csv
+import gzip
+import os
+import re
 import sqlite3
-import pandas as pd
-from io import BytesIO
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import pathname2url
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext, ExitStack
+from itertools import chain
+from io import BytesIO, StringIO
+from lazy_imports import LazyModule, loaded
+from query_profiler import query_profiler, Measurement, OPERATION_ERRORS
+from metrics import metrics
+from result_store import result_store as shared_result_store
+
+pd = LazyModule('pandas')
+pa = LazyModule('pyarrow')
+pq = LazyModule('pyarrow.parquet')
+
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024  # Bot API limit for documents sent by a bot
+EXPORT_BATCH_SIZE = 5000
+EXPORT_SPOOL_SIZE = 4 * 1024 * 1024  # Bytes kept in memory before an export part spills to disk
+EXPORT_FORMATS = ('csv', 'parquet', 'arrow', 'feather')
+PAGE_SIZE = 100
+MAX_PAGERS = 64
+PROGRESS_HANDLER_INTERVAL = 10000  # SQLite VM instructions between cancellation checks
+SMALL_RESULT_ROWS = 20  # Results up to this many rows are returned as rows instead of an export file
+MAX_CLASSIFICATIONS = 1024
+# Applied to every pooled connection; journal_mode is stored in the database file and set once per database
+DEFAULT_PRAGMAS = "journal_mode=WAL; synchronous=NORMAL; busy_timeout=5000; mmap_size=268435456; cache_size=-65536"
+
+# Quoted strings and identifiers, and comments, which normalizing a query must leave as they are
+_SQL_TOKEN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`(?:[^`]|``)*`|\[[^\]]*\]"
+                        r"|--[^\n]*\n?|/\*.*?(?:\*/|$)|(\s+)", re.DOTALL)
+
+_cancellation = threading.local()
+_read_only = threading.local()
+_budget = threading.local()
+
+
+@contextmanager
+def cancellation_scope(event):
+    """Make SQLite statements run by this thread fail with "interrupted" once the event is set."""
+    previous = getattr(_cancellation, 'event', None)
+    _cancellation.event = event
+    try:
+        yield
+    finally:
+        _cancellation.event = previous
+
+
+class QueryBudget:
+    __slots__ = ('max_rows', 'max_seconds', 'rows', 'seconds', 'running_since', 'reason')
+
+    def __init__(self, max_rows=None, max_seconds=None):
+        """
+        Limits for the statements run inside a budget_scope.
+
+        Only time spent with a borrowed connection counts against max_seconds, and not while a generator
+        reading from it has handed a batch or a result file back to its caller (see pause), so a slow
+        upload of the result does not use up the budget of a cheap query.
+
+        :param max_rows: Rows that may be fetched in total, None for no limit.
+        :param max_seconds: Seconds the statements may run, None for no limit.
+        """
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.rows = 0
+        self.seconds = 0.0  # Counted time of earlier intervals
+        self.running_since = None  # Start of the interval being counted
+        self.reason = None  # Why the budget was exceeded
+
+    def resume(self):
+        if self.running_since is None:
+            self.running_since = time.monotonic()
+
+    def pause(self):
+        if self.running_since is not None:
+            self.seconds += time.monotonic() - self.running_since
+            self.running_since = None
+
+    def elapsed(self):
+        if self.running_since is None:
+            return self.seconds
+        return self.seconds + time.monotonic() - self.running_since
+
+    def exceeded(self):
+        if self.reason is None:
+            if self.max_rows is not None and self.rows > self.max_rows:
+                self.reason = f"Query stopped after {self.max_rows:,} rows, add a WHERE clause or a LIMIT."
+            elif self.max_seconds and self.elapsed() > self.max_seconds:
+                self.reason = f"Query stopped after {self.max_seconds:g}s, add a WHERE clause or a LIMIT."
+        return self.reason is not None
+
+
+@contextmanager
+def budget_scope(budget):
+    """
+    Interrupt SQLite statements run by this thread once the QueryBudget is exceeded.
+
+    The time limit and the rows fetched in batches (see fetch_batches) are checked by the progress handler,
+    and the interrupted statement fails with a RuntimeError giving the reason.
+    """
+    previous = getattr(_budget, 'budget', None)
+    _budget.budget = budget
+    try:
+        yield budget
+    finally:
+        _budget.budget = previous
+
+
+@contextmanager
+def _budget_paused():
+    """Stop counting this thread's QueryBudget time while a generator has handed control back to its caller."""
+    budget = getattr(_budget, 'budget', None)
+    if budget is None or budget.running_since is None:
+        yield
+        return
+    budget.pause()
+    try:
+        yield
+    finally:
+        budget.resume()
+
+
+@contextmanager
+def read_only_scope():
+    """Make connections borrowed by this thread refuse every statement that could modify a database."""
+    previous = getattr(_read_only, 'active', False)
+    _read_only.active = True
+    try:
+        yield
+    finally:
+        _read_only.active = previous
+
+
+def parse_pragmas(text):
+    """Parse a PRAGMA profile such as "journal_mode=WAL; busy_timeout=5000" into (name, value) pairs."""
+    pragmas = []
+    for item in (text or "").split(';'):
+        if not item.strip():
+            continue
+        name, _, value = item.partition('=')
+        name, value = name.strip().lower(), value.strip()
+        if not re.fullmatch(r'[a-z_]+', name) or not re.fullmatch(r'[\w.+-]+', value):
+            raise ValueError(f"Invalid PRAGMA setting: {item.strip()}")
+        pragmas.append((name, value))
+    return pragmas
+
+
+def pragma_profiles(settings):
+    """Return (default profile, {database file: profile}) from the SQLITE_PRAGMAS[.<database file>] settings."""
+    prefix = 'SQLITE_PRAGMAS.'
+    return settings.get('SQLITE_PRAGMAS', DEFAULT_PRAGMAS), \
+        {key[len(prefix):]: value for key, value in settings.items() if key.startswith(prefix)}
+
+
+class ConnectionPool:
+    def __init__(self, max_size=5, idle_timeout=300, health_check_interval=30, wait_timeout=10,
+                 pragmas=DEFAULT_PRAGMAS, database_pragmas=None):
+        """
+        Thread-safe pool of sqlite3 connections keyed by database path and access mode.
+
+        Read-only connections are opened as mode=ro URIs and pooled separately from read-write ones.
+        With the default WAL profile any number of readers (in this and other processes) keep running
+        while a single writer commits; busy_timeout makes a second writer wait instead of failing.
+
+        :param max_size: Maximum number of open connections (idle + in use) per database and mode.
+        :param idle_timeout: Seconds after which an unused connection is closed.
+        :param health_check_interval: Idle seconds after which a connection is pinged before reuse.
+        :param wait_timeout: Seconds to wait for a free connection before giving up.
+        :param pragmas: PRAGMA profile applied to every new connection (see parse_pragmas).
+        :param database_pragmas: Dict of database file name -> PRAGMA profile overriding single settings.
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.wait_timeout = wait_timeout
+        self._condition = threading.Condition()
+        self._idle = {}  # (database path, read_only) -> list of (connection, last_used)
+        self._open = {}  # (database path, read_only) -> number of open connections
+        self._journal_checked = set()  # Database paths whose journal mode was set by this pool
+        self.pragmas = self.database_pragmas = None
+        self.configure(pragmas, database_pragmas)
+        self.stats = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time': 0.0, 'timeouts': 0,
+                      'evictions': 0, 'health_check_failures': 0}
+
+    def configure(self, pragmas=DEFAULT_PRAGMAS, database_pragmas=None):
+        """Change the PRAGMA profiles; connections opened before keep their settings until they are closed."""
+        pragmas = dict(parse_pragmas(pragmas))
+        database_pragmas = {name: dict(parse_pragmas(profile)) for name, profile in (database_pragmas or {}).items()}
+        if (pragmas, database_pragmas) != (self.pragmas, self.database_pragmas):
+            self.pragmas, self.database_pragmas = pragmas, database_pragmas
+            self._journal_checked = set()
+
+    def pragmas_for(self, database_name):
+        pragmas = dict(self.pragmas)
+        pragmas.update(self.database_pragmas.get(os.path.basename(database_name), {}))
+        return pragmas
+
+    @staticmethod
+    def _key(database_name, read_only=False):
+        return os.path.abspath(database_name), read_only
+
+    def _connect(self, database_name, read_only=False):
+        pragmas = self.pragmas_for(database_name)
+        if read_only:
+            path = os.path.abspath(database_name)
+            if 'journal_mode' in pragmas and path not in self._journal_checked and os.path.exists(path):
+                # A read-only connection cannot switch the journal mode, so let a short-lived writer do it
+                with sqlite3.connect(path) as writer:
+                    writer.execute(f"PRAGMA journal_mode={pragmas['journal_mode']}")
+                writer.close()
+                self._journal_checked.add(path)
+            connection = sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri=True, check_same_thread=False)
+            pragmas.pop('journal_mode', None)
+        else:
+            connection = sqlite3.connect(database_name, check_same_thread=False)
+        for name, value in pragmas.items():
+            connection.execute(f"PRAGMA {name}={value}").fetchall()
+        return connection
+
+    def _is_healthy(self, database_name, connection):
+        if not os.path.exists(database_name):
+            return False
+        try:
+            connection.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _close(self, key, connection):
+        self._open[key] -= 1
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+
+    def _evict_idle_locked(self, now):
+        for key, idle in self._idle.items():
+            fresh = []
+            for connection, last_used in idle:
+                if now - last_used > self.idle_timeout:
+                    self._close(key, connection)
+                    self.stats['evictions'] += 1
+                else:
+                    fresh.append((connection, last_used))
+            idle[:] = fresh
+
+    def acquire(self, database_name, read_only=False):
+        """Take a connection for the database out of the pool, opening a new one if needed."""
+        key = self._key(database_name, read_only)
+        started = None
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._evict_idle_locked(now)
+                idle = self._idle.setdefault(key, [])
+                while idle:
+                    connection, last_used = idle.pop()
+                    if now - last_used > self.health_check_interval and \
+                            not self._is_healthy(database_name, connection):
+                        self.stats['health_check_failures'] += 1
+                        self._close(key, connection)
+                        continue
+                    self.stats['hits'] += 1
+                    self._record_wait(started)
+                    return connection
+                if self._open.get(key, 0) < self.max_size:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    self.stats['misses'] += 1
+                    self._record_wait(started)
+                    break
+                if started is None:
+                    started = now
+                    self.stats['waits'] += 1
+                remaining = self.wait_timeout - (now - started)
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    self._record_wait(started)
+                    raise RuntimeError(f"No free connection to {database_name} after {self.wait_timeout}s")
+                self._condition.wait(remaining)
+
+        try:
+            return self._connect(database_name, read_only)
+        except Exception:
+            with self._condition:
+                self._open[key] -= 1
+                self._condition.notify()
+            raise
+
+    def _record_wait(self, started):
+        if started is not None:
+            self.stats['wait_time'] += time.monotonic() - started
+
+    def release(self, database_name, connection, discard=False, read_only=False):
+        """Return a connection to the pool (or close it when discard is set)."""
+        key = self._key(database_name, read_only)
+        with self._condition:
+            if discard:
+                self._close(key, connection)
+            else:
+                if connection.in_transaction:
+                    connection.rollback()
+                self._idle.setdefault(key, []).append((connection, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self, database_name, read_only=False):
+        """Borrow a connection for the duration of a with block."""
+        connection = self.acquire(database_name, read_only)
+        discard = False
+        cancel_event = getattr(_cancellation, 'event', None)
+        budget = getattr(_budget, 'budget', None)
+        deny_writes = getattr(_read_only, 'active', False)
+        if budget is not None:
+            budget.resume()
+            connection.set_progress_handler(
+                lambda: budget.exceeded() or cancel_event is not None and cancel_event.is_set(),
+                PROGRESS_HANDLER_INTERVAL)
+        elif cancel_event is not None:
+            connection.set_progress_handler(cancel_event.is_set, PROGRESS_HANDLER_INTERVAL)
+        if deny_writes:
+            connection.set_authorizer(_deny_writes)
+        try:
+            yield connection
+        except sqlite3.DatabaseError as e:
+            # Keep the connection unless it no longer responds (e.g. the file went away)
+            discard = not self._is_healthy(database_name, connection)
+            if budget is not None and budget.reason is not None:
+                raise RuntimeError(budget.reason) from e
+            raise
+        finally:
+            if cancel_event is not None or budget is not None:
+                connection.set_progress_handler(None, 0)
+            if budget is not None:
+                budget.pause()
+            if deny_writes:
+                connection.set_authorizer(None)
+            self.release(database_name, connection, discard=discard, read_only=read_only)
+
+    def evict_idle(self):
+        """Close every connection that has been idle for longer than idle_timeout."""
+        with self._condition:
+            self._evict_idle_locked(time.monotonic())
+
+    def close_all(self):
+        """Close all idle connections; connections in use are closed when released with discard."""
+        with self._condition:
+            for key, idle in self._idle.items():
+                for connection, _ in idle:
+                    self._close(key, connection)
+                idle.clear()
+
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self.stats)
+            stats['open'] = sum(self._open.values())
+            stats['idle'] = sum(len(idle) for idle in self._idle.values())
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+class ResultCache:
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=512, ttl=60, store=None):
+        """
+        LRU cache of read query results with a TTL and a byte budget.
+
+        Entries are keyed on the database path, the normalized SQL and the database file version, so a
+        change to the file on disk (from this or another process) makes old entries unreachable.
+        Writes through SQLViewer.executor drop every entry of that database explicitly.
+
+        :param max_bytes: Approximate memory budget for cached results.
+        :param max_entries: Maximum number of cached results.
+        :param ttl: Seconds after which an entry is considered stale.
+        :param store: Optional SharedResultStore consulted on a miss, so other processes' results are reused.
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = store
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, stored_at)
+        self._bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'uncacheable': 0}
+
+    @staticmethod
+    def normalize(query):
+        """
+        Collapse whitespace and drop trailing semicolons so trivially different spellings share an entry.
+
+        Whitespace inside string literals, quoted identifiers and comments is kept: 'a  b' and 'a b' differ.
+        """
+        query = _SQL_TOKEN.sub(lambda match: ' ' if match.group(1) else match.group(0), query)
+        return query.strip().rstrip(';').strip()
+
+    def make_key(self, database_name, query, *extra):
+        path = os.path.abspath(database_name)
+        return path, self.normalize(query), file_version(database_name), extra
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[2] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return True, entry[0]
+            if entry is not None:
+                self._remove(key)
+            self.stats['misses'] += 1
+            return False, None
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        with self._lock:
+            if size > self.max_bytes:
+                self.stats['uncacheable'] += 1
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic())
+            self._bytes += size
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def invalidate(self, database_name=None):
+        """Drop all entries of one database, or of every database when no name is given."""
+        path = os.path.abspath(database_name) if database_name else None
+        with self._lock:
+            for key in [key for key in self._entries if path is None or key[0] == path]:
+                self._remove(key)
+            self.stats['invalidations'] += 1
+        if self.store is not None:
+            self.store.invalidate(path)
+
+    def get_or_compute(self, key, compute):
+        found, value = self.get(key)
+        if found:
+            return value
+        found, value = self.store.get(key) if self.store is not None else (False, None)
+        if not found:
+            started = time.perf_counter()
+            value = compute()
+            if self.store is not None:
+                self.store.put(key, value, time.perf_counter() - started)
+        self.put(key, value)
+        return value
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def estimate_size(value):
+    """Rough in-memory size of a cached result (DataFrame, Arrow table or list of row tuples)."""
+    if hasattr(value, 'memory_usage'):
+        return int(value.memory_usage(deep=True).sum())
+    if loaded('pyarrow') and isinstance(value, pa.Table):
+        return value.nbytes
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            size += estimate_size(item) if isinstance(item, (list, tuple)) else sys.getsizeof(item)
+    return size
+
+
+_READ_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+_ACTION_KINDS = {
+    sqlite3.SQLITE_SELECT: 'select', sqlite3.SQLITE_READ: 'select', sqlite3.SQLITE_RECURSIVE: 'select',
+    sqlite3.SQLITE_FUNCTION: 'select', sqlite3.SQLITE_PRAGMA: 'pragma',
+    sqlite3.SQLITE_INSERT: 'write', sqlite3.SQLITE_UPDATE: 'write', sqlite3.SQLITE_DELETE: 'write',
+    sqlite3.SQLITE_TRANSACTION: 'transaction', sqlite3.SQLITE_SAVEPOINT: 'transaction',
+    sqlite3.SQLITE_ATTACH: 'other', sqlite3.SQLITE_DETACH: 'other',
+}
+# Pragmas that take an argument without changing anything, e.g. PRAGMA table_info(t)
+READ_PRAGMAS_WITH_ARGUMENT = {'table_info', 'table_xinfo', 'index_list', 'index_info', 'index_xinfo',
+                              'foreign_key_list', 'foreign_key_check', 'integrity_check', 'quick_check'}
+# Pragmas that do work even without an argument
+PRAGMAS_WITH_SIDE_EFFECTS = {'optimize', 'wal_checkpoint', 'incremental_vacuum', 'shrink_memory'}
+
+
+def _is_read_action(action, arg1, arg2):
+    if action in _READ_ACTIONS:
+        return True
+    if action == sqlite3.SQLITE_PRAGMA:
+        name = (arg1 or '').lower()
+        if arg2 is not None:
+            return name in READ_PRAGMAS_WITH_ARGUMENT  # Otherwise PRAGMA name = value sets something
+        return name not in PRAGMAS_WITH_SIDE_EFFECTS
+    return False
+
+
+def _deny_writes(action, arg1, arg2, database, trigger):
+    return sqlite3.SQLITE_OK if _is_read_action(action, arg1, arg2) else sqlite3.SQLITE_DENY
+
+
+def split_statements(script):
+    """
+    Split an SQL script into its statements.
+
+    sqlite3.complete_statement decides where a statement ends, so semicolons inside string literals,
+    comments and CREATE TRIGGER bodies do not split it. An unterminated last statement is kept as is.
+    """
+    statements = []
+    pending = ''
+    for piece in script.split(';'):
+        pending += piece + ';'
+        if sqlite3.complete_statement(pending):
+            if pending.strip(' \t\r\n;'):
+                statements.append(pending.strip())
+            pending = ''
+    if pending.strip(' \t\r\n;'):
+        statements.append(pending.strip().rstrip(';'))
+    return statements
+
+
+class StatementResult:
+    """Outcome of one statement of a script run by SQLViewer.execute_script."""
+    __slots__ = ('statement', 'rows', 'seconds', 'error')
+
+    def __init__(self, statement, rows, seconds, error=None):
+        self.statement = statement
+        self.rows = rows  # Rows changed, or rows returned by a statement that produces a result set
+        self.seconds = seconds
+        self.error = error
+
+
+class StatementInfo:
+    """What SQLite reported while preparing a statement; see SQLViewer.classify."""
+    __slots__ = ('kind', 'read_only', 'tables', 'actions')
+
+    def __init__(self, actions):
+        self.actions = actions  # (action_code, arg1, arg2, database) as reported to the authorizer
+        # Statements SQLite prepares without any callback (VACUUM) are never treated as reads
+        self.read_only = bool(actions) and all(_is_read_action(*action[:3]) for action in actions)
+        # CTEs and subqueries are reported without a database name
+        self.tables = sorted({arg1 for action, arg1, _, database in actions
+                              if action in (sqlite3.SQLITE_READ, sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE,
+                                            sqlite3.SQLITE_DELETE) and database and not arg1.startswith('sqlite_')})
+        if self.read_only:
+            self.kind = 'pragma' if actions[0][0] == sqlite3.SQLITE_PRAGMA else 'select'
+        else:
+            # CREATE, DROP, ALTER and friends also write to sqlite_master, so they take precedence
+            kinds = [_ACTION_KINDS.get(action, 'schema') for action, arg1, arg2, _ in actions
+                     if not _is_read_action(action, arg1, arg2)]
+            self.kind = 'schema' if 'schema' in kinds else kinds[0] if kinds else 'other'
+
+    def __repr__(self):
+        return f"StatementInfo(kind={self.kind!r}, read_only={self.read_only}, tables={self.tables})"
+
+
+_classifications = OrderedDict()  # (database path, normalized query) -> StatementInfo
+_classifications_lock = threading.Lock()
+
+
+# Shared by every SQLViewer in the process (bot handlers and Streamlit reruns alike)
+connection_pool = ConnectionPool()
+result_cache = ResultCache(store=shared_result_store)
+metrics.register_stats('sqlite_pool', connection_pool.get_stats, "Shared SQLite connection pool")
+metrics.register_stats('result_cache', result_cache.get_stats, "In-process result cache")
 
 
 class SQLViewer:
-    def __init__(self, database_name):
-        self.connection = sqlite3.connect(database_name)
-        self.cursor = self.connection.cursor()
+    def __init__(self, database_name, pool=None, cache=None, read_only=False, profiler=None):
+        """
+        :param database_name: Path of the SQLite database file.
+        :param pool: ConnectionPool to borrow connections from (the shared one by default).
+        :param cache: ResultCache for reads (the shared one by default).
+        :param read_only: Open mode=ro connections, used for user sessions; executor then always fails.
+        :param profiler: QueryProfiler recording the statements run (the shared one by default).
+        """
+        self.database_name = database_name
+        self.pool = pool or connection_pool
+        self.cache = cache or result_cache
+        self.read_only = read_only
+        self.profiler = profiler or query_profiler
+
+    def connection(self):
+        """Borrow a pooled connection to this viewer's database in its access mode."""
+        return self.pool.connection(self.database_name, read_only=self.read_only)
+
+    def classify(self, query):
+        """
+        Return a StatementInfo for a single SQL statement without running it.
+
+        The statement is prepared through EXPLAIN with an authorizer that records every action SQLite checks,
+        so WITH ... INSERT, REPLACE or PRAGMA assignments are recognised as writes however they are spelled.
+        Results are cached per database and normalized query. Invalid SQL raises sqlite3.Error.
+        """
+        normalized = ResultCache.normalize(query)
+        key = (os.path.abspath(self.database_name), normalized)
+        with _classifications_lock:
+            info = _classifications.get(key)
+            if info is not None:
+                _classifications.move_to_end(key)
+                return info
+        # EXPLAIN only compiles the statement; an explicit EXPLAIN is classified (and authorized) like its statement
+        statement = re.sub(r'^explain(\s+query\s+plan)?\s+', '', normalized, flags=re.IGNORECASE)
+        actions = []
+
+        def record(action, arg1, arg2, database, trigger):
+            actions.append((action, arg1, arg2, database))
+            return sqlite3.SQLITE_OK
+
+        with self.connection() as connection:
+            connection.set_authorizer(record)
+            try:
+                connection.execute(f"EXPLAIN {statement}").close()
+            finally:
+                connection.set_authorizer(None)
+        info = StatementInfo(actions)
+        with _classifications_lock:
+            _classifications[key] = info
+            if len(_classifications) > MAX_CLASSIFICATIONS:
+                del _classifications[next(iter(_classifications))]
+        return info
+
+    def _cached(self, operation, query, compute, *extra):
+        """Serve a read from the result cache; results must be treated as read-only by callers."""
+        profiled = lambda: self._profiled(operation, query, compute)
+        try:
+            cacheable = self.classify(query).read_only
+        except sqlite3.Error:
+            cacheable = False  # Let the query itself report the error
+        if not cacheable:
+            return profiled()
+        return self.cache.get_or_compute(self.cache.make_key(self.database_name, query, operation, *extra), profiled)
+
+    def _profiled(self, operation, query, compute):
+        """Run compute under the profiler; cache hits are not profiled since no statement runs."""
+        with self.profiler.measure(self, operation, query) as measurement:
+            result = compute()
+            measurement.rows = result.num_rows if loaded('pyarrow') and isinstance(result, pa.Table) else len(result)
+            measurement.bytes = estimate_size(result)
+        return result
+
+    def _profiled_stream(self, operation, query, items, count):
+        """
+        Profile a generator, timing only the work done inside it and not the caller's handling of each item.
+        count(measurement, item) adds the rows and bytes of an item.
+        """
+        measurement = Measurement()
+        measurement.bytes = 0
+        elapsed = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(items)
+                finally:
+                    elapsed += time.perf_counter() - started
+                count(measurement, item)
+                yield item
+        except StopIteration:
+            pass
+        except Exception:
+            OPERATION_ERRORS.inc(operation)
+            raise
+        finally:
+            items.close()
+        self.profiler.record(self, operation, query, elapsed, measurement)
 
     def simple_view(self, query):
         """Execute a query and return the raw results (used for table listing)."""
-        self.cursor.execute(query)
-        return self.cursor.fetchall()
+        def compute():
+            with self.connection() as connection:
+                return connection.execute(query).fetchall()
+        return self._cached('simple_view', query, compute)
 
     def executor(self, query):
-        try:
-            self.cursor.execute(query)
-            self.connection.commit()
-        except Exception as e:
-            raise RuntimeError(f"Query failed: {str(e)}")
+        with self.profiler.measure(self, 'executor', query) as measurement, self.connection() as connection:
+            try:
+                measurement.rows = connection.execute(query).rowcount
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                raise RuntimeError(f"Query failed: {str(e)}")
+            finally:
+                self.cache.invalidate(self.database_name)
+
+    def execute_script(self, script, atomic=True):
+        """
+        Run a multi-statement script in a single transaction, each statement inside its own savepoint.
+
+        With atomic, the first failing statement rolls the whole script back; otherwise only that statement
+        is rolled back to its savepoint and the rest are still run and committed. Statements that would end
+        or nest the transaction (BEGIN, COMMIT, SAVEPOINT...) are refused by the authorizer.
+
+        :return: A list of StatementResult; after an atomic rollback the failed statement is the last one.
+        """
+        statements = split_statements(script)
+        results = []
+        in_script = [False]  # The savepoints of the runner itself are allowed
+
+        def authorize(action, arg1, arg2, database, trigger):
+            if in_script[0] and action in (sqlite3.SQLITE_TRANSACTION, sqlite3.SQLITE_SAVEPOINT):
+                return sqlite3.SQLITE_DENY
+            return sqlite3.SQLITE_OK
+
+        with self.connection() as connection:
+            connection.set_authorizer(authorize)
+            try:
+                connection.execute("BEGIN")
+                for statement in statements:
+                    connection.execute("SAVEPOINT script_statement")
+                    measurement = Measurement()
+                    started = time.perf_counter()
+                    try:
+                        in_script[0] = True
+                        cursor = connection.execute(statement)
+                        measurement.rows = sum(1 for _ in cursor) if cursor.description else cursor.rowcount
+                    except sqlite3.DatabaseError as e:
+                        in_script[0] = False
+                        connection.execute("ROLLBACK TO script_statement")
+                        connection.execute("RELEASE script_statement")
+                        error = "transactions are managed by the script runner" if "not authorized" in str(e) \
+                            else str(e)
+                        results.append(StatementResult(statement, None, time.perf_counter() - started, error))
+                        if atomic:
+                            connection.rollback()
+                            return results
+                        continue
+                    in_script[0] = False
+                    duration = time.perf_counter() - started
+                    connection.execute("RELEASE script_statement")
+                    results.append(StatementResult(statement, measurement.rows, duration))
+                    self.profiler.record(self, 'executor', statement, duration, measurement)
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+            finally:
+                connection.set_authorizer(None)
+                self.cache.invalidate(self.database_name)
+        return results
 
     def view_query_as_df(self, query):
-        df = pd.read_sql(query, self.connection)
-        return df
+        def compute():
+            with self.connection() as connection:
+                return pd.read_sql(query, connection)
+        return self._cached('view_query_as_df', query, compute)
 
     def export_query_to_csv(self, query):
         """Execute a query, convert the result to a CSV in memory, and return a BytesIO object."""
-        df = pd.read_sql(query, self.connection)
-        output = BytesIO()
-        df.to_csv(output, index=False)
+        with self.profiler.measure(self, 'export_query_to_csv', query) as measurement:
+            with self.connection() as connection:
+                df = pd.read_sql(query, connection)
+            output = BytesIO()
+            df.to_csv(output, index=False)
+            measurement.rows, measurement.bytes = len(df), output.tell()
         output.seek(0)
         return output
 
-    # def __del__(self):
-    #     self.connection.close()
+    def stream_query_to_csv(self, query, batch_size=EXPORT_BATCH_SIZE, compress=False,
+                            max_part_size=TELEGRAM_UPLOAD_LIMIT, file_name="query_result"):
+        """
+        Execute a query and write the result as CSV without loading it into memory.
+
+        Rows are fetched from the cursor in batches of batch_size and appended to a temporary file
+        that spills to disk, so memory stays flat regardless of the row count. When max_part_size is
+        set, the output is split into several files below that size, each with its own header row.
+
+        :return: A generator of (visible_file_name, file_object) pairs, positioned at the start.
+                 The caller is responsible for closing each file object.
+        """
+        return self.stream_query_export(query, 'csv', batch_size, compress, max_part_size, file_name)
+
+    def stream_query_export(self, query, export_format='csv', batch_size=EXPORT_BATCH_SIZE, compress=False,
+                            max_part_size=TELEGRAM_UPLOAD_LIMIT, file_name="query_result"):
+        """
+        Like stream_query_to_csv, for any of EXPORT_FORMATS.
+
+        Parquet, Arrow IPC and Feather files are written from Arrow record batches built straight from
+        the cursor rows (one Parquet row group per batch). compress gzips CSV, uses zstd instead of
+        snappy for Parquet and compresses Arrow IPC buffers; Feather is always lz4-compressed.
+        """
+        parts = self._export_parts(query, export_format, batch_size, compress, max_part_size, file_name)
+        return self._profiled_stream('stream_query_export', query, parts, _count_part)
+
+    def _export_parts(self, query, export_format, batch_size, compress, max_part_size, file_name):
+        with self.connection() as connection:
+            cursor = connection.execute(query)
+            try:
+                header = [column[0] for column in cursor.description or []]
+                yield from export_rows(header, fetch_batches(cursor, batch_size), export_format, compress,
+                                       max_part_size, file_name)
+            finally:
+                cursor.close()
+
+    def execute_read(self, query, enforce_read_only=True, small_result_rows=SMALL_RESULT_ROWS, export_format='csv',
+                     batch_size=EXPORT_BATCH_SIZE, compress=False, max_part_size=TELEGRAM_UPLOAD_LIMIT,
+                     file_name="query_result", progress=None):
+        """
+        Run a read statement and deliver its result the cheapest way its size allows.
+
+        The first small_result_rows + 1 rows are fetched; a single value is yielded as ('scalar', (column, value)),
+        a result that fits as ('rows', (columns, rows)). Anything larger is announced right away with
+        ('preview', (columns, first_rows)) and continues streaming from the same cursor into
+        ('file', (visible_file_name, file_object)) items as in stream_query_export; progress(rows_so_far) is
+        called after every batch.
+        With enforce_read_only the connection refuses any statement that would write (see read_only_scope).
+        """
+        results = self._read_results(query, enforce_read_only, small_result_rows, export_format, batch_size,
+                                     compress, max_part_size, file_name, progress)
+        return self._profiled_stream('execute_read', query, results, _count_result)
+
+    def _read_results(self, query, enforce_read_only, small_result_rows, export_format, batch_size, compress,
+                      max_part_size, file_name, progress):
+        with ExitStack() as stack:
+            # The authorizer is installed when the connection is borrowed, so the scope need not outlive that
+            with read_only_scope() if enforce_read_only else nullcontext():
+                connection = stack.enter_context(self.connection())
+            cursor = connection.execute(query)
+            stack.callback(cursor.close)
+            columns = [column[0] for column in cursor.description or []]
+            rows = cursor.fetchmany(small_result_rows + 1)
+            if len(rows) <= small_result_rows:
+                stack.close()  # Return the connection before the caller starts sending
+                if len(rows) == 1 and len(columns) == 1:
+                    yield 'scalar', (columns[0], rows[0][0])
+                else:
+                    yield 'rows', (columns, rows)
+                return
+            with _budget_paused():
+                yield 'preview', (columns, rows)
+            batches = chain([rows], fetch_batches(cursor, batch_size))
+            if progress is not None:
+                batches = _reporting(batches, progress)
+            for part in export_rows(columns, batches, export_format, compress, max_part_size, file_name):
+                yield 'file', part
+
+    def fetch_arrow_batches(self, query, batch_size=EXPORT_BATCH_SIZE):
+        """Execute a query and yield its result as pyarrow RecordBatches built directly from the cursor."""
+        return self._profiled_stream('fetch_arrow_batches', query, self._arrow_batches(query, batch_size),
+                                     _count_batch)
+
+    def _arrow_batches(self, query, batch_size):
+        with self.connection() as connection:
+            cursor = connection.execute(query)
+            try:
+                builder = ArrowBatchBuilder([column[0] for column in cursor.description or []])
+                for rows in fetch_batches(cursor, batch_size):
+                    yield builder.build(rows)
+            finally:
+                cursor.close()
+
+    def view_query_as_arrow(self, query):
+        """Execute a query and return the result as a pyarrow Table (no pandas conversion)."""
+        def compute():
+            with self.connection() as connection:
+                cursor = connection.execute(query)
+                try:
+                    builder = ArrowBatchBuilder([column[0] for column in cursor.description or []])
+                    batches = [builder.build(rows) for rows in fetch_batches(cursor, EXPORT_BATCH_SIZE)]
+                finally:
+                    cursor.close()
+            return pa.Table.from_batches(batches, schema=builder.finalize_schema())
+        return self._cached('view_query_as_arrow', query, compute)
+
+    def view_query_page_as_df(self, query, page_number, page_size=PAGE_SIZE):
+        """
+        Run an arbitrary query and return only one page (0-based) of its result as a DataFrame.
+        Rows before the page are skipped on the cursor, so at most page_size rows are held in memory.
+        """
+        def compute():
+            columns, rows = self._fetch_query_page(query, page_number, page_size)
+            return pd.DataFrame.from_records(rows, columns=columns)
+        return self._cached('view_query_page_as_df', query, compute, page_number, page_size)
+
+    def view_query_page_as_arrow(self, query, page_number, page_size=PAGE_SIZE):
+        """Like view_query_page_as_df, returning a pyarrow Table."""
+        def compute():
+            columns, rows = self._fetch_query_page(query, page_number, page_size)
+            return ArrowBatchBuilder(columns).table(rows)
+        return self._cached('view_query_page_as_arrow', query, compute, page_number, page_size)
+
+    def _fetch_query_page(self, query, page_number, page_size):
+        with self.connection() as connection:
+            cursor = connection.execute(query)
+            try:
+                columns = [column[0] for column in cursor.description or []]
+                to_skip = page_number * page_size
+                while to_skip > 0:
+                    skipped = len(cursor.fetchmany(min(to_skip, EXPORT_BATCH_SIZE)))
+                    if not skipped:
+                        break
+                    to_skip -= skipped
+                rows = cursor.fetchmany(page_size)
+            finally:
+                cursor.close()
+        return columns, rows
+
+    def table_pager(self, table, columns, page_size=PAGE_SIZE):
+        """Return the shared TablePager for browsing the given columns of a table page by page."""
+        key = (os.path.abspath(self.database_name), table, tuple(columns), page_size)
+        with _pagers_lock:
+            pager = _pagers.pop(key, None)
+            if pager is None:
+                pager = TablePager(self, table, columns, page_size)
+                if len(_pagers) >= MAX_PAGERS:
+                    del _pagers[next(iter(_pagers))]  # Least recently used
+            _pagers[key] = pager
+        return pager
+
+    def view_page_as_df(self, table, columns, page_number, page_size=PAGE_SIZE):
+        """Fetch a single page (0-based) of a table as a DataFrame."""
+        def compute():
+            column_names, rows = self.table_pager(table, columns, page_size).fetch_page(page_number)
+            return pd.DataFrame.from_records(rows, columns=column_names)
+        query = f"SELECT {', '.join(quote_identifier(column) for column in columns)} FROM {quote_identifier(table)}"
+        return self._cached('view_page_as_df', query, compute, page_number, page_size)
+
+    def view_page_as_arrow(self, table, columns, page_number, page_size=PAGE_SIZE):
+        """Like view_page_as_df, returning a pyarrow Table that Streamlit can render without pandas."""
+        def compute():
+            column_names, rows = self.table_pager(table, columns, page_size).fetch_page(page_number)
+            return ArrowBatchBuilder(column_names).table(rows)
+        query = f"SELECT {', '.join(quote_identifier(column) for column in columns)} FROM {quote_identifier(table)}"
+        return self._cached('view_page_as_arrow', query, compute, page_number, page_size)
+
+
+def _count_part(measurement, part):
+    _, file = part
+    file.seek(0, os.SEEK_END)
+    measurement.bytes += file.tell()
+    file.seek(0)
+
+
+def _count_result(measurement, result):
+    kind, value = result
+    if kind == 'file':
+        _count_part(measurement, value)
+    elif kind != 'preview':
+        measurement.rows = 1 if kind == 'scalar' else len(value[1])
+
+
+def _reporting(batches, progress):
+    rows = 0
+    for batch in batches:
+        rows += len(batch)
+        yield batch
+        progress(rows)
+
+
+def _count_batch(measurement, batch):
+    measurement.rows = (measurement.rows or 0) + batch.num_rows
+    measurement.bytes += batch.nbytes
+
+
+def export_rows(header, batches, export_format='csv', compress=False, max_part_size=TELEGRAM_UPLOAD_LIMIT,
+                file_name="query_result"):
+    """
+    Write batches of rows into export files of one of EXPORT_FORMATS, split below max_part_size.
+
+    :return: A generator of (visible_file_name, file_object) pairs, positioned at the start.
+             The caller is responsible for closing each file object.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {export_format}, use one of: {', '.join(EXPORT_FORMATS)}")
+    if export_format == 'csv':
+        extension = ".csv.gz" if compress else ".csv"
+        chunks = (_encode_csv_rows(rows) for rows in batches)
+        new_part = lambda: _CSVExportPart(header, compress)
+    else:
+        extension = f".{export_format}"
+        builder = ArrowBatchBuilder(header)
+        chunks = (builder.build(rows) for rows in batches)
+        new_part = lambda: _ArrowExportPart(builder.finalize_schema(), export_format, compress)
+    part = None
+    part_number = 1
+    try:
+        for chunk in chunks:
+            part = part or new_part()
+            if max_part_size and part.has_rows and part.size + part.chunk_size(chunk) > max_part_size:
+                finished, part = part.finish(), new_part()
+                yield f"{file_name}.part{part_number}{extension}", finished
+                part_number += 1
+            part.write(chunk)
+        part = part or new_part()
+    except BaseException:
+        if part is not None:
+            part.discard()
+        raise
+    if part_number > 1:
+        yield f"{file_name}.part{part_number}{extension}", part.finish()
+    else:
+        yield f"{file_name}{extension}", part.finish()
+
+
+def _encode_csv_rows(rows):
+    buffer = StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+def fetch_batches(cursor, batch_size):
+    """
+    Yield the rows of an executed cursor in lists of up to batch_size rows, counting them against the
+    QueryBudget of this thread (see budget_scope); the time the consumer spends on a batch is not counted.
+    """
+    budget = getattr(_budget, 'budget', None)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        if budget is not None:
+            budget.rows += len(rows)  # The next fetch is interrupted once this exceeds the budget
+        with _budget_paused():
+            yield rows
+
+
+def _arrow_type(values):
+    """Arrow type for a column from its Python values; columns without values or with mixed values become strings."""
+    kinds = {type(value) for value in values if value is not None}
+    if not kinds:
+        return pa.string()
+    if kinds == {int}:
+        return pa.int64()
+    if kinds <= {int, float}:
+        return pa.float64()
+    if kinds == {bytes}:
+        return pa.binary()
+    return pa.string()
+
+
+class ArrowBatchBuilder:
+    """
+    Turns batches of cursor rows into RecordBatches with one stable schema.
+
+    SQLite values are dynamically typed, so the schema is inferred from the first batch. Later values that do
+    not fit a string column are converted to text; values that do not fit any other type raise an error asking
+    for a CAST in the query.
+    """
+
+    def __init__(self, column_names):
+        self.column_names = column_names
+        self.schema = None
+
+    def finalize_schema(self):
+        if self.schema is None:
+            self.schema = pa.schema([pa.field(name, pa.string()) for name in self.column_names])
+        return self.schema
+
+    def build(self, rows):
+        columns = list(zip(*rows)) if rows else [() for _ in self.column_names]
+        if self.schema is None:
+            self.schema = pa.schema([pa.field(name, _arrow_type(values))
+                                     for name, values in zip(self.column_names, columns)])
+        arrays = [self._array(values, field) for values, field in zip(columns, self.schema)]
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def table(self, rows):
+        return pa.Table.from_batches([self.build(rows)], schema=self.schema)
+
+    @staticmethod
+    def _array(values, field):
+        try:
+            return pa.array(values, type=field.type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            if field.type != pa.string():
+                raise RuntimeError(f"Column {field.name} mixes value types, CAST it in the query to export it.")
+            return pa.array([None if value is None else value.hex() if isinstance(value, bytes) else str(value)
+                             for value in values], type=pa.string())
+
+
+class _CSVExportPart:
+    """A single export file, optionally gzip-compressed, backed by a spooled temporary file."""
+
+    def __init__(self, header, compress):
+        self.file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        self.writer = gzip.GzipFile(fileobj=self.file, mode="wb") if compress else self.file
+        self.has_rows = False
+        if header:
+            self.writer.write(_encode_csv_rows([header]))
+
+    @property
+    def size(self):
+        # For gzip this lags behind by zlib's internal buffer, which is why callers compare it with
+        # the uncompressed chunk length: the chunk always compresses to fewer bytes.
+        return self.file.tell()
+
+    @staticmethod
+    def chunk_size(chunk):
+        return len(chunk)
+
+    def write(self, chunk):
+        self.writer.write(chunk)
+        self.has_rows = True
+
+    def finish(self):
+        if self.writer is not self.file:
+            self.writer.close()
+        self.file.seek(0)
+        return self.file
+
+    def discard(self):
+        self.file.close()
+
+
+class _ArrowExportPart:
+    """A single Parquet, Arrow IPC or Feather file written batch by batch to a spooled temporary file."""
+
+    def __init__(self, schema, export_format, compress):
+        self.file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+        self.sink = pa.PythonFile(self.file, mode="w")
+        if export_format == 'parquet':
+            self.writer = pq.ParquetWriter(self.sink, schema, compression="zstd" if compress else "snappy")
+        else:
+            # Feather v2 is the Arrow IPC file format with lz4-compressed buffers
+            compression = "lz4" if export_format == 'feather' else ("zstd" if compress else None)
+            self.writer = pa.ipc.new_file(self.sink, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+        self.has_rows = False
+
+    @property
+    def size(self):
+        return self.file.tell()
+
+    @staticmethod
+    def chunk_size(batch):
+        # Uncompressed size, never smaller than what the batch adds to the file
+        return batch.nbytes
+
+    def write(self, batch):
+        self.writer.write_batch(batch)
+        self.has_rows = True
+
+    def finish(self):
+        self.writer.close()
+        self.file.seek(0)
+        return self.file
+
+    def discard(self):
+        try:
+            self.writer.close()
+        except (pa.ArrowException, ValueError):
+            pass
+        self.file.close()
+
+
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def file_version(database_name):
+    """
+    Cheap change marker for a database file; the -wal file is included for WAL databases.
+
+    An empty -wal file holds no changes; it is recreated whenever a process opens the database, so its
+    mtime is ignored to keep the version stable across processes (see SharedResultStore).
+    """
+    version = []
+    for path in (database_name, database_name + "-wal"):
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_mtime_ns, stat.st_size) if stat.st_size or path == database_name else None)
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+_pagers = {}
+_pagers_lock = threading.Lock()
+
+
+class TablePager:
+    def __init__(self, viewer, table, columns, page_size=PAGE_SIZE):
+        """
+        Keyset pagination over a table ordered by rowid.
+
+        Each fetched page remembers the last rowid it returned, so the next page starts with an indexed
+        "rowid > ?" lookup instead of an OFFSET scan. Jumping to an unseen page walks the rowid keys from
+        the nearest known boundary. Tables without a rowid fall back to LIMIT/OFFSET.
+        The exact row count is computed on a background thread; until it finishes an estimate is returned.
+        """
+        self.viewer = viewer
+        self.table = table
+        self.columns = list(columns)
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._version = None
+        self._boundaries = {}  # page number -> last rowid of the previous page
+        self._has_rowid = None
+        self._row_count = None
+        self._count_thread = None
+
+    def _reset_if_changed(self):
+        version = file_version(self.viewer.database_name)
+        if version != self._version:
+            self._version = version
+            self._boundaries = {0: None}
+            self._row_count = None
+
+    def _check_rowid(self, connection):
+        if self._has_rowid is None:
+            try:
+                connection.execute(f"SELECT rowid FROM {quote_identifier(self.table)} LIMIT 0")
+                self._has_rowid = True
+            except sqlite3.OperationalError:
+                self._has_rowid = False
+        return self._has_rowid
+
+    def _page_start(self, connection, page_number):
+        """Return the rowid after which the page starts, or None for the first page."""
+        if page_number in self._boundaries:
+            return self._boundaries[page_number]
+        known = max(number for number in self._boundaries if number < page_number)
+        start = self._boundaries[known]
+        skip = (page_number - known) * self.page_size - 1
+        table = quote_identifier(self.table)
+        if start is None:
+            row = connection.execute(f"SELECT rowid FROM {table} ORDER BY rowid LIMIT 1 OFFSET ?",
+                                     (skip,)).fetchone()
+        else:
+            row = connection.execute(f"SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT 1 OFFSET ?",
+                                     (start, skip)).fetchone()
+        if row is None:
+            return _PAST_END
+        self._boundaries[page_number] = row[0]
+        return row[0]
+
+    def fetch_page(self, page_number):
+        """Return (column_names, rows) for a 0-based page number; rows is empty past the end."""
+        table = quote_identifier(self.table)
+        column_list = ", ".join(quote_identifier(column) for column in self.columns)
+        with self._lock, self.viewer.connection() as connection:
+            self._reset_if_changed()
+            if not self._check_rowid(connection):
+                rows = connection.execute(f"SELECT {column_list} FROM {table} LIMIT ? OFFSET ?",
+                                          (self.page_size, page_number * self.page_size)).fetchall()
+                return self.columns, rows
+
+            start = self._page_start(connection, page_number)
+            if start is _PAST_END:
+                return self.columns, []
+            if start is None:
+                rows = connection.execute(f"SELECT rowid, {column_list} FROM {table} ORDER BY rowid LIMIT ?",
+                                          (self.page_size,)).fetchall()
+            else:
+                rows = connection.execute(f"SELECT rowid, {column_list} FROM {table} WHERE rowid > ? "
+                                          f"ORDER BY rowid LIMIT ?", (start, self.page_size)).fetchall()
+            if len(rows) == self.page_size:
+                self._boundaries[page_number + 1] = rows[-1][0]
+        return self.columns, [row[1:] for row in rows]
+
+    def row_count(self):
+        """
+        Return (row_count, exact). The first call starts an exact COUNT(*) in the background and
+        returns an estimate taken from the largest rowid.
+        """
+        with self._lock:
+            self._reset_if_changed()
+            if self._row_count is not None:
+                return self._row_count, True
+            if self._count_thread is None or not self._count_thread.is_alive():
+                self._count_thread = threading.Thread(target=self._count_rows, args=(self._version,), daemon=True)
+                self._count_thread.start()
+        table = quote_identifier(self.table)
+        with self.viewer.connection() as connection:
+            if self._check_rowid(connection):
+                estimate = connection.execute(f"SELECT max(rowid) FROM {table}").fetchone()[0]
+                return estimate or 0, False
+        return 0, False
+
+    def _count_rows(self, version):
+        table = quote_identifier(self.table)
+        try:
+            with self.viewer.connection() as connection:
+                count = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        except (sqlite3.Error, RuntimeError):
+            return
+        with self._lock:
+            if self._version == version:
+                self._row_count = count
+
+    def page_count(self):
+        """Return (number_of_pages, exact) based on row_count()."""
+        count, exact = self.row_count()
+        return max(1, -(-count // self.page_size)), exact
+
 
+_PAST_END = object()
@@ -1,24 +1,43 @@
 import pandas as pd
 import streamlit as st
-from sqlite_handler import SQLViewer
-import os
-import pexpect
-import re
-from settings_reader import read_settings
+from sqlite_handler import SQLViewer, connection_pool, result_cache, pragma_profiles, PAGE_SIZE
+import uuid
+from settings_reader import load_settings
+from catalog import catalog
+from query_profiler import query_profiler
+from job_queue import job_queue
+from result_store import result_store
+from admission import admission
+from backup import backup_manager
+from metrics import metrics
+from streamlit_widgets import (query_profile, metrics_dashboard, index_advisor, import_file_form, script_form,
+                               session_owner, background_jobs, backups, page_selector, catalog_search)
+from mongo_backend import create_backend, DEFAULT_MONGO_URI
+
+
+@st.cache_resource
+def get_mongo_backend(kind, uri):
+    """One backend per Streamlit process, shared by all sessions and reruns."""
+    backend = create_backend(kind, uri)
+    metrics.register_stats('mongo_backend', backend.get_stats, "MongoDB backend of Streamlit")
+    return backend
 
 
 class StreamlitApp:
-    def __init__(self, admin_password, mongosh_allowed_commands):
+    def __init__(self, admin_password, mongosh_allowed_commands, mongo_backend, bot_metrics_url=None):
         self.admin_password = admin_password
         self.mongosh_allowed_commands = mongosh_allowed_commands
+        self.mongo_backend = mongo_backend
+        # The bot runs in another process; its metrics are read from its endpoint
+        self.bot_metrics_url = bot_metrics_url
 
         # Initialize session state
         if 'admin_logged_in' not in st.session_state:
             st.session_state.admin_logged_in = False
 
-        if 'child' not in st.session_state:
-            st.session_state.child = pexpect.spawn('mongosh', encoding='utf-8')
-            st.session_state.child.expect('>')
+        # Key of this browser session in the MongoDB backend (its shell or current database)
+        if 'mongosh_key' not in st.session_state:
+            st.session_state.mongosh_key = uuid.uuid4().hex
 
     def set_theme(self, theme):
         with open('/Users/williamleonheart/.streamlit/config.toml', 'w') as config_file:
@@ -68,57 +87,87 @@ class StreamlitApp:
 
     def admin_process(self):
         st.sidebar.write("You are logged in as Admin.")
-        tab1, tab2 = st.tabs(["SQLite", "MongoDB"])
+        with st.sidebar.expander("Connection pool"):
+            st.json(connection_pool.get_stats())
+        with st.sidebar.expander("Result cache"):
+            st.json(result_cache.get_stats())
+        with st.sidebar.expander("Shared result store"):
+            st.json(result_store.get_stats())
+        with st.sidebar.expander("Catalog"):
+            st.json(catalog.get_stats())
+        with st.sidebar.expander("Admission control"):
+            st.json(admission.get_stats())
+        with st.sidebar.expander("Backups"):
+            st.json(backup_manager.get_stats())
+        with st.sidebar.expander("Background jobs"):
+            st.json(job_queue.get_stats())
+        with st.sidebar.expander("MongoDB backend"):
+            st.json(self.mongo_backend.get_stats())
+        tab1, tab2, tab3, tab4, tab5 = st.tabs(["SQLite", "MongoDB", "Query profile", "Index advisor", "Metrics"])
         with tab1:
             self.handle_sqlite_admin()
         with tab2:
             self.mongosh_process(is_admin=True)
+        with tab3:
+            query_profile()
+        with tab4:
+            index_advisor()
+        with tab5:
+            metrics_dashboard(self.bot_metrics_url)
 
     def handle_sqlite_user(self):
         st.header("Choose a database to connect")
-        dbs_list = os.listdir("SQLite_databases")
+        dbs_list = catalog.databases()
         df = pd.DataFrame(dbs_list, columns=['Databases'])
         st.dataframe(df, use_container_width=True, hide_index=True)
+        catalog_search()
 
         db_name = st.text_input("Current connection")
 
         # Ensure the input is not empty before checking for a valid connection
         if db_name:
             if db_name in dbs_list:
-                sv = SQLViewer(f"SQLite_databases/{db_name}")
-                tables_in_db = sv.simple_view(f"SELECT name FROM sqlite_master WHERE type='table';")
-                table_names = [item[0] for item in tables_in_db]
+                sv = SQLViewer(f"SQLite_databases/{db_name}", read_only=True)
+                table_names = catalog.tables(db_name)
 
                 # Show tables
                 selected_table = st.selectbox("Select a table", options=table_names)
 
                 if selected_table:
-                    columns_in_table = sv.simple_view(f"PRAGMA table_info({selected_table});")
-                    column_names = [item[1] for item in columns_in_table]
+                    column_names = catalog.columns(db_name, selected_table)
 
                     # Dropdown for selecting columns to display
                     selected_columns = st.multiselect("Select columns to display", options=column_names,
                                                       default=column_names)
 
-                    # Button to execute SELECT query
+                    # Button to execute SELECT query; the selection is kept so paging survives reruns
                     if st.button("Execute SELECT"):
                         if selected_columns:
-                            query = f"SELECT {', '.join(selected_columns)} FROM {selected_table};"
-                            try:
-                                df = sv.view_query_as_df(query)
-                                st.dataframe(df, use_container_width=True, hide_index=True)
-                            except Exception as e:
-                                st.text(f"Error processing SELECT query: {str(e)}")
+                            st.session_state.browsed_table = (db_name, selected_table, tuple(selected_columns))
                         else:
                             st.text("Please select at least one column.")
+
+                    if st.session_state.get('browsed_table') == (db_name, selected_table, tuple(selected_columns)):
+                        try:
+                            pager = sv.table_pager(selected_table, selected_columns)
+                            page_count, exact = pager.page_count()
+                            page_number = page_selector(page_count, exact, key='user_page')
+                            # Arrow tables are handed to the frontend without a pandas conversion
+                            # A page is a keyset lookup, so it is charged as its rows instead of the table scan
+                            with admission.admit(session_owner(), sv, None, cost=PAGE_SIZE):
+                                table = sv.view_page_as_arrow(selected_table, selected_columns, page_number)
+                            st.dataframe(table, use_container_width=True, hide_index=True)
+                        except Exception as e:
+                            st.text(f"Error processing SELECT query: {str(e)}")
             else:
                 st.text("Invalid connection.")
 
     def handle_sqlite_admin(self):
         st.header("Choose a database to connect")
-        dbs_list = os.listdir("SQLite_databases")
+        dbs_list = catalog.databases()
         df = pd.DataFrame(dbs_list, columns=['Databases'])
         st.dataframe(df, use_container_width=True, hide_index=True)
+        catalog_search()
 
         db_name = st.text_input("Current connection")
 
@@ -126,10 +175,14 @@ class StreamlitApp:
         if db_name:
             if db_name in dbs_list:
                 sv = SQLViewer(f"SQLite_databases/{db_name}")
-                tables_in_db = sv.simple_view(f"SELECT name FROM sqlite_master WHERE type='table';")
-                table_names = [item[0] for item in tables_in_db]
-                df = pd.DataFrame(table_names, columns=['Tables'])
+                tables = catalog.database(db_name).tables.values()
+                df = pd.DataFrame([(table.name, table.row_estimate, len(table.indexes)) for table in tables],
+                                  columns=['Tables', 'Rows (approx.)', 'Indexes'])
                 st.dataframe(df, use_container_width=True, hide_index=True)
+                import_file_form(sv, db_name)
+                script_form(sv, db_name)
+                background_jobs(db_name)
+                backups(db_name)
 
                 # Using a form to explicitly submit the query
                 with st.form("query_form"):
@@ -138,21 +191,32 @@ class StreamlitApp:
 
                 if submit_query:
                     if query.strip():  # Ensure the query is not just whitespace
-                        query_lower = query.lower()
-                        if query_lower.startswith(("insert", "update", "delete", "drop", "create", "alter")):
+                        try:
+                            read_only = sv.classify(query).read_only
+                        except Exception as e:
+                            read_only = None
+                            st.text(f"Error processing query: {str(e)}")
+                        if read_only is False:
                             try:
                                 sv.executor(query)
                                 st.text("Query processed successfully.")
                             except Exception as e:
                                 st.text(f"Error processing query: {str(e)}")
-                        else:
-                            try:
-                                df = sv.view_query_as_df(query)
-                                st.dataframe(df, use_container_width=True, hide_index=True)
-                            except Exception as e:
-                                st.text(f"Error processing SELECT query: {str(e)}")
+                        elif read_only:
+                            st.session_state.admin_query = (db_name, query)
+                            st.session_state.admin_page = 1
                     else:
                         st.text("Please enter a valid query.")
+
+                if st.session_state.get('admin_query', (None, None))[0] == db_name:
+                    try:
+                        page_number = page_selector(None, False, key='admin_page')
+                        query = st.session_state.admin_query[1]
+                        with admission.admit(session_owner(), sv, query, privileged=True):
+                            table = sv.view_query_page_as_arrow(query, page_number)
+                        st.dataframe(table, use_container_width=True, hide_index=True)
+                    except Exception as e:
+                        st.text(f"Error processing SELECT query: {str(e)}")
             else:
                 st.text("Invalid connection.")
 
@@ -160,15 +224,11 @@ class StreamlitApp:
         command = st.text_area("Enter command", key='mongo_command')
         if command:
             if is_admin or command in self.mongosh_allowed_commands:
-                st.session_state.child.sendline(command)
-                st.session_state.child.expect('>')
-                output = st.session_state.child.before
-                cleaned_output = re.sub(r'\x1B[@-_][0-?]*[ -/]*[@-~]', '', output)
-                cleaned_output_lines = cleaned_output.splitlines()
-                if cleaned_output_lines:
-                    cleaned_output_lines[-1] += ' >'
-                    cleaned_output = '\n'.join(cleaned_output_lines)
-                st.session_state.latest_output = cleaned_output
+                try:
+                    output = self.mongo_backend.run(st.session_state.mongosh_key, command, read_only=not is_admin)
+                except Exception as e:
+                    output = f"Error: {str(e)}"
+                st.session_state.latest_output = output
             else:
                 st.text("This command is unavailable for you.")
         if 'latest_output' in st.session_state:
@@ -176,8 +236,59 @@ class StreamlitApp:
 
 
 if __name__ == "__main__":
-    ADMIN_PASSWORD = read_settings('settings.txt')['ADMIN_PASSWORD']
-    MONGOSH_ALLOWED_COMMANDS = read_settings('settings.txt')['MONGOSH_ALLOWED_COMMANDS']
+    SETTINGS = load_settings('settings.txt')
+    ADMIN_PASSWORD = SETTINGS['ADMIN_PASSWORD']
+    SQLITE_PRAGMAS, SQLITE_DATABASE_PRAGMAS = pragma_profiles(SETTINGS)
+    QUERY_LOG_PATH = SETTINGS.get_optional('QUERY_LOG_PATH')
+    SLOW_QUERY_SECONDS = SETTINGS.get_float('SLOW_QUERY_SECONDS', 1)
+    JOB_QUEUE_PATH = SETTINGS.get_optional('JOB_QUEUE_PATH')
+    JOB_RESULT_DIR = SETTINGS.get('JOB_RESULT_DIR', 'job_results')
+    JOB_WORKERS = SETTINGS.get_int('JOB_WORKERS', 2)
+    JOB_MAX_PER_USER = SETTINGS.get_int('JOB_MAX_PER_USER', 1)
+    JOB_MAX_PER_DATABASE = SETTINGS.get_int('JOB_MAX_PER_DATABASE', 2)
+    JOB_TIMEOUT = SETTINGS.get_int('JOB_TIMEOUT', 3600)
+    JOB_MAX_QUEUED_PER_USER = SETTINGS.get_int('JOB_MAX_QUEUED_PER_USER', 5)
+    JOB_MAX_ROWS = SETTINGS.get_int('JOB_MAX_ROWS', 10000000)
+    RESULT_STORE_DIR = SETTINGS.get_optional('RESULT_STORE_DIR')
+    RESULT_STORE_MAX_MB = SETTINGS.get_int('RESULT_STORE_MAX_MB', 512)
+    ADMISSION_USER_ROWS_PER_SECOND = SETTINGS.get_int('ADMISSION_USER_ROWS_PER_SECOND', 100000)
+    ADMISSION_USER_BURST_ROWS = SETTINGS.get_int('ADMISSION_USER_BURST_ROWS', 2000000)
+    ADMISSION_DATABASE_ROWS_PER_SECOND = SETTINGS.get_int('ADMISSION_DATABASE_ROWS_PER_SECOND', 1000000)
+    ADMISSION_DATABASE_BURST_ROWS = SETTINGS.get_int('ADMISSION_DATABASE_BURST_ROWS', 20000000)
+    ADMISSION_MAX_COST_ROWS = SETTINGS.get_int('ADMISSION_MAX_COST_ROWS', 20000000)
+    ADMISSION_MAX_CONCURRENT = SETTINGS.get_int('ADMISSION_MAX_CONCURRENT', 4)
+    ADMISSION_MAX_WAIT = SETTINGS.get_float('ADMISSION_MAX_WAIT', 10)
+    QUERY_MAX_ROWS = SETTINGS.get_int('QUERY_MAX_ROWS', 1000000)
+    QUERY_MAX_SECONDS = SETTINGS.get_float('QUERY_MAX_SECONDS', 30)
+    METRICS_HOST = SETTINGS.get('METRICS_HOST', '127.0.0.1')
+    METRICS_PORT = SETTINGS.get_int('METRICS_PORT')
+    METRICS_STREAMLIT_PORT = SETTINGS.get_int('METRICS_STREAMLIT_PORT')
+    BACKUP_DIR = SETTINGS.get_optional('BACKUP_DIR')
+    BACKUP_INTERVAL = SETTINGS.get_int('BACKUP_INTERVAL', 0)
+    BACKUP_KEEP = SETTINGS.get_int('BACKUP_KEEP', 7)
+    BACKUP_PAGES_PER_STEP = SETTINGS.get_int('BACKUP_PAGES_PER_STEP', 1024)
+    BACKUP_STEP_PAUSE = SETTINGS.get_float('BACKUP_STEP_PAUSE', 0)
+    MONGOSH_ALLOWED_COMMANDS = SETTINGS['MONGOSH_ALLOWED_COMMANDS']
+    MONGO_BACKEND = SETTINGS.get('MONGO_BACKEND', 'mongosh')
+    MONGO_URI = SETTINGS.get('MONGO_URI', DEFAULT_MONGO_URI)
 
-    app = StreamlitApp(ADMIN_PASSWORD, MONGOSH_ALLOWED_COMMANDS)
+    connection_pool.configure(SQLITE_PRAGMAS, SQLITE_DATABASE_PRAGMAS)
+    query_profiler.configure(QUERY_LOG_PATH, SLOW_QUERY_SECONDS)
+    result_store.configure(RESULT_STORE_DIR, RESULT_STORE_MAX_MB * 1024 * 1024)
+    admission.configure(ADMISSION_USER_ROWS_PER_SECOND, ADMISSION_USER_BURST_ROWS, ADMISSION_DATABASE_ROWS_PER_SECOND,
+                        ADMISSION_DATABASE_BURST_ROWS, max_cost=ADMISSION_MAX_COST_ROWS,
+                        max_concurrent=ADMISSION_MAX_CONCURRENT, max_wait=ADMISSION_MAX_WAIT, max_rows=QUERY_MAX_ROWS,
+                        max_seconds=QUERY_MAX_SECONDS)
+    job_queue.configure(JOB_QUEUE_PATH, JOB_RESULT_DIR, workers=JOB_WORKERS, max_per_owner=JOB_MAX_PER_USER,
+                        max_per_database=JOB_MAX_PER_DATABASE, job_timeout=JOB_TIMEOUT, pragmas=SQLITE_PRAGMAS,
+                        database_pragmas=SQLITE_DATABASE_PRAGMAS, max_queued_per_owner=JOB_MAX_QUEUED_PER_USER,
+                        max_rows=JOB_MAX_ROWS)
+    job_queue.start()
+    backup_manager.configure(BACKUP_DIR, interval=BACKUP_INTERVAL, keep=BACKUP_KEEP,
+                             pages_per_step=BACKUP_PAGES_PER_STEP, step_pause=BACKUP_STEP_PAUSE)
+    backup_manager.start()
+    if METRICS_STREAMLIT_PORT:
+        metrics.serve(METRICS_STREAMLIT_PORT, METRICS_HOST)
+    app = StreamlitApp(ADMIN_PASSWORD, MONGOSH_ALLOWED_COMMANDS, get_mongo_backend(MONGO_BACKEND, MONGO_URI),
+                       f"http://{METRICS_HOST}:{METRICS_PORT}/metrics" if METRICS_PORT else None)
     app.main()
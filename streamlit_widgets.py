@@ -0,0 +1,227 @@
+import os
+import uuid
+import pandas as pd
+import streamlit as st
+from sqlite_handler import SQLViewer, EXPORT_FORMATS
+from catalog import catalog
+from query_profiler import query_profiler, format_duration
+from index_advisor import IndexAdvisor
+from job_queue import job_queue
+from backup import backup_manager
+from metrics import metrics, parse_metrics, fetch_metrics, histogram_summary
+from bulk_import import import_file, table_name_for, IMPORT_FORMATS
+
+
+def query_profile():
+    """Latency percentiles per SQLViewer operation and the slowest logged statements."""
+    percentiles = query_profiler.percentiles()
+    if percentiles:
+        df = pd.DataFrame([{'Operation': operation, 'Calls': stats['calls'],
+                            **{name: format_duration(stats[name]) for name in ('p50', 'p95', 'p99', 'max')}}
+                           for operation, stats in percentiles.items()])
+        st.dataframe(df, use_container_width=True, hide_index=True)
+    else:
+        st.text("No queries recorded yet.")
+    st.subheader(f"Slowest queries (over {format_duration(query_profiler.slow_threshold)})")
+    for record in query_profiler.slowest(20):
+        with st.expander(f"{format_duration(record['duration'])}  {record['database']}  {record['query'][:80]}"):
+            st.code(record['query'], language="sql")
+            st.text(f"Operation: {record['operation']}, rows: {record['rows']}, bytes: {record['bytes']}")
+            if record['plan']:
+                st.code(record['plan'])
+
+
+def metrics_dashboard(bot_metrics_url=None):
+    """Counters, gauges and latency histograms of this Streamlit process or of the bot."""
+    sources = ["Streamlit"] + (["Bot"] if bot_metrics_url else [])
+    source = st.radio("Process", sources, horizontal=True, key='metrics_source')
+    st.button("Refresh", key='metrics_refresh')
+    try:
+        samples = parse_metrics(metrics.render()) if source == "Streamlit" else fetch_metrics(bot_metrics_url)
+    except OSError as e:
+        st.text(f"Could not read {bot_metrics_url}: {str(e)}")
+        return
+    name_filter = st.text_input("Filter metrics", key='metrics_filter')
+    histograms = [row for row in histogram_summary(samples) if name_filter in row[0]]
+    if histograms:
+        st.subheader("Latencies and sizes")
+        df = pd.DataFrame([(name, ", ".join(f"{key}={value}" for key, value in labels.items()), count, mean,
+                            p50, p95, p99) for name, labels, count, mean, p50, p95, p99 in histograms],
+                          columns=['Metric', 'Labels', 'Count', 'Mean', 'p50 ≤', 'p95 ≤', 'p99 ≤'])
+        st.dataframe(df, use_container_width=True, hide_index=True)
+    values = [(name, ", ".join(f"{key}={value}" for key, value in labels.items()), value)
+              for name, labels, value in samples
+              if not name.endswith(('_bucket', '_sum')) and name_filter in name and
+              not (name.endswith('_count') and any(name[:-len('_count')] == row[0] for row in histograms))]
+    st.subheader("Counters and gauges")
+    st.dataframe(pd.DataFrame(values, columns=['Metric', 'Labels', 'Value']), use_container_width=True,
+                 hide_index=True)
+
+
+def index_advisor():
+    """Suggest indexes for the queries observed on a database and create the chosen ones."""
+    db_name = st.selectbox("Database", options=catalog.databases(), key='advisor_db')
+    if db_name and st.button("Analyze workload"):
+        with st.spinner("Replaying the observed queries on a copy of the database..."):
+            st.session_state.index_suggestions = (db_name, IndexAdvisor(f"SQLite_databases/{db_name}").suggest())
+    advised_db, suggestions = st.session_state.get('index_suggestions', (None, []))
+    if advised_db != db_name:
+        return
+    if not suggestions:
+        st.text("No index would speed up the queries observed so far.")
+    for number, suggestion in enumerate(suggestions):
+        st.code(suggestion.statement, language="sql")
+        st.text(f"{suggestion.calls} calls, replay {format_duration(suggestion.baseline)} -> "
+                f"{format_duration(suggestion.indexed)}, about {format_duration(suggestion.benefit)} saved so far")
+        if st.button("Create index", key=f"apply_index_{number}"):
+            try:
+                SQLViewer(f"SQLite_databases/{db_name}").executor(suggestion.statement)
+                st.text("Index created.")
+            except Exception as e:
+                st.text(f"Error processing query: {str(e)}")
+
+
+def import_file_form(sv, db_name):
+    """Load an uploaded CSV, Parquet or Arrow file into a table of the current database."""
+    with st.expander("Import a file"):
+        uploaded = st.file_uploader("File", type=list(IMPORT_FORMATS) + ['gz'], key=f'import_{db_name}')
+        if uploaded is None:
+            return
+        table = st.text_input("Table", value=table_name_for(uploaded.name), key=f'import_table_{db_name}')
+        if_exists = st.radio("If the table exists", options=['append', 'replace', 'fail'], horizontal=True,
+                             key=f'import_if_exists_{db_name}')
+        if st.button("Import", key=f'import_button_{db_name}'):
+            bar = st.progress(0.0, text="Importing...")
+
+            def progress(rows, total_rows):
+                bar.progress(min(rows / total_rows, 1.0) if total_rows else 0.0, text=f"{rows:,} rows imported")
+
+            try:
+                table, rows, seconds = import_file(sv, uploaded, uploaded.name, table=table, if_exists=if_exists,
+                                                   progress=progress)
+                bar.progress(1.0, text=f"Imported {rows:,} rows into {table} in {format_duration(seconds)} "
+                                       f"({rows / max(seconds, 1e-9):,.0f} rows/s).")
+            except Exception as e:
+                st.text(f"Error importing {uploaded.name}: {str(e)}")
+
+
+def script_form(sv, db_name):
+    """Run a multi-statement script, typed or uploaded as an .sql file, in one transaction."""
+    with st.expander("Run a script"):
+        script = st.text_area("Statements", key=f'script_{db_name}')
+        uploaded = st.file_uploader(".sql file", type=['sql'], key=f'script_file_{db_name}')
+        atomic = st.checkbox("Roll everything back if a statement fails", value=True,
+                             key=f'script_atomic_{db_name}')
+        if st.button("Run script", key=f'script_button_{db_name}'):
+            if uploaded is not None:
+                script = uploaded.getvalue().decode('utf-8')
+            try:
+                results = sv.execute_script(script, atomic=atomic)
+            except Exception as e:
+                st.text(f"Error processing script: {str(e)}")
+                return
+            failed = [result for result in results if result.error]
+            if failed and atomic:
+                st.text(f"Statement {len(results)} failed, nothing was changed: {failed[0].error}")
+            else:
+                st.text(f"Committed {len(results) - len(failed)} of {len(results)} statements in "
+                        f"{format_duration(sum(result.seconds for result in results))}.")
+            df = pd.DataFrame([(format_duration(result.seconds),
+                                result.rows if result.rows is not None and result.rows >= 0 else None,
+                                result.error, result.statement) for result in results],
+                              columns=['Time', 'Rows', 'Error', 'Statement'])
+            st.dataframe(df, use_container_width=True)
+
+
+def session_owner():
+    """Identifies this browser session for the per-user limits of background jobs and admission control."""
+    if 'session_owner' not in st.session_state:
+        st.session_state.session_owner = f"streamlit:{uuid.uuid4().hex}"
+    return st.session_state.session_owner
+
+
+def background_jobs(db_name):
+    """Queue long queries as background jobs and download their results once they are done."""
+    with st.expander("Background jobs"):
+        if not job_queue.enabled:
+            st.text("Background jobs are not enabled (set JOB_QUEUE_PATH).")
+            return
+        owner = session_owner()
+        query = st.text_area("Query", key=f'job_query_{db_name}')
+        export_format = st.selectbox("Format", options=EXPORT_FORMATS, key=f'job_format_{db_name}')
+        if st.button("Queue job", key=f'job_submit_{db_name}'):
+            try:
+                job_id = job_queue.submit(owner, f"SQLite_databases/{db_name}", query, export_format,
+                                          privileged=True)
+                st.text(f"Job {job_id} queued.")
+            except Exception as e:
+                st.text(f"Error: {str(e)}")
+        st.button("Refresh", key=f'job_refresh_{db_name}')
+        for job in job_queue.jobs(owner):
+            status, action = st.columns([5, 1])
+            status.text(f"{job.id}. {job.status}, {job.rows:,} rows: {job.query[:80]}")
+            if not job.finished and action.button("Cancel", key=f'job_cancel_{job.id}'):
+                job_queue.cancel(job.id, owner)
+            if job.error:
+                st.text(job.error)
+            for path in job.files:
+                with open(path, 'rb') as result_file:
+                    st.download_button(os.path.basename(path), result_file.read(),
+                                       file_name=os.path.basename(path), key=f'job_file_{path}')
+
+
+def backups(db_name):
+    """Take a snapshot of the database now, or restore one of its snapshots."""
+    with st.expander("Backups"):
+        if not backup_manager.enabled:
+            st.text("Backups are not enabled (set BACKUP_DIR).")
+            return
+        if st.button("Snapshot now", key=f'backup_{db_name}'):
+            progress_bar = st.progress(0.0)
+            try:
+                result = backup_manager.snapshot(
+                    db_name, progress=lambda done, total: progress_bar.progress(done / total if total else 1.0))
+                st.text(f"Snapshot {result.snapshot.name}: {result.describe()}, "
+                        f"{result.snapshot.size / 1024 / 1024:.1f} MB compressed.")
+            except Exception as e:
+                st.text(f"Error: {str(e)}")
+        snapshots = backup_manager.snapshots(db_name)
+        if not snapshots:
+            st.text("No snapshots yet.")
+            return
+        df = pd.DataFrame([(snapshot.name, pd.Timestamp(snapshot.created_at, unit='s'),
+                            snapshot.size / 1024 / 1024) for snapshot in snapshots],
+                          columns=['Snapshot', 'Taken at (UTC)', 'Size (MB)'])
+        st.dataframe(df, use_container_width=True, hide_index=True)
+        name = st.selectbox("Restore snapshot", options=[snapshot.name for snapshot in snapshots],
+                            key=f'restore_choice_{db_name}')
+        confirmed = st.checkbox(f"Replace the current contents of {db_name}; they are saved as a pre-restore "
+                                f"snapshot first", key=f'restore_confirm_{db_name}')
+        if st.button("Restore", key=f'restore_{db_name}', disabled=not confirmed):
+            try:
+                result, saved = backup_manager.restore(db_name, name)
+                st.text(f"Restored {name}: {result.describe()}. The previous state is {saved.snapshot.name}.")
+            except Exception as e:
+                st.text(f"Error: {str(e)}")
+
+
+def page_selector(page_count, exact, key):
+    """Render page navigation and return the selected 0-based page number."""
+    if page_count is None:
+        label = "Page"
+    else:
+        label = f"Page (of {page_count})" if exact else f"Page (of ~{page_count}, counting rows...)"
+    page = st.number_input(label, min_value=1, max_value=page_count if exact else None, step=1, key=key)
+    return int(page) - 1
+
+
+def catalog_search():
+    """Search table and column names across every database."""
+    text = st.text_input("Search tables and columns")
+    if text:
+        matches = catalog.search(text)
+        if matches:
+            df = pd.DataFrame(matches, columns=['Database', 'Table', 'Column'])
+            st.dataframe(df, use_container_width=True, hide_index=True)
+        else:
+            st.text("Nothing found.")
@@ -0,0 +1,104 @@
+import gzip
+import threading
+import time
+from io import BytesIO
+from lazy_imports import LazyModule
+
+MESSAGE_LIMIT = 4096
+EDIT_INTERVAL = 1.5  # Seconds between two edits of one chat's messages; Telegram allows about one per second
+apihelper = LazyModule('telebot.apihelper')
+
+
+def format_rows(columns, rows):
+    """Rows as a plain text table, one line per row."""
+    lines = [" | ".join(columns)] + [" | ".join("NULL" if value is None else str(value) for value in row)
+                                     for row in rows]
+    return "\n".join(lines) if rows else "\n".join(lines + ["(no rows)"])
+
+
+def truncate(text, limit=MESSAGE_LIMIT):
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+class ChatThrottle:
+    def __init__(self, interval=EDIT_INTERVAL):
+        """
+        Spaces out the API calls made for one chat and honours the retry_after of "Too Many Requests" errors.
+
+        :param interval: Minimum seconds between two calls for the same chat.
+        """
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next_call = {}  # chat_id -> monotonic time of the next allowed call
+
+    def ready(self, chat_id):
+        """True if a call for the chat may be made now (it is then accounted for)."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_call.get(chat_id, 0):
+                return False
+            self._next_call[chat_id] = now + self.interval
+            return True
+
+    def wait(self, chat_id):
+        """Block until a call for the chat may be made."""
+        while True:
+            with self._lock:
+                delay = self._next_call.get(chat_id, 0) - time.monotonic()
+                if delay <= 0:
+                    self._next_call[chat_id] = time.monotonic() + self.interval
+                    return
+            time.sleep(delay)
+
+    def back_off(self, chat_id, seconds):
+        with self._lock:
+            self._next_call[chat_id] = max(self._next_call.get(chat_id, 0), time.monotonic() + seconds)
+
+
+class ProgressMessage:
+    def __init__(self, bot, chat_id, text, throttle):
+        """
+        One message edited in place while a result streams in.
+
+        update() only edits when the chat's throttle allows it, so a fast producer is coalesced into a few
+        edits instead of queueing one API call per batch; finish() always shows the final text.
+        """
+        self.bot = bot
+        self.chat_id = chat_id
+        self.throttle = throttle
+        self.text = truncate(text)
+        throttle.wait(chat_id)
+        self.message_id = bot.send_message(chat_id, self.text).message_id
+
+    def update(self, text):
+        text = truncate(text)
+        if text != self.text and self.throttle.ready(self.chat_id):
+            self._edit(text)
+
+    def finish(self, text):
+        text = truncate(text)
+        if text != self.text:
+            self.throttle.wait(self.chat_id)
+            self._edit(text)
+
+    def _edit(self, text):
+        try:
+            self.bot.edit_message_text(text, self.chat_id, self.message_id)
+            self.text = text
+        except apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 5)
+                self.throttle.back_off(self.chat_id, retry_after)
+            # Anything else ("message is not modified", deleted message) just skips this update
+
+
+def send_text(bot, chat_id, text, file_name="output.txt"):
+    """
+    Send text in one message, or a preview message plus the whole text as a single gzipped document.
+    """
+    if len(text) <= MESSAGE_LIMIT:
+        bot.send_message(chat_id, text)
+        return
+    preview = text[:MESSAGE_LIMIT - 200].rsplit("\n", 1)[0]
+    bot.send_message(chat_id, f"{preview}\n\n… {len(text):,} characters in total, see the attached file.")
+    bot.send_document(chat_id, BytesIO(gzip.compress(text.encode("utf-8"))), visible_file_name=f"{file_name}.gz")
@@ -0,0 +1,199 @@
+import unittest
+from mongo_backend import CommandParseError, DriverBackend, parse_command
+
+
+class FakeCursor:
+    """The part of pymongo's Cursor that DriverBackend uses, over a list of documents."""
+
+    def __init__(self, documents, calls):
+        self.documents = list(documents)
+        self.calls = calls
+        self.closed = False
+
+    def max_time_ms(self, milliseconds):
+        self.calls.append(('max_time_ms', milliseconds))
+        return self
+
+    def sort(self, keys):
+        for field, direction in reversed(keys):
+            self.documents.sort(key=lambda document: document[field], reverse=direction < 0)
+        return self
+
+    def skip(self, count):
+        self.documents = self.documents[count:]
+        return self
+
+    def limit(self, count):
+        self.documents = self.documents[:count] if count else self.documents
+        return self
+
+    def batch_size(self, size):
+        self.calls.append(('batch_size', size))
+        return self
+
+    def __iter__(self):
+        return iter(self.documents)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCollection:
+    def __init__(self, calls):
+        self.documents = []
+        self.calls = calls
+
+    def _matching(self, query=None):
+        return [document for document in self.documents
+                if all(document.get(field) == value for field, value in (query or {}).items())]
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(self._matching(query), self.calls)
+
+    def find_one(self, query=None, projection=None, **kwargs):
+        self.calls.append(('find_one', kwargs))
+        matching = self._matching(query)
+        return matching[0] if matching else None
+
+    def count_documents(self, query, **kwargs):
+        self.calls.append(('count_documents', kwargs))
+        return len(self._matching(query))
+
+    def estimated_document_count(self, **kwargs):
+        self.calls.append(('estimated_document_count', kwargs))
+        return len(self.documents)
+
+    def distinct(self, field, query=None, **kwargs):
+        self.calls.append(('distinct', kwargs))
+        return sorted({document[field] for document in self._matching(query) if field in document})
+
+    def aggregate(self, pipeline, **kwargs):
+        self.calls.append(('aggregate', kwargs))
+        documents = self.documents
+        for stage in pipeline:
+            if '$match' in stage:
+                documents = [document for document in documents
+                             if all(document.get(field) == value for field, value in stage['$match'].items())]
+        return FakeCursor(documents, self.calls)
+
+    def insert_one(self, document):
+        self.documents.append(document)
+        return type('InsertOneResult', (), {'acknowledged': True, 'inserted_id': len(self.documents)})()
+
+    def drop(self):
+        self.documents = []
+
+
+class FakeDatabase(dict):
+    def __init__(self, calls):
+        super().__init__()
+        self.calls = calls
+
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection(self.calls)
+        return collection
+
+    def list_collection_names(self):
+        return list(self)
+
+
+class FakeClient(dict):
+    """In-process stand-in for pymongo.MongoClient."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def __missing__(self, name):
+        database = self[name] = FakeDatabase(self.calls)
+        return database
+
+    def list_database_names(self):
+        return list(self)
+
+    def close(self):
+        pass
+
+
+class ParseCommandTest(unittest.TestCase):
+    def test_shell_commands(self):
+        self.assertEqual(parse_command("show dbs").kind, 'show_dbs')
+        self.assertEqual(parse_command("show collections").kind, 'show_collections')
+        command = parse_command("use shop;")
+        self.assertEqual((command.kind, command.database), ('use', 'shop'))
+
+    def test_find_with_modifiers(self):
+        command = parse_command('db.orders.find({status: "new", total: {$gt: 10.5}}, {_id: 0})'
+                                '.sort({total: -1}).skip(2).limit(5)')
+        self.assertEqual((command.kind, command.collection, command.method), ('collection', 'orders', 'find'))
+        self.assertEqual(command.args, [{'status': 'new', 'total': {'$gt': 10.5}}, {'_id': 0}])
+        self.assertEqual(command.modifiers, [('sort', [{'total': -1}]), ('skip', [2]), ('limit', [5])])
+        self.assertFalse(command.is_write)
+
+    def test_dotted_collection_and_literals(self):
+        command = parse_command("db.logs.errors.find({level: 'error', tags: ['a', \"b\"], ok: true, note: null})")
+        self.assertEqual(command.collection, 'logs.errors')
+        self.assertEqual(command.args, [{'level': 'error', 'tags': ['a', 'b'], 'ok': True, 'note': None}])
+
+    def test_writes(self):
+        self.assertTrue(parse_command("db.orders.insertOne({a: 1})").is_write)
+        self.assertTrue(parse_command("db.orders.aggregate([{$match: {a: 1}}, {$out: 'copy'}])").is_write)
+        self.assertFalse(parse_command("db.orders.aggregate([{$match: {a: 1}}])").is_write)
+
+    def test_rejects_unsupported_commands(self):
+        for text in ("db.dropDatabase()", "db.orders.mapReduce()", "db.orders.find().explain()",
+                     "db.orders.findOne().limit(1)", "db.orders.aggregate([]).sort({a: 1})", "db.orders.find().limit()",
+                     "db.orders.find().limit('5')", "db.orders.find().pretty(1)", "db.orders.find() extra",
+                     "rs.status()"):
+            with self.subTest(text=text), self.assertRaises(CommandParseError):
+                parse_command(text)
+
+
+class DriverBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.client['test']['items'].documents = [{'n': n, 'even': n % 2 == 0} for n in range(10)]
+        self.backend = DriverBackend(client=self.client, batch_size=4, max_documents=5, command_timeout=2)
+
+    def test_find(self):
+        output = self.backend.run('chat', "db.items.find({even: true}).sort({n: -1}).limit(2)")
+        self.assertIn('"n": 8', output)
+        self.assertIn('"n": 6', output)
+        self.assertNotIn('"n": 4', output)
+        self.assertIn(('max_time_ms', 2000), self.client.calls)
+        self.assertIn(('batch_size', 4), self.client.calls)
+
+    def test_batch_size_modifier(self):
+        self.backend.run('chat', "db.items.find().batchSize(2).toArray()")
+        self.assertIn(('batch_size', 2), self.client.calls)
+        self.backend.run('chat', "db.items.aggregate([]).batchSize(3)")
+        self.assertEqual(self.client.calls[-1], ('aggregate', {'batchSize': 3, 'maxTimeMS': 2000}))
+
+    def test_truncation(self):
+        self.assertIn("output truncated after 5 documents", self.backend.run('chat', "db.items.find()"))
+        self.assertNotIn("truncated", self.backend.run('chat', "db.items.find().limit(5)"))
+
+    def test_reads_have_a_time_limit(self):
+        self.assertEqual(self.backend.run('chat', "db.items.find({even: true}).count()"), '5')
+        self.assertEqual(self.backend.run('chat', "db.items.estimatedDocumentCount()"), '10')
+        self.assertEqual(self.backend.run('chat', "db.items.distinct('even')"), 'False\nTrue')
+        self.assertIn('"n": 3', self.backend.run('chat', "db.items.findOne({n: 3})"))
+        for name in ('count_documents', 'estimated_document_count', 'distinct'):
+            self.assertIn((name, {'maxTimeMS': 2000}), self.client.calls)
+        self.assertIn(('find_one', {'max_time_ms': 2000}), self.client.calls)
+
+    def test_databases_per_key(self):
+        self.backend.run('chat', "use shop")
+        self.backend.run('chat', "db.orders.insertOne({total: 3})")
+        self.assertEqual(self.backend.run('chat', "show collections"), 'orders')
+        self.assertEqual(self.backend.run('other', "show collections"), 'items')
+
+    def test_read_only(self):
+        with self.assertRaises(PermissionError):
+            self.backend.run('chat', "db.items.drop()", read_only=True)
+        self.assertEqual(len(self.client['test']['items'].documents), 10)
+        self.assertEqual(self.backend.get_stats()['errors'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()